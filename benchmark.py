@@ -0,0 +1,252 @@
+import argparse
+import gzip
+import io
+import json
+import lzma
+import multiprocessing as mp
+import platform
+import queue
+import resource
+import sys
+import time
+from itertools import islice
+from typing import List, Dict, Callable, Optional
+
+from bitbuffer import BitBufferWriter
+from cache import StringCache, SchemaCache
+from compress import compress_records, make_buffers, LINKING_COLUMN
+from datablock import Sinkable, RECORD_MAX_BLOCK_SIZE
+from ingest import RecordBuilder, open_input, read_input
+from parallel import POLL_SECONDS
+from record import CompactRecord
+from recordbuffer import RecordBuffer
+from utils import flatten
+from writer import BlockWriter, KEY_RECORD_BLOCK
+
+DEFAULT_INPUT = 'data/stock_data.json.gz'
+DEFAULT_SIZES = '1000,5000'
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 0.1  # allowed relative loss of speed or ratio before the comparison fails
+VALUES_PER_RECORD = 16  # add_value calls per record in the bit buffer benchmark
+
+
+class CollectingSink(Sinkable):
+
+    def __init__(self):
+        self.records: List[CompactRecord] = list()
+
+    def add(self, data: CompactRecord) -> None:
+        self.records.append(data)
+
+    def close(self):
+        pass
+
+
+def load_lines(path: str, size: Optional[int]) -> List[str]:
+    with open_input(path) as fp:
+        return [line for line in islice(fp, size) if line.strip()]
+
+
+def build_records(lines: List[str], buf: RecordBuffer, linking_column: str = LINKING_COLUMN) -> list:
+    builder = RecordBuilder(linking_column)
+    records = list()
+    for index, line in enumerate(lines):
+        record = builder.build(index, flatten(json.loads(line)))
+        buf.index_string_values(record)
+        records.append(record)
+    return records
+
+
+def bench_pipeline(lines: List[str]) -> dict:
+    out = io.BytesIO()
+    start = time.perf_counter()
+    count, _ = compress_records(read_input(iter(lines)), out)
+    return {'seconds': time.perf_counter() - start, 'records': count, 'bytes_out': len(out.getvalue())}
+
+
+def bench_bitbuffer(lines: List[str]) -> dict:
+    values = [((i * 2654435761) & 0xffffffff, 1 + i % 40) for i in range(len(lines) * VALUES_PER_RECORD)]
+    out = io.BytesIO()
+    bb = BitBufferWriter(out)
+    bb.set_metric('values')
+    start = time.perf_counter()
+    for value, bits in values:
+        bb.add_value(value, bits)
+    bb.close()
+    return {'seconds': time.perf_counter() - start, 'records': len(lines)}  # synthetic values, no ratio
+
+
+def bench_record_buffer(lines: List[str]) -> dict:
+    buf = make_buffers(CollectingSink(), StringCache(), SchemaCache())
+    records = build_records(lines, buf)
+    start = time.perf_counter()
+    for record in records:
+        buf.add(record)
+    buf.close()
+    return {'seconds': time.perf_counter() - start, 'records': len(records)}
+
+
+def bench_save_record(lines: List[str]) -> dict:
+    sink = CollectingSink()
+    buf = make_buffers(sink, StringCache(), SchemaCache())
+    for record in build_records(lines, buf):
+        buf.add(record)
+    buf.close()
+    schema_cache = buf.schema_cache
+    for r in sink.records:
+        if r.signature == KEY_RECORD_BLOCK:
+            schema_cache.add(r.schema_hash, schema_cache.schema_of(r.schema_hash))  # as Sink.add does
+    out = io.BytesIO()
+    bb = BitBufferWriter(out)
+    bw = BlockWriter(bit_buffer=bb)
+    bw.save_meta({'linking_column': LINKING_COLUMN})
+    start = time.perf_counter()
+    for i, r in enumerate(sink.records):
+        if i % RECORD_MAX_BLOCK_SIZE == 0:
+            bw.start_block(buf.string_cache.index)
+        bw.save_record(r, schema_cache.ids.get(r.schema_hash))
+    bb.close()
+    return {'seconds': time.perf_counter() - start, 'records': len(sink.records), 'bytes_out': len(out.getvalue())}
+
+
+def _baseline(compress: Callable[[bytes], bytes]) -> Callable[[List[str]], dict]:
+    def bench(lines: List[str]) -> dict:
+        data = ''.join(lines).encode('utf-8')
+        start = time.perf_counter()
+        compressed = compress(data)
+        return {'seconds': time.perf_counter() - start, 'records': len(lines), 'bytes_out': len(compressed)}
+    return bench
+
+
+stages: Dict[str, Callable[[List[str]], dict]] = {
+    'compress.py': bench_pipeline,
+    'BitBufferWriter.add_value': bench_bitbuffer,
+    'RecordBuffer.add': bench_record_buffer,
+    'BlockWriter.save_record': bench_save_record,
+    'gzip': _baseline(lambda data: gzip.compress(data, compresslevel=6)),
+    'xz': _baseline(lambda data: lzma.compress(data, preset=6)),
+}
+try:
+    import zstandard
+
+    stages['zstd'] = _baseline(lambda data: zstandard.ZstdCompressor(level=3).compress(data))
+except ImportError:
+    pass
+
+
+def measure(stage: str, path: str, size: Optional[int], repeats: int) -> dict:
+    """Runs the stage over the first `size` lines of input `repeats` times, keeps the fastest run
+    """
+    lines = load_lines(path, size)
+    runs = [stages[stage](lines) for _ in range(repeats)]
+    ret = min(runs, key=lambda r: r['seconds'])
+    bytes_in = sum(len(line.encode('utf-8')) for line in lines)
+    ret.update(stage=stage, lines=len(lines), bytes_in=bytes_in,
+               mb_per_s_in=bytes_in / ret['seconds'] / 1e6 if ret['seconds'] else None,
+               records_per_s=ret['records'] / ret['seconds'] if ret['seconds'] else None,
+               peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    if 'bytes_out' in ret:
+        ret['bytes_per_record'] = ret['bytes_out'] / ret['records'] if ret['records'] else None
+        ret['ratio'] = bytes_in / ret['bytes_out'] if ret['bytes_out'] else None
+    return ret
+
+
+def _measure_in_child(results: mp.Queue, *args) -> None:
+    try:
+        results.put(measure(*args))
+    except Exception as e:
+        results.put(e)
+
+
+def measure_isolated(stage: str, path: str, size: Optional[int], repeats: int) -> dict:
+    """Measures the stage in a fresh interpreter, so peak RSS belongs to this stage only,
+    raises RuntimeError if the interpreter exits without result (killed or crashed)
+    """
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    p = ctx.Process(target=_measure_in_child, args=(results, stage, path, size, repeats), name='bench-%s' % stage)
+    p.start()
+    while True:
+        alive = p.is_alive()  # see parallel._get
+        try:
+            ret = results.get(timeout=POLL_SECONDS)
+            break
+        except queue.Empty:
+            if not alive:
+                raise RuntimeError('%s exited with code %s' % (p.name, p.exitcode))
+    p.join()
+    if isinstance(ret, Exception):
+        raise ret
+    return ret
+
+
+def run(path: str, sizes: List[Optional[int]], repeats: int, selected: Optional[List[str]] = None,
+        isolated: bool = True) -> dict:
+    results = list()
+    for size in sizes:
+        for stage in selected or stages:
+            results.append((measure_isolated if isolated else measure)(stage, path, size, repeats))
+    return {'input': path, 'repeats': repeats, 'python': platform.python_version(), 'machine': platform.machine(),
+            'results': results}
+
+
+def compare(current: dict, previous: dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """Returns the regressions of current results against previous ones: the stages which became slower
+    or compress worse by more than tolerance
+    """
+    before = {(r['stage'], r['lines']): r for r in previous['results']}
+    ret = list()
+    for r in current['results']:
+        old = before.get((r['stage'], r['lines']))
+        if old is None:
+            continue
+        if old.get('records_per_s') and r['records_per_s'] < old['records_per_s'] * (1 - tolerance):
+            ret.append('%s (%s lines): %.0f records/s, was %.0f' % (r['stage'], r['lines'], r['records_per_s'],
+                                                                    old['records_per_s']))
+        if old.get('bytes_out') and r.get('bytes_out', 0) > old['bytes_out'] * (1 + tolerance):
+            ret.append('%s (%s lines): %s bytes, was %s' % (r['stage'], r['lines'], r['bytes_out'], old['bytes_out']))
+    return ret
+
+
+def show(report: dict) -> None:
+    print('%-26s %8s %9s %12s %10s %11s %8s %12s' % ('stage', 'lines', 'MB/s in', 'records/s', 'bytes out',
+                                                     'bytes/rec', 'ratio', 'peak RSS KB'))
+    for r in report['results']:
+        print('%-26s %8s %9.2f %12.0f %10s %11s %8s %12s' % (
+            r['stage'], r['lines'], r['mb_per_s_in'] or 0, r['records_per_s'] or 0, r.get('bytes_out', '-'),
+            '%.2f' % r['bytes_per_record'] if r.get('bytes_per_record') else '-',
+            '%.2f' % r['ratio'] if r.get('ratio') else '-', r['peak_rss_kb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the compressor and its components against gzip/xz/zstd')
+    parser.add_argument('-i', '--in', default=DEFAULT_INPUT, help='json lines (plain, gzip, xz or zstd)',
+                        required=False)
+    parser.add_argument('-n', '--sizes', default=DEFAULT_SIZES,
+                        help='comma separated numbers of lines, "all" for the whole input', required=False)
+    parser.add_argument('-r', '--repeats', help='runs per measurement, the fastest is kept', type=int,
+                        default=DEFAULT_REPEATS, required=False)
+    parser.add_argument('-s', '--stages', help='comma separated stages, all by default: %s' % ', '.join(stages),
+                        required=False)
+    parser.add_argument('-o', '--out', default='benchmark.json', help='json file for results', required=False)
+    parser.add_argument('-c', '--compare', help='json results of previous run, exits with 1 on regression',
+                        required=False)
+    parser.add_argument('-t', '--tolerance', help='allowed relative regression', type=float,
+                        default=DEFAULT_TOLERANCE, required=False)
+
+    args = vars(parser.parse_args())
+    sizes = [None if size == 'all' else int(size) for size in args.get('sizes').split(',')]
+    selected = args.get('stages').split(',') if args.get('stages') else None
+    if selected and not set(selected) <= set(stages):
+        parser.error('unknown stages: %s' % ', '.join(sorted(set(selected) - set(stages))))
+    report = run(args.get('in'), sizes, args.get('repeats'), selected)
+    show(report)
+    with open(args.get('out'), 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    if args.get('compare'):
+        with open(args.get('compare')) as fp:
+            regressions = compare(report, json.load(fp), args.get('tolerance'))
+        for regression in regressions:
+            print('regression: %s' % regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,38 @@
+import json
+import os
+import tempfile
+import unittest
+
+from benchmark import run, compare, stages
+from reader_test import make_records
+
+
+class TestingBenchmark(unittest.TestCase):
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'records.json')
+            with open(path, 'w') as fp:
+                for r in make_records(120):
+                    fp.write(json.dumps(r) + '\n')
+            report = run(path, [50, None], repeats=1, isolated=False)
+
+        self.assertEqual(len(report['results']), 2 * len(stages))
+        by_stage = {(r['stage'], r['lines']): r for r in report['results']}
+        pipeline = by_stage[('compress.py', 120)]
+        self.assertEqual(pipeline['records'], 120)
+        self.assertGreater(pipeline['ratio'], 1)
+        self.assertGreater(by_stage[('gzip', 50)]['bytes_out'], 0)
+        self.assertEqual(by_stage[('BlockWriter.save_record', 50)]['records'], 50)
+        self.assertIsNone(by_stage[('RecordBuffer.add', 50)].get('bytes_out'))
+        json.dumps(report)
+
+        self.assertEqual(compare(report, report), [])
+        slower = json.loads(json.dumps(report))
+        slower['results'][0]['records_per_s'] /= 2
+        slower['results'][0]['bytes_out'] *= 2
+        self.assertEqual(len(compare(slower, report)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,20 @@
+import mmap
+import os
+import queue
+import struct
+import threading
 from abc import ABC, abstractmethod
-from typing import List, Dict
-from typing.io import BinaryIO
+from typing import List, Dict, Iterable, Tuple, Union, BinaryIO, Optional
 
-import numpy as np
-
-FIRST_BIT_OF_BYTE = 1 << 7
 CHUNK_SIZE = 512
+BACKGROUND_CHUNK_SIZE = 1 << 20  # chunks are handed over to the I/O thread, so they can be large
+BACKGROUND_BUFFERS = 3  # one is filled by the encoder, the others are written or wait for it
+FSYNC_NEVER = 'never'
+FSYNC_CLOSE = 'close'  # fsync once, after the last chunk
+FSYNC_ALWAYS = 'always'  # fsync after every chunk
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_CLOSE, FSYNC_ALWAYS)
+
+_WORD = struct.Struct('>Q')
 
 
 class BufferWriter(ABC):
@@ -13,6 +22,25 @@ class BufferWriter(ABC):
     def add_value(self, value: int, bits_in_value=1):
         pass
 
+    def add_values(self, values: Iterable[Tuple[int, int]]):
+        """Packs a batch of (value, bits_in_value) pairs, in order
+        """
+        for value, bits_in_value in values:
+            self.add_value(value, bits_in_value)
+
+    def add_bytes(self, data: bytes):
+        """Packs a raw byte payload, 8 bits per byte
+        """
+        for b in data:
+            self.add_value(b, 8)
+
+    @property
+    @abstractmethod
+    def position(self) -> int:
+        """Number of bits added so far
+        """
+        pass
+
     @abstractmethod
     def set_metric(self, metric: str):
         pass
@@ -23,13 +51,22 @@ class BufferWriter(ABC):
 
 
 class Statistics:
+    """Number and bits of blocks per metric, the bits are counted by positions at which metrics change,
+    so adding values costs nothing. Bits and time per column are collected only if the writer profiles them
+    (see BlockWriter), they are kept by "col_name:col_type"
+    """
 
     def __init__(self):
         self.counter: Dict[str, int] = dict()
         self.volume: Dict[str, int] = dict()
         self.metric = ''
+        self.start = 0  # position at which the current metric started
+        self.columns: Dict[str, List[Union[int, float]]] = dict()  # map: col_name:col_type => [bits, seconds]
+        self.history: Dict[str, Dict[str, int]] = dict()  # map: pass of delta search => HistoryStore.counters()
 
-    def set_metric(self, metric: str):
+    def set_metric(self, metric: str, position: int = None):
+        if position is not None:
+            self.account(position)
         self.metric = metric
         if metric not in self.counter:
             self.counter[metric] = 0
@@ -42,6 +79,58 @@ class Statistics:
             raise Exception('invoke set_metric before measuring')
         self.volume[self.metric] += bits
 
+    def account(self, position: int):
+        """Adds the bits from the start of current metric up to position to it
+        """
+        if position != self.start:
+            self.measure(position - self.start)
+            self.start = position
+
+    def measure_column(self, column: str, bits: int, seconds: float):
+        if column not in self.columns:
+            self.columns[column] = [0, 0.0]
+        self.columns[column][0] += bits
+        self.columns[column][1] += seconds
+
+    def count_history(self, name: str, counters: Dict[str, int]) -> None:
+        summed = self.history.setdefault(name, dict())
+        for counter, value in counters.items():
+            summed[counter] = summed.get(counter, 0) + value
+
+    def codecs(self) -> Dict[str, List[Union[int, float]]]:
+        """Bits and time of columns summed by column type (the codec)
+        """
+        ret = dict()
+        for column, (bits, seconds) in self.columns.items():
+            codec = ret.setdefault(column.rsplit(':', 1)[1], [0, 0.0])
+            codec[0] += bits
+            codec[1] += seconds
+        return ret
+
+    def snapshot(self) -> dict:
+        """Returns json-serializable metrics, with sorted keys they can be diffed between runs
+        """
+        return {
+            'total_bits': sum(self.volume.values()),
+            'blocks': {metric: {'count': count, 'bits': self.volume.get(metric, 0)}
+                       for metric, count in self.counter.items()},
+            'columns': {column: {'bits': bits, 'seconds': round(seconds, 6)}
+                        for column, (bits, seconds) in self.columns.items()},
+            'codecs': {codec: {'bits': bits, 'seconds': round(seconds, 6)}
+                       for codec, (bits, seconds) in self.codecs().items()},
+            'history': self.history,
+        }
+
+    def merge(self, other: 'Statistics') -> None:
+        for metric, count in other.counter.items():
+            self.counter[metric] = self.counter.get(metric, 0) + count
+        for metric, vol in other.volume.items():
+            self.volume[metric] = self.volume.get(metric, 0) + vol
+        for column, (bits, seconds) in other.columns.items():
+            self.measure_column(column, bits, seconds)
+        for name, counters in other.history.items():
+            self.count_history(name, counters)
+
     def show(self):
         total_vol_bytes = 0
         for metric, vol in self.volume.items():
@@ -50,114 +139,307 @@ class Statistics:
         print("total %s bytes" % total_vol_bytes)
         for metric, count in self.counter.items():
             print("%s : %s block(s), avg size = %s bytes/block" % (metric, count, self.volume.get(metric)/(8 * count)))
+        for column, (bits, seconds) in sorted(self.columns.items(), key=lambda c: -c[1][0]):
+            print("%s : %s bytes, %.3f s" % (column, bits / 8, seconds))
+        for name, counters in self.history.items():
+            print("%s : %s" % (name, ', '.join('%s=%s' % item for item in counters.items())))
 
 
 class BitBufferReader:
+    """Reads values from a memory-mapped bitstream, fields are extracted from 64-bit words
+    with a shift and a mask, so the cost of a read does not depend on the number of bits in it
+    """
 
-    def __init__(self, io: BinaryIO, size: int = CHUNK_SIZE):
-        self.default_buffer_size = size
-        self.unused_bits_in_last_byte_bit_length = 0
-        self._capacity = size
-        self._buffer = np.zeros(self._capacity, dtype=np.uint8)
-        self._length = 0  # length in bytes
-        self._bit_position = FIRST_BIT_OF_BYTE
-        self._cur_byte = 0
-        self._offset = 0
+    def __init__(self, io: Union[BinaryIO, bytes, bytearray, memoryview, mmap.mmap]):
         self.io = io
-        self._mask: List[int] = list()
-        for shift in range(64):
-            self._mask.append(1 << shift)
-        self._mask.reverse()
-        self._load()
-        self._cur_byte = self._buffer.item(self._length)
-        self._length += 1
-
-    def _load(self):
-        self._buffer = np.fromfile(self.io, dtype=np.uint8, count=self._capacity, offset=self._offset)
-        print(self._buffer)
-        self._offset += self._capacity
-
-    def _get_byte(self):
-        self._cur_byte = self._buffer.item(self._length)
-        self._length += 1
-        if self._length >= self._capacity:
-            self._load()
-            self._length = 0
+        self._mmap = None
+        if isinstance(io, (bytes, bytearray, memoryview, mmap.mmap)):
+            data = io
+        else:
+            try:
+                self._mmap = mmap.mmap(io.fileno(), 0, access=mmap.ACCESS_READ)
+                data = self._mmap
+            except (AttributeError, OSError, ValueError):
+                # not a regular file (pipe, in-memory stream) or an empty file
+                data = io.read()
+        self._data = memoryview(data).cast('B')
+        self._length = len(self._data)  # length in bytes
+        self._size = self._length * 8  # length in bits
+        self._position = 0  # absolute position in bits
+
+    @property
+    def size(self) -> int:
+        """Total number of bits in the stream
+        """
+        return self._size
+
+    @property
+    def bits_left(self) -> int:
+        return self._size - self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, bit_offset: int) -> None:
+        if bit_offset < 0 or bit_offset > self._size:
+            raise ValueError('bit offset %s is out of stream of %s bits' % (bit_offset, self._size))
+        self._position = bit_offset
+
+    def skip(self, bits: int) -> None:
+        """Moves over bits without reading them
+        """
+        end = self._position + bits
+        if end > self._size:
+            raise EOFError('cannot skip %s bits at %s, stream has %s bits' % (bits, self._position, self._size))
+        self._position = end
+
+    def align(self) -> None:
+        """Skips the padding bits up to the next byte boundary
+        """
+        self._position = (self._position + 7) & ~7
 
     def get_value(self, bits_in_value: int = 1) -> int:
         if bits_in_value == 0:
             return 0
-        ret = 0
-        for bit_pos in range(bits_in_value):
-            if self._cur_byte & self._bit_position:
-                ret += 1
-            ret = ret << 1
-            if self._bit_position == 1:
-                self._bit_position = FIRST_BIT_OF_BYTE
-                self._get_byte()
-            else:
-                self._bit_position = self._bit_position >> 1
-        ret = ret >> 1
+        position = self._position
+        end = position + bits_in_value
+        if end > self._size:
+            raise EOFError('cannot read %s bits at %s, stream has %s bits' % (bits_in_value, position, self._size))
+        offset = position >> 3
+        if bits_in_value <= 57 and offset + 8 <= self._length:
+            # the whole field lies within one 64-bit word starting at the current byte
+            word = _WORD.unpack_from(self._data, offset)[0]
+            ret = (word >> (64 - (position & 7) - bits_in_value)) & ((1 << bits_in_value) - 1)
+        else:
+            length = ((end + 7) >> 3) - offset
+            word = int.from_bytes(self._data[offset:offset + length], 'big')
+            ret = (word >> (length * 8 - (position & 7) - bits_in_value)) & ((1 << bits_in_value) - 1)
+        self._position = end
         return ret
 
+    def get_bytes(self, length: int) -> bytes:
+        """Reads a raw byte payload, without shifting when the stream is byte-aligned
+        """
+        position = self._position
+        if position & 7:
+            return self.get_value(length * 8).to_bytes(length, 'big')
+        if position + length * 8 > self._size:
+            raise EOFError('cannot read %s bytes at %s, stream has %s bits' % (length, position, self._size))
+        self._position = position + length * 8
+        return bytes(self._data[position >> 3:(position >> 3) + length])
+
+    def close(self):
+        self._data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class BackgroundWriter:
+    """Writes chunks to io in a separate thread, the chunks come from a fixed pool of buffers, which are
+    returned to the pool once written. The encoder waits only if all buffers are still queued for writing
+    """
+
+    def __init__(self, io: BinaryIO, size: int, buffers: int = BACKGROUND_BUFFERS, fsync: str = FSYNC_NEVER):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy %s, expected one of %s' % (fsync, ', '.join(FSYNC_POLICIES)))
+        if buffers < 2:
+            raise ValueError('background writing needs at least 2 buffers, got %s' % buffers)
+        self.io = io
+        self.fsync = fsync
+        self.free: queue.Queue = queue.Queue()
+        for _ in range(buffers - 1):
+            self.free.put(bytearray(size))
+        self.pending: queue.Queue = queue.Queue()
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, name='bitbuffer-flush', daemon=True)
+        self.thread.start()
+
+    def _sync(self):
+        self.io.flush()
+        os.fsync(self.io.fileno())
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            buffer, length = item
+            try:
+                if self.error is None:
+                    self.io.write(buffer if length == len(buffer) else memoryview(buffer)[:length])
+                    if self.fsync == FSYNC_ALWAYS:
+                        self._sync()
+            except BaseException as e:
+                self.error = e
+            self.free.put(buffer)
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, buffer: bytearray, length: int) -> bytearray:
+        """Queues the first length bytes of buffer for writing, returns an empty buffer to continue with
+        """
+        self._check()
+        self.pending.put((buffer, length))
+        return self.free.get()
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self._check()
+        if self.fsync != FSYNC_NEVER:
+            self._sync()
+
 
 class BitBufferWriter(BufferWriter):
+    """Packs values into a 64-bit accumulator and emits whole bytes into the output chunk,
+    the produced bitstream is MSB-first, exactly the same as with bit-by-bit packing.
+
+    With background, full chunks are written by BackgroundWriter and the encoder continues
+    with another buffer of the pool, fsync (see FSYNC_POLICIES) needs io with fileno()
+    """
 
-    def __init__(self, io: BinaryIO, size: int = CHUNK_SIZE):
+    def __init__(self, io: BinaryIO, size: int = CHUNK_SIZE, background: bool = False,
+                 buffers: int = BACKGROUND_BUFFERS, fsync: str = FSYNC_NEVER):
         self.default_buffer_size = size
         self.unused_bits_in_last_byte_bit_length = 0
         self._capacity = size
-        self._buffer = np.zeros(self._capacity, dtype=np.uint8)
+        self._buffer = bytearray(self._capacity)
         self._length = 0  # length in bytes
-        self._bit_position = FIRST_BIT_OF_BYTE
-        self._cur_byte = 0
-        self._offset = 0
+        self._flushed = 0  # bytes already written to io
+        self._acc = 0  # pending bits, never more than 63 between calls
+        self._acc_bits = 0
         self.io = io
-        self._mask: List[int] = list()
-        for i in range(64):
-            self._mask.append(1 << i)
-        self._mask.reverse()
         self.stat = Statistics()
+        self._writer: Optional[BackgroundWriter] = None
+        if background:
+            self._writer = BackgroundWriter(io, size, buffers, fsync)
+        elif fsync not in FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy %s, expected one of %s' % (fsync, ', '.join(FSYNC_POLICIES)))
+        self.fsync = fsync
 
     def _flush(self):
-        self._buffer.tofile(self.io)
-
-    def _push_byte(self):
-        self._buffer.itemset(self._length, self._cur_byte)
-        self._cur_byte = 0
-        self._length += 1
-        if self._length >= self._capacity:
-            self._flush()
-            self._buffer = np.zeros(self._capacity, dtype=np.uint8)
-            self._length = 0
+        if self._writer is not None:
+            self._buffer = self._writer.submit(self._buffer, self._length)
+        elif self._length == self._capacity:
+            self.io.write(self._buffer)
+        else:
+            self.io.write(memoryview(self._buffer)[:self._length])
+        if self._writer is None and self.fsync == FSYNC_ALWAYS:
+            self.io.flush()
+            os.fsync(self.io.fileno())
+        self._flushed += self._length
+
+    def _emit(self, data: bytes):
+        length = self._length
+        n = len(data)
+        if length + n < self._capacity:
+            self._buffer[length:length + n] = data
+            self._length = length + n
+            return
+        pos = 0
+        while pos < n:
+            take = min(self._capacity - self._length, n - pos)
+            self._buffer[self._length:self._length + take] = data[pos:pos + take]
+            self._length += take
+            pos += take
+            if self._length >= self._capacity:
+                self._flush()
+                self._length = 0
+
+    @property
+    def position(self) -> int:
+        return (self._flushed + self._length) * 8 + self._acc_bits
+
+    def resume(self, bit_offset: int, last_byte: int = 0):
+        """Continues a stream of bit_offset bits: io is positioned after its whole bytes and last_byte holds
+        the rest of bits (if bit_offset is not byte-aligned), which are written again with the following values
+        """
+        if self.position:
+            raise ValueError('only an empty buffer can resume a stream')
+        self._flushed = bit_offset // 8
+        self._acc_bits = bit_offset % 8
+        self._acc = last_byte >> (8 - self._acc_bits) if self._acc_bits else 0
+        self.stat.start = bit_offset
 
     def set_metric(self, metric: str):
-        self.stat.set_metric(metric)
+        self.stat.set_metric(metric, self.position)
 
     def add_value(self, value: int, bits_in_value: int = 1):
         if bits_in_value == 0:
             # Nothing to do.
             return
-        for bit_pos in range(bits_in_value):
-           # print('test: %s == %s' % (value, self._mask[64 - bits_in_value + bit_pos]))
-            if value & self._mask[64 - bits_in_value + bit_pos]:
-                self._cur_byte |= self._bit_position
-            if self._bit_position == 1:
-                self._bit_position = FIRST_BIT_OF_BYTE
-                self._push_byte()
-            else:
-                self._bit_position = self._bit_position >> 1
-        #print('added data: %s' % self._cur_byte)
-        self.stat.measure(bits_in_value)
+        acc = (self._acc << bits_in_value) | (value & ((1 << bits_in_value) - 1))
+        acc_bits = self._acc_bits + bits_in_value
+        if acc_bits >= 64:
+            rest = acc_bits & 7
+            self._emit((acc >> rest).to_bytes(acc_bits >> 3, 'big'))
+            acc &= (1 << rest) - 1
+            acc_bits = rest
+        self._acc = acc
+        self._acc_bits = acc_bits
+
+    def add_values(self, values: Iterable[Tuple[int, int]]):
+        acc = self._acc
+        acc_bits = self._acc_bits
+        for value, bits_in_value in values:
+            acc = (acc << bits_in_value) | (value & ((1 << bits_in_value) - 1))
+            acc_bits += bits_in_value
+            if acc_bits >= 64:
+                rest = acc_bits & 7
+                self._emit((acc >> rest).to_bytes(acc_bits >> 3, 'big'))
+                acc &= (1 << rest) - 1
+                acc_bits = rest
+        self._acc = acc
+        self._acc_bits = acc_bits
+
+    def add_bytes(self, data: bytes):
+        if not data:
+            return
+        self._emit_whole_bytes()
+        rest = self._acc_bits
+        if rest == 0:
+            self._emit(data)
+        else:
+            # payload is not byte-aligned: shift it through the accumulator in one go
+            acc = (self._acc << (len(data) * 8)) | int.from_bytes(data, 'big')
+            self._emit((acc >> rest).to_bytes(len(data), 'big'))
+            self._acc = acc & ((1 << rest) - 1)
+
+    def _emit_whole_bytes(self):
+        if self._acc_bits >= 8:
+            rest = self._acc_bits & 7
+            self._emit((self._acc >> rest).to_bytes(self._acc_bits >> 3, 'big'))
+            self._acc &= (1 << rest) - 1
+            self._acc_bits = rest
+
+    def flush(self):
+        """Hands all whole bytes over to io (or the background writer), up to 7 bits stay in the accumulator
+        """
+        self._emit_whole_bytes()
+        if self._length > 0:
+            self._flush()
+            self._length = 0
 
     def close(self):
-        print('closing buffer')
-        print(self._cur_byte)
-
-        if self._length > 0 or self._bit_position != FIRST_BIT_OF_BYTE:
-            self._push_byte()
-            print(self._buffer)
+        self.stat.account(self.position)  # the padding of last byte is not counted
+        self._emit_whole_bytes()
+        if self._acc_bits > 0:
+            # the last byte is padded with zero bits
+            self._emit(bytes([(self._acc << (8 - self._acc_bits)) & 0xff]))
+            self._acc = 0
+            self._acc_bits = 0
+        if self._length > 0:
             self._flush()
+            self._length = 0
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif self.fsync == FSYNC_CLOSE:
+            self.io.flush()
+            os.fsync(self.io.fileno())
 
 
 class DummyBufferWriter(BufferWriter):
@@ -165,6 +447,10 @@ class DummyBufferWriter(BufferWriter):
         self.saved_bits = 0
         self.stat = Statistics()
 
+    @property
+    def position(self) -> int:
+        return self.saved_bits
+
     def set_metric(self, metric: str):
         self.stat.set_metric(metric)
 
@@ -1,15 +1,34 @@
+import io
+import os
+import random
+import tempfile
 import unittest
 
-from bitbuffer import BitBufferWriter, BitBufferReader
+from bitbuffer import BitBufferWriter, BitBufferReader, FSYNC_ALWAYS, FSYNC_CLOSE
+
+
+def pack_bit_by_bit(values) -> bytes:
+    """Reference packer, MSB-first, one bit per step
+    """
+    bits = list()
+    for value, bits_in_value in values:
+        for pos in range(bits_in_value - 1, -1, -1):
+            bits.append((value >> pos) & 1)
+    while len(bits) % 8:
+        bits.append(0)
+    return bytes(int(''.join(str(b) for b in bits[i:i + 8]), 2) for i in range(0, len(bits), 8))
 
 
 class TestingBitBuffer(unittest.TestCase):
 
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
     def test_functional_saving(self):
-        with open('test.bin', 'wb') as f:
+        with open(os.path.join(self.tmp, 'test.bin'), 'wb') as f:
             bb = BitBufferWriter(f)
-            print('mask')
-            print(bb._mask)
             bb.set_metric('test_1')
 
             bb.add_value(1, 1)
@@ -21,19 +40,18 @@ class TestingBitBuffer(unittest.TestCase):
             bb.close()
             bb.stat.show()
 
-        with open('test.bin', 'rb') as f:
+        with open(os.path.join(self.tmp, 'test.bin'), 'rb') as f:
             bb = BitBufferReader(f)
-            print(bb.get_value(1))
-            print(bb.get_value(3))
-            print(bb.get_value(1))
-            print(bb.get_value(4))
-            print(bb.get_value(1))
+            self.assertEqual(bb.get_value(1), 1)
+            self.assertEqual(bb.get_value(3), 7)
+            self.assertEqual(bb.get_value(1), 0)
+            self.assertEqual(bb.get_value(4), 8)
+            self.assertEqual(bb.get_value(1), 1)
+            bb.close()
 
     def test_special_cases_saving(self):
-        with open('test1.bin', 'wb') as f:
+        with open(os.path.join(self.tmp, 'test1.bin'), 'wb') as f:
             bb = BitBufferWriter(f)
-            print('mask')
-            print(bb._mask)
             bb.set_metric('test_2')
 
             bb.add_value(1, 1)
@@ -44,13 +62,154 @@ class TestingBitBuffer(unittest.TestCase):
             # should write 11110100|01000000 = F440
             bb.close()
 
-        with open('test1.bin', 'rb') as f:
+        with open(os.path.join(self.tmp, 'test1.bin'), 'rb') as f:
+            bb = BitBufferReader(f)
+            self.assertEqual(bb.get_value(1), 1)
+            self.assertEqual(bb.get_value(32), 7)
+            self.assertEqual(bb.get_value(1), 0)
+            self.assertEqual(bb.get_value(4), 8)
+            self.assertEqual(bb.get_value(1), 1)
+            bb.close()
+
+    def test_word_packing_matches_bit_by_bit(self):
+        random.seed(3)
+        values = [(random.getrandbits(70) - (1 << 69), random.choice([0, 1, 3, 8, 13, 32, 63, 64]))
+                  for _ in range(2000)]
+        expected = pack_bit_by_bit(values)
+
+        out = io.BytesIO()
+        bb = BitBufferWriter(out)
+        bb.set_metric('test_3')
+        for value, bits_in_value in values:
+            bb.add_value(value, bits_in_value)
+        bb.close()
+        data = out.getvalue()
+        self.assertEqual(data, expected)
+        self.assertEqual(bb.position, len(expected) * 8)
+
+        out_batch = io.BytesIO()
+        bb = BitBufferWriter(out_batch)
+        bb.set_metric('test_3')
+        bb.add_values(values)
+        bb.close()
+        self.assertEqual(out_batch.getvalue(), data)
+
+    def test_background_flush(self):
+        random.seed(4)
+        values = [(random.getrandbits(64), random.choice([1, 7, 33, 64])) for _ in range(3000)]
+        payload = bytes(range(256)) * 2
+        expected = io.BytesIO()
+        bb = BitBufferWriter(expected)
+        bb.set_metric('test_5')
+        bb.add_values(values)
+        bb.add_bytes(payload)
+        bb.close()
+        for size, buffers in [(16, 2), (100, 3), (1 << 20, 2)]:
+            out = io.BytesIO()
+            bb = BitBufferWriter(out, size=size, background=True, buffers=buffers)
+            bb.set_metric('test_5')
+            for value, bits_in_value in values:
+                bb.add_value(value, bits_in_value)
+            bb.add_bytes(payload)
+            bb.close()
+            self.assertEqual(out.getvalue(), expected.getvalue())
+
+    def test_background_fsync(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for fsync in [FSYNC_ALWAYS, FSYNC_CLOSE]:
+                path = os.path.join(tmp, fsync)
+                with open(path, 'wb') as f:
+                    bb = BitBufferWriter(f, size=64, background=True, fsync=fsync)
+                    bb.set_metric('test_6')
+                    bb.add_bytes(bytes(1000))
+                    bb.close()
+                self.assertEqual(os.path.getsize(path), 1000)
+        with self.assertRaises(ValueError):
+            BitBufferWriter(io.BytesIO(), fsync='sometimes')
+
+    def test_background_error(self):
+        class Broken(io.RawIOBase):
+            def write(self, data):
+                raise OSError('disk is full')
+
+        bb = BitBufferWriter(Broken(), size=16, background=True)
+        bb.set_metric('test_7')
+        with self.assertRaises(OSError):
+            for _ in range(100):
+                bb.add_bytes(bytes(16))
+            bb.close()
+
+    def test_bytes_payload(self):
+        payload = bytes(range(256)) * 3  # longer than CHUNK_SIZE
+        for prefix_bits in range(9):
+            values = [(0x1ff, prefix_bits)] + [(b, 8) for b in payload] + [(5, 3)]
+            out = io.BytesIO()
+            bb = BitBufferWriter(out)
+            bb.set_metric('test_4')
+            bb.add_value(0x1ff, prefix_bits)
+            bb.add_bytes(payload)
+            bb.add_value(5, 3)
+            bb.close()
+            expected = pack_bit_by_bit(values)
+            self.assertEqual(out.getvalue(), expected)
+            self.assertEqual(bb.stat.volume['test_4'], prefix_bits + len(payload) * 8 + 3)
+
+    def test_metrics_by_positions(self):
+        bb = BitBufferWriter(io.BytesIO())
+        bb.set_metric('header')
+        bb.add_value(3, 16)
+        bb.set_metric('record')
+        bb.add_values([(1, 5), (2, 7)])
+        bb.set_metric('header')
+        bb.add_bytes(b'ab')
+        bb.set_metric('record')
+        bb.add_value(1, 3)
+        bb.close()
+        self.assertEqual(bb.stat.counter, {'header': 2, 'record': 2})
+        self.assertEqual(bb.stat.volume, {'header': 32, 'record': 15})
+        bb.stat.measure_column('price:float64', 10, 0.5)
+        bb.stat.measure_column('volume:int32', 5, 0.25)
+        bb.stat.measure_column('open:float64', 2, 0.25)
+        snapshot = bb.stat.snapshot()
+        self.assertEqual(snapshot['total_bits'], 47)
+        self.assertEqual(snapshot['blocks']['record'], {'count': 2, 'bits': 15})
+        self.assertEqual(snapshot['codecs'], {'float64': {'bits': 12, 'seconds': 0.75},
+                                              'int32': {'bits': 5, 'seconds': 0.25}})
+
+    def test_reading_words_and_seeking(self):
+        random.seed(5)
+        values = [(random.getrandbits(64), random.choice([1, 2, 7, 8, 15, 31, 57, 58, 64])) for _ in range(3000)]
+        with open(os.path.join(self.tmp, 'test3.bin'), 'wb') as f:
+            bb = BitBufferWriter(f)
+            bb.set_metric('test_5')
+            bb.add_values(values)
+            bb.close()
+
+        with open(os.path.join(self.tmp, 'test3.bin'), 'rb') as f:
             bb = BitBufferReader(f)
-            print(bb.get_value(1))
-            print(bb.get_value(32))
-            print(bb.get_value(1))
-            print(bb.get_value(4))
-            print(bb.get_value(1))
+            offsets = list()
+            for value, bits_in_value in values:
+                offsets.append(bb.tell())
+                self.assertEqual(bb.get_value(bits_in_value), value & ((1 << bits_in_value) - 1))
+            for i in (2999, 0, 1500, 17):
+                bb.seek(offsets[i])
+                value, bits_in_value = values[i]
+                self.assertEqual(bb.get_value(bits_in_value), value & ((1 << bits_in_value) - 1))
+            bb.seek(bb.size - 3)
+            self.assertEqual(bb.bits_left, 3)
+            with self.assertRaises(EOFError):
+                bb.get_value(4)
+            bb.close()
+
+    def test_reading_in_memory_bytes(self):
+        bb = BitBufferReader(bytes([0xf4, 0x40, 0x61, 0x62, 0x63]))
+        self.assertEqual(bb.get_value(3), 7)
+        bb.align()
+        self.assertEqual(bb.get_value(8), 0x40)
+        self.assertEqual(bb.get_bytes(3), b'abc')
+        self.assertEqual(bb.bits_left, 0)
+        bb.seek(4)
+        self.assertEqual(bb.get_bytes(1), bytes([0x44]))
 
 
 if __name__ == '__main__':
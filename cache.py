@@ -1,6 +1,7 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 from serializable import Serializable
+from utils import encode_varint, decode_varint, schema_fingerprint
 
 
 class SchemaCache(Serializable):
@@ -8,39 +9,69 @@ class SchemaCache(Serializable):
     """
 
     def __init__(self):
-        self.schemas: Dict[int, List[str]] = dict()  # map: hash => list(col_name:col_type)
+        self.schemas: Dict[int, List[str]] = dict()  # map: fingerprint => list(col_name:col_type), in order of ids
+        self.ids: Dict[int, int] = dict()  # map: fingerprint => sequential schema id, saved in key records
         self.saved_records = 0
+        self.columns: Dict[int, Tuple[Tuple[str, ...], Tuple[str, ...]]] = dict()  # map: hash => (names, types)
 
     @property
     def size(self) -> int:
         return len(self.schemas)
 
-    def add(self, schema_hash: int, schema: List[str]) -> None:
-        self.schemas[schema_hash] = schema
+    def add(self, schema_hash: int, schema: List[str]) -> int:
+        """Returns the id of schema, ids are given in order of adding, which is the order of saving too
+        """
+        if schema_hash not in self.schemas:
+            self.ids[schema_hash] = len(self.schemas)
+            self.schemas[schema_hash] = schema
+        return self.ids[schema_hash]
+
+    def register(self, schema_hash: int, names: List[str], types: List[str]) -> Tuple[str, ...]:
+        """Remembers the columns of every seen schema (saved or not), returns the tuple of types
+        shared by all records of the schema
+        """
+        if schema_hash not in self.columns:
+            self.columns[schema_hash] = (tuple(names), tuple(types))
+        return self.columns[schema_hash][1]
+
+    def types_of(self, schema_hash: int) -> Optional[Tuple[str, ...]]:
+        columns = self.columns.get(schema_hash)
+        return columns[1] if columns else None
+
+    def schema_of(self, schema_hash: int) -> List[str]:
+        names, types = self.columns[schema_hash]
+        return [name + ':' + col_type for name, col_type in zip(names, types)]
 
     def has_unsaved(self) -> bool:
         return self.saved_records != self.size
 
+    def _to_bytes(self, start: int) -> bytes:
+        to_save = [','.join(schema) for schema in list(self.schemas.values())[start:]]
+        return bytes('|'.join(to_save), encoding='UTF-8')
+
     def unsaved_to_bytes(self) -> bytes:
-        all_records = list(self.schemas.values())
-        all_records.reverse()
-        to_save = list()
-        for i in range(self.size - self.saved_records):
-            to_save.append(','.join(all_records[i]))
-        ret_bytes = bytes('|'.join([s for s in to_save]), encoding='UTF-8')
+        ret_bytes = self._to_bytes(self.saved_records)
         self.saved_records = self.size
         return ret_bytes
 
+    def to_bytes(self) -> bytes:
+        """Returns all schemas in the format of unsaved_to_bytes
+        """
+        return self._to_bytes(0)
+
     def append_from_bytes(self, data: bytes) -> None:
         restored = data.decode('utf-8')
         schema_records = restored.split('|')
         for schema in schema_records:
-            self.schemas[hash(schema)] = schema.split(',')
+            self.add(schema_fingerprint(schema), schema.split(','))
         self.saved_records = self.size
 
 
+NULL_STRING = b'\xff'  # saved bytes of None, never valid UTF-8 of a string
+
+
 class StringCache(Serializable):
-    """Implements cached string storage
+    """Implements cached string storage, None (the value of nullable columns) is cached as a string
     """
 
     def __init__(self):
@@ -49,7 +80,7 @@ class StringCache(Serializable):
         self.index = 0  # points to the last empty cell
         self.saved_ptr = 0
 
-    def add(self, value: str) -> int:
+    def add(self, value: Optional[str]) -> int:
         if value in self.reverse_dictionary:
             return self.reverse_dictionary[value]
         self.dictionary[self.index] = value
@@ -57,7 +88,7 @@ class StringCache(Serializable):
         self.index += 1
         return self.index - 1
 
-    def get(self, index: int) -> str:
+    def get(self, index: int) -> Optional[str]:
         """Restores the string value by its index in cache
         """
         return self.dictionary.get(index)
@@ -65,15 +96,34 @@ class StringCache(Serializable):
     def has_unsaved(self) -> bool:
         return self.saved_ptr != self.index
 
+    def _to_bytes(self, start: int) -> bytes:
+        ret_bytes = bytearray()
+        for idx in range(start, self.index):
+            value = self.dictionary[idx]
+            data = NULL_STRING if value is None else value.encode('utf-8')
+            ret_bytes += encode_varint(len(data))
+            ret_bytes += data
+        return bytes(ret_bytes)
+
     def unsaved_to_bytes(self) -> bytes:
-        ret_bytes = bytes(','.join([s for idx, s in self.dictionary.items() if idx >= self.saved_ptr - 1]),
-                          encoding='UTF-8')
+        """Appends strings added since the last call: [varint length|UTF-8 bytes] per string
+        """
+        ret_bytes = self._to_bytes(self.saved_ptr)
         self.saved_ptr = self.index
         return ret_bytes
 
+    def to_bytes(self) -> bytes:
+        """Returns all strings in the format of unsaved_to_bytes
+        """
+        return self._to_bytes(0)
+
     def append_from_bytes(self, data: bytes) -> None:
-        restored = data.decode('utf-8')
-        arr = restored.split(',')
-        for val in arr:
-            self.add(val)
+        pos = 0
+        while pos < len(data):
+            size, pos = decode_varint(data, pos)
+            if pos + size > len(data):
+                raise ValueError('string of %s bytes at %s is truncated' % (size, pos))
+            value = data[pos:pos + size]
+            self.add(None if value == NULL_STRING else value.decode('utf-8'))
+            pos += size
         self.saved_ptr = self.index
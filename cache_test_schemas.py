@@ -73,6 +73,8 @@ class TestingSchemaCacheCls(unittest.TestCase):
         restored_schema_cache.append_from_bytes(dump)
         print('restored schema:')
         print(restored_schema_cache.schemas)
+        self.assertEqual(restored_schema_cache.schemas, schema_cache.schemas)
+        self.assertEqual(restored_schema_cache.ids, {record_1.schema_hash: 0, record_2.schema_hash: 1})
 
 
 if __name__ == '__main__':
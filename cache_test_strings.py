@@ -11,23 +11,36 @@ class TestingStringCacheCls(unittest.TestCase):
         for test_item in TestingStringCacheCls.test_arr:
             str_cache.add(test_item)
 
-        print(str_cache.index)
-        print(str_cache.dictionary)
-        print(str_cache.reverse_dictionary)
-        print(str_cache.get(1))
+        self.assertEqual(str_cache.index, 2)
+        self.assertEqual(str_cache.get(1), 'other_1')
+        self.assertEqual(str_cache.reverse_dictionary['unqiue_1'], 0)
 
     def test_restore_cache(self):
         str_cache = StringCache()
+        restored = StringCache()
+        for values in [['value_1', 'with, comma'], [], ['ünïcode', '', 'x' * 300, 'with, comma']]:
+            for value in values:
+                str_cache.add(value)
+            restored.append_from_bytes(str_cache.unsaved_to_bytes())
+            self.assertFalse(str_cache.has_unsaved())
+
+        self.assertEqual(restored.dictionary, str_cache.dictionary)
+        self.assertEqual(restored.index, 5)
+        self.assertEqual(restored.get(1), 'with, comma')
+
+    def test_null(self):
+        str_cache = StringCache()
+        for value in ['value_1', None, '', None, '\xff']:
+            str_cache.add(value)
+        restored = StringCache()
+        restored.append_from_bytes(str_cache.unsaved_to_bytes())
+        self.assertEqual(restored.dictionary, {0: 'value_1', 1: None, 2: '', 3: '\xff'})
 
-        data_1 = bytes('value_1,value_2', encoding='UTF-8')
-        str_cache.append_from_bytes(data_1)
-        data_2 = bytes('value_3', encoding='UTF-8')
-        str_cache.append_from_bytes(data_2)
-
-        print(str_cache.index)
-        print(str_cache.dictionary)
-        print(str_cache.reverse_dictionary)
-        print(str_cache.get(1))
+    def test_truncated_cache(self):
+        str_cache = StringCache()
+        str_cache.add('value_1')
+        with self.assertRaises(ValueError):
+            StringCache().append_from_bytes(str_cache.unsaved_to_bytes()[:-1])
 
 
 if __name__ == '__main__':
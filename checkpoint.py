@@ -0,0 +1,141 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import BinaryIO, List, Optional, Tuple
+
+from datablock import BlockIndexEntry
+
+CHECKPOINT_MAGIC = b'TSCK'  # [magic (4 bytes)|index bit offset (8 bytes)|records (8 bytes)|fingerprint (4 bytes)|
+CHECKPOINT_SUFFIX = '.ckpt'  # sections: state json, strings, schemas, index as [length (4 bytes)|data]|crc32 (4 bytes)]
+FINGERPRINT_BYTES = 1 << 16  # bytes of stream before its block index covered by the fingerprint
+INDEX_ENTRY = struct.Struct('>QQQI?qq')  # bit offset, first and last rec_id, anchor, has timestamps, min/max timestamp
+
+# [rec_id, schema_hash, first_ref, second_ref, depth, since_key, linking value, timestamp, values]
+HistoryEntry = List[any]
+
+
+class Checkpoint:
+    """State of closed compressor which the next run continues the stream with: the string dictionary,
+    schemas, block index, learned column types and the last record of every series per pass of delta search
+    """
+
+    def __init__(self, index_offset: int, records: int, linking_column: Optional[str], strings: bytes,
+                 schemas: bytes, index: List[BlockIndexEntry], bindings: List[List[str]],
+                 histories: List[List[HistoryEntry]]):
+        self.index_offset = index_offset  # bit offset of block index, the appended blocks overwrite it
+        self.records = records
+        self.linking_column = linking_column
+        self.strings = strings  # see StringCache.to_bytes
+        self.schemas = schemas  # see SchemaCache.to_bytes
+        self.index = index
+        self.bindings = bindings  # list(col_name:col_type) per learned record shape
+        self.histories = histories
+        self.tail = 0  # the byte with the last bits before block index, read from the stream
+        self.fingerprint = 0  # crc32 of the end of stream before block index, see stream_fingerprint
+
+    def to_bytes(self) -> bytes:
+        state = json.dumps({'linking_column': self.linking_column, 'bindings': self.bindings,
+                            'histories': self.histories}, separators=(',', ':')).encode('utf-8')
+        index = b''.join(INDEX_ENTRY.pack(e.bit_offset, e.first_rec_id, e.last_rec_id, e.anchor,
+                                          e.min_timestamp is not None, e.min_timestamp or 0, e.max_timestamp or 0)
+                         for e in self.index)
+        data = bytearray(CHECKPOINT_MAGIC)
+        data += struct.pack('>QQI', self.index_offset, self.records, self.fingerprint)
+        for section in (state, self.strings, self.schemas, index):
+            data += len(section).to_bytes(4, 'big')
+            data += section
+        data += zlib.crc32(data).to_bytes(4, 'big')
+        return bytes(data)
+
+    @staticmethod
+    def from_bytes(data: any) -> 'Checkpoint':
+        """Parses the checkpoint from bytes or mmap, slices of which are copies
+        """
+        if data[:4] != CHECKPOINT_MAGIC or len(data) < 28:
+            raise ValueError('not a checkpoint')
+        if zlib.crc32(data[:-4]) != int.from_bytes(data[-4:], 'big'):
+            raise ValueError('checkpoint is corrupt')
+        index_offset, records, fingerprint = struct.unpack_from('>QQI', data, 4)
+        pos = 24
+        sections = list()
+        for _ in range(4):
+            length = int.from_bytes(data[pos:pos + 4], 'big')
+            sections.append(data[pos + 4:pos + 4 + length])
+            pos += 4 + length
+        state = json.loads(sections[0].decode('utf-8'))
+        index = list()
+        for offset, first, last, anchor, timed, min_ts, max_ts in INDEX_ENTRY.iter_unpack(sections[3]):
+            entry = BlockIndexEntry(offset, first, last, anchor)
+            if timed:
+                entry.min_timestamp, entry.max_timestamp = min_ts, max_ts
+            index.append(entry)
+        checkpoint = Checkpoint(index_offset, records, state['linking_column'], sections[1], sections[2], index,
+                                state['bindings'], state['histories'])
+        checkpoint.fingerprint = fingerprint
+        return checkpoint
+
+
+def stream_fingerprint(fp: BinaryIO, index_offset: int) -> Tuple[int, int]:
+    """Returns crc32 of the last FINGERPRINT_BYTES of stream before the block index at index_offset (with the bits
+    of its first byte which precede it) and that byte, raises ValueError if the stream is shorter
+    """
+    end = index_offset // 8
+    start = max(0, end - FINGERPRINT_BYTES)
+    fp.seek(start)
+    data = fp.read(end - start)
+    bits = index_offset % 8
+    tail = 0
+    if bits:
+        last = fp.read(1)
+        tail = last[0] & (0xff00 >> bits) & 0xff if last else -1
+    if len(data) != end - start or tail < 0:
+        raise ValueError('stream is shorter than its checkpoint')
+    return zlib.crc32(data + bytes([tail])), tail
+
+
+def save_checkpoint(path: str, checkpoint: Checkpoint) -> None:
+    """Saves the checkpoint of stream at path next to it, replacing the previous one at once.
+    This commits the run which wrote the stream (see open_append)
+    """
+    with open(path, 'rb') as fp:
+        checkpoint.fingerprint, _ = stream_fingerprint(fp, checkpoint.index_offset)
+    temp = path + CHECKPOINT_SUFFIX + '.tmp'
+    with open(temp, 'wb') as fp:
+        fp.write(checkpoint.to_bytes())
+    os.replace(temp, path + CHECKPOINT_SUFFIX)
+
+
+def load_checkpoint(path: str) -> Checkpoint:
+    """Loads the checkpoint of stream at path, raises ValueError if the stream before the block index
+    of checkpoint has changed since it was saved (what follows it is written by the next run)
+    """
+    with open(path + CHECKPOINT_SUFFIX, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        checkpoint = Checkpoint.from_bytes(data)
+    with open(path, 'rb') as fp:
+        try:
+            fingerprint, checkpoint.tail = stream_fingerprint(fp, checkpoint.index_offset)
+        except ValueError:
+            fingerprint = None
+    if fingerprint != checkpoint.fingerprint:
+        raise ValueError('stream %s does not match its checkpoint' % path)
+    return checkpoint
+
+
+def open_append(path: str) -> Tuple[BinaryIO, Optional[Checkpoint]]:
+    """Opens the stream at path for appending with its checkpoint (see Compressor), the block index
+    is cut off and saved again with the appended blocks on close. A missing or empty stream is created
+    and has no checkpoint.
+
+    A run is committed by saving its checkpoint (see save_checkpoint): whatever a run which failed or crashed
+    before that has written after the block index of the last checkpoint is cut off too, so the stream continues
+    from its last committed state. A stream without checkpoint has nothing committed and is started anew
+    """
+    if not os.path.exists(path + CHECKPOINT_SUFFIX):
+        return open(path, 'wb'), None
+    checkpoint = load_checkpoint(path)
+    out = open(path, 'r+b')
+    out.truncate((checkpoint.index_offset + 7) // 8)  # the last bits are kept until their byte is written again
+    out.seek(checkpoint.index_offset // 8)
+    return out, checkpoint
@@ -0,0 +1,122 @@
+import io
+import os
+import tempfile
+import unittest
+
+from checkpoint import Checkpoint, open_append, save_checkpoint, load_checkpoint, CHECKPOINT_SUFFIX
+from compress import Compressor
+from reader import read_records, BlockReader
+from reader_test import make_records
+from utils import flatten
+from writer import LAYOUT_COLUMNS
+
+
+def append(path: str, records: list, **options) -> Compressor:
+    out, checkpoint = open_append(path)
+    with out, Compressor(out, resume=checkpoint, **options) as compressor:
+        compressor.push_many(records)
+    save_checkpoint(path, compressor.checkpoint())
+    return compressor
+
+
+class TestingCheckpoint(unittest.TestCase):
+
+    def test_append(self):
+        records = make_records(400)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stream.bin')
+            self.assertEqual(append(path, records[:150]).count, 150)
+            self.assertEqual(append(path, records[150:151]).count, 151)
+            compressor = append(path, records[151:])
+            self.assertEqual(compressor.count, 400)
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.assertEqual(list(read_records(data)), [flatten(r) for r in records])
+            self.assertEqual(next(iter(BlockReader(io.BytesIO(data)).records_from(151))), flatten(records[151]))
+            self.assertEqual(len(BlockReader(io.BytesIO(data)).read_index()), len(compressor.sink.index))
+
+            # the restored history gives the first appended records references, unlike a new stream
+            cold = Compressor(io.BytesIO())
+            cold.push_many(records[151:])
+            cold.close()
+            self.assertLess(compressor.stat.counter.get('key record', 0), cold.stat.counter['key record'])
+
+    def test_append_columns(self):
+        records = make_records(300)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stream.bin')
+            append(path, records[:120], layout=LAYOUT_COLUMNS)
+            append(path, records[120:], layout=LAYOUT_COLUMNS)
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.assertEqual(list(read_records(data)), [flatten(r) for r in records])
+            self.assertEqual(list(read_records(data, columns=['data.low'])),
+                             [{'data.low': r['data']['low']} for r in records])
+
+    def test_failed_append(self):
+        records = make_records(300)
+
+        def failing(rows: list):
+            yield from rows
+            raise RuntimeError('input failed')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stream.bin')
+            append(path, records[:120])
+            # the failed run closes the stream with its blocks and index, but its checkpoint is not saved
+            with self.assertRaises(RuntimeError):
+                append(path, failing(records[120:200]))
+            # a crashed run leaves a part of block after the block index was cut off
+            out, checkpoint = open_append(path)
+            with out:
+                out.seek(0, os.SEEK_END)
+                out.write(b'\x5a' * 100)
+            compressor = append(path, records[120:])
+            self.assertEqual(compressor.count, 300)
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.assertEqual(list(read_records(data)), [flatten(r) for r in records])
+            self.assertEqual(len(BlockReader(io.BytesIO(data)).read_index()), len(compressor.sink.index))
+
+    def test_failed_first_append(self):
+        records = make_records(100)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stream.bin')
+            # the first run is killed before its checkpoint is saved, so nothing is committed
+            out, checkpoint = open_append(path)
+            with out:
+                out.write(b'\x5a' * 100)
+            self.assertIsNone(checkpoint)
+            append(path, records[:40])
+            self.assertEqual(append(path, records[40:]).count, 100)
+            with open(path, 'rb') as f:
+                self.assertEqual(list(read_records(f.read())), [flatten(r) for r in records])
+
+    def test_mismatch(self):
+        records = make_records(50)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stream.bin')
+            append(path, records)
+            checkpoint = load_checkpoint(path)
+            self.assertEqual(Checkpoint.from_bytes(checkpoint.to_bytes()).records, 50)
+            with self.assertRaises(ValueError):
+                Compressor(io.BytesIO(), linking_column='symbol', resume=checkpoint)
+            with open(path, 'r+b') as f:
+                f.seek(checkpoint.index_offset // 8 - 1)
+                last = f.read(1)[0]
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([last ^ 1]))
+            with self.assertRaises(ValueError):
+                open_append(path)
+            with open(path + CHECKPOINT_SUFFIX, 'r+b') as f:
+                f.seek(10)
+                f.write(b'\xff')
+            with self.assertRaises(ValueError):
+                load_checkpoint(path)
+            out, checkpoint = open_append(os.path.join(tmp, 'new.bin'))
+            out.close()
+            self.assertIsNone(checkpoint)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,45 +1,324 @@
 import argparse
 import json
+from itertools import chain, islice
+from typing import Iterable, BinaryIO, Tuple, Dict, List, Optional
 
-from bitbuffer import BitBufferWriter
+from bitbuffer import BitBufferWriter, Statistics, BACKGROUND_CHUNK_SIZE, FSYNC_NEVER, FSYNC_POLICIES
 from cache import StringCache, SchemaCache
-from datablock import Sink
-from record import Record
-from recordbuffer import RecordBuffer
+from checkpoint import Checkpoint, CHECKPOINT_SUFFIX, open_append, save_checkpoint
+from datablock import Sink, Sinkable, RECORD_MAX_BLOCK_SIZE
+from ingest import Binding, RecordBuilder, load_schema, open_input, parse_lines, read_input
+from record import CompactRecord
+from history import DEFAULT_MAX_SERIES, DEFAULT_MAX_BYTES
+from recordbuffer import RecordBuffer, DEFAULT_SEARCH_DEPTH, MAX_REFERENCE_DISTANCE
 from utils import flatten
-from writer import BlockWriter
+from writer import BlockWriter, LAYOUT_ROWS, LAYOUTS
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Generates sample files (simulates log lines or json files')
-    parser.add_argument('-i', '--in', help='input file with data', required=True)
-    parser.add_argument('-o', '--out', default='stock_data.bin', help='input file with data', required=False)
-    parser.add_argument('-l', '--lines', help='number of lines to read', default=1000, required=False)
+LINKING_COLUMN = 'data.symbol'
 
-    args = vars(parser.parse_args())
-    total_lines = args.get('lines')
-    lines = 10_000_000 if total_lines == 'all' else int(args.get('lines'))
-    index = 0
 
-    with open(args.get('in'), 'r+') as fp, \
-            open(args.get('out'), 'wb') as out:
+class Level:
+    """Knobs which trade CPU for ratio: records of series searched for reference, passes of delta search
+    (the second one finds references for deltas, i.e. delta of delta), records buffered by every pass
+    (only they can be referenced) and records per block
+    """
+
+    def __init__(self, depth: int, passes: int, buffer_size: int, block_size: int):
+        if passes not in (1, 2):
+            raise ValueError('1 or 2 passes of delta search are supported, got %s' % passes)
+        self.depth = depth
+        self.passes = passes
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+
+    def __repr__(self):
+        return f'depth={self.depth}, passes={self.passes}, buffer={self.buffer_size}, block={self.block_size}'
+
+
+LEVELS = {
+    'fast': Level(depth=1, passes=1, buffer_size=100, block_size=RECORD_MAX_BLOCK_SIZE),
+    'default': Level(depth=DEFAULT_SEARCH_DEPTH, passes=2, buffer_size=100, block_size=RECORD_MAX_BLOCK_SIZE),
+    'max': Level(depth=MAX_REFERENCE_DISTANCE, passes=2, buffer_size=MAX_REFERENCE_DISTANCE, block_size=1000),
+}
+DEFAULT_LEVEL = 'default'
+
+
+def make_buffers(sink: Sinkable, string_cache: StringCache, schema_cache: SchemaCache,
+                 level: str = DEFAULT_LEVEL, max_chain: Optional[int] = None,
+                 key_interval: Optional[int] = None, max_series: int = DEFAULT_MAX_SERIES,
+                 ttl: Optional[int] = None, history_bytes: int = DEFAULT_MAX_BYTES) -> RecordBuffer:
+    """Chains the delta search passes of level in front of sink, returns the first one.
+    max_chain and key_interval bound the references to decode for a record (see RecordBuffer),
+    max_series, ttl and history_bytes bound the series histories of every pass (see HistoryStore)
+    """
+    knobs = LEVELS[level]
+    for iteration in reversed(range(knobs.passes)):
+        sink = RecordBuffer(sink=sink, string_cache=string_cache, schema_cache=schema_cache, iteration=iteration,
+                            max_size=knobs.buffer_size, depth=knobs.depth, max_series=max_series, ttl=ttl,
+                            max_chain=max_chain, key_interval=key_interval, history_bytes=history_bytes)
+    return sink
+
+
+def compress_lines(lines: Iterable[str], out: BinaryIO, linking_column: str = LINKING_COLUMN,
+                   schema: Optional[Dict[str, str]] = None, profile: bool = False,
+                   background: bool = False, level: str = DEFAULT_LEVEL, max_chain: Optional[int] = None,
+                   key_interval: Optional[int] = None, layout: str = LAYOUT_ROWS,
+                   max_series: int = DEFAULT_MAX_SERIES, ttl: Optional[int] = None,
+                   history_bytes: int = DEFAULT_MAX_BYTES) -> Tuple[int, Statistics]:
+    """Compresses json lines (up to the first empty one) into out,
+    returns the number of compressed records and collected statistics
+    """
+    return compress_records(chain.from_iterable(parse_lines(lines)), out, linking_column, schema, profile,
+                            background, level=level, max_chain=max_chain, key_interval=key_interval, layout=layout,
+                            max_series=max_series, ttl=ttl, history_bytes=history_bytes)
+
+
+def compress_records(records: Iterable[dict], out: BinaryIO, linking_column: str = LINKING_COLUMN,
+                     schema: Optional[Dict[str, str]] = None, profile: bool = False, background: bool = False,
+                     buffer_size: int = BACKGROUND_CHUNK_SIZE, fsync: str = FSYNC_NEVER,
+                     level: str = DEFAULT_LEVEL, max_chain: Optional[int] = None,
+                     key_interval: Optional[int] = None, layout: str = LAYOUT_ROWS,
+                     max_series: int = DEFAULT_MAX_SERIES, ttl: Optional[int] = None,
+                     history_bytes: int = DEFAULT_MAX_BYTES) -> Tuple[int, Statistics]:
+    """Compresses flat records into out, returns the number of compressed records and collected statistics.
+    The column types are taken from schema (see ingest.load_schema) or learned per record shape,
+    with profile the statistics have the bits and encoding time of every column.
+    With background, the chunks of buffer_size bytes are written to out by a separate thread.
+    The level (see LEVELS) sets how hard the references are searched for, max_chain limits the references
+    to follow for decoding a record and key_interval the records of a series between key records.
+    The layout (see LAYOUTS) sets whether the values of block are saved record by record or column by column.
+    Every pass of delta search keeps the histories of at most max_series series in about history_bytes of memory,
+    with ttl a series not seen for ttl records is forgotten
+    """
+    with Compressor(out, linking_column, schema, level, profile, background, buffer_size, fsync, max_chain,
+                    key_interval, layout=layout, max_series=max_series, ttl=ttl,
+                    history_bytes=history_bytes) as compressor:
+        compressor.push_many(records)
+    return compressor.count, compressor.stat
+
+
+class Compressor:
+    """Streaming compressor of records into out, which is ready after construction and accepts records
+    one by one or in batches until it is closed (or the `with` block ends). The arguments are the same as
+    of compress_records.
+
+    With resume (see checkpoint.open_append) the compressor continues the stream which the checkpoint was taken
+    from: out is positioned at the block index of stream, the records are numbered on and can refer to the last
+    records of their series before the restart
+    """
+
+    def __init__(self, out: BinaryIO, linking_column: str = LINKING_COLUMN, schema: Optional[Dict[str, str]] = None,
+                 level: str = DEFAULT_LEVEL, profile: bool = False, background: bool = False,
+                 buffer_size: int = BACKGROUND_CHUNK_SIZE, fsync: str = FSYNC_NEVER, max_chain: Optional[int] = None,
+                 key_interval: Optional[int] = None, resume: Optional[Checkpoint] = None, layout: str = LAYOUT_ROWS,
+                 max_series: int = DEFAULT_MAX_SERIES, ttl: Optional[int] = None,
+                 history_bytes: int = DEFAULT_MAX_BYTES):
+        if level not in LEVELS:
+            raise ValueError('unknown level %s, expected one of %s' % (level, ', '.join(LEVELS)))
+        if resume is not None and resume.linking_column != linking_column:
+            raise ValueError('stream is linked by %s, not %s' % (resume.linking_column, linking_column))
         string_cache = StringCache()
         schema_cache = SchemaCache()
-        bitbuffer = BitBufferWriter(out)
-        bw = BlockWriter(bit_buffer=bitbuffer)
-        sink = Sink(block_writer=bw, string_cache=string_cache, schema_cache=schema_cache)
-        buf_2 = RecordBuffer(sink=sink, string_cache=string_cache, schema_cache=schema_cache, iteration=1, max_size=100)
-        buf_1 = RecordBuffer(sink=buf_2, string_cache=string_cache, schema_cache=schema_cache, iteration=0, max_size=100)
-
-        line = fp.readline()
-        while line.strip() and lines > index:
-            json_line = json.loads(line)
-
-            record = Record(index, linking_column='data.symbol')
-            flat_record = flatten(json_line)
-            record.from_dict(flat_record)
-            buf_1.index_string_values(record)
-            buf_1.add(record)
-
-            index += 1
-            line = fp.readline()
-        bitbuffer.stat.show()
\ No newline at end of file
+        if background:
+            self.bitbuffer = BitBufferWriter(out, size=buffer_size, background=True, fsync=fsync)
+        else:
+            self.bitbuffer = BitBufferWriter(out, fsync=fsync)
+        block_writer = BlockWriter(bit_buffer=self.bitbuffer, profile=profile)
+        if resume is None:
+            block_writer.save_meta({'linking_column': linking_column})
+        else:
+            self.bitbuffer.resume(resume.index_offset, resume.tail)
+            block_writer.linked = linking_column is not None
+        self.sink = Sink(block_writer=block_writer, string_cache=string_cache, schema_cache=schema_cache,
+                         block_size=LEVELS[level].block_size, layout=layout)
+        self.buffer = make_buffers(self.sink, string_cache, schema_cache, level, max_chain, key_interval, max_series,
+                                   ttl, history_bytes)
+        self.linking_column = linking_column
+        self.builder = RecordBuilder(linking_column, schema)
+        self.count = 0  # number of pushed records, the rec_id of the next one
+        self.closed = False
+        self._last_records: List[List[Tuple[CompactRecord, int]]] = list()  # per pass, taken on close
+        if resume is not None:
+            self._resume(resume)
+
+    def _passes(self) -> List[RecordBuffer]:
+        ret = list()
+        buf = self.buffer
+        while isinstance(buf, RecordBuffer):
+            ret.append(buf)
+            buf = buf.sink
+        return ret
+
+    def _resume(self, checkpoint: Checkpoint) -> None:
+        string_cache = self.sink.string_cache
+        schema_cache = self.sink.schema_cache
+        string_cache.append_from_bytes(checkpoint.strings)
+        if checkpoint.schemas:
+            schema_cache.append_from_bytes(checkpoint.schemas)
+        for schema_hash, schema in schema_cache.schemas.items():
+            names, types = zip(*[col.rsplit(':', 1) for col in schema])
+            schema_cache.register(schema_hash, list(names), list(types))
+        self.sink.restore_index(checkpoint.index)
+        self.count = checkpoint.records
+        if self.builder.schema is None:  # the shapes are typed as before the restart
+            for schema in checkpoint.bindings:
+                names, types = zip(*[col.rsplit(':', 1) for col in schema])
+                self.builder.bindings[names] = Binding(list(names), list(types))
+        for buf, records in zip(self._passes(), checkpoint.histories):
+            for rec_id, schema_hash, first_ref, second_ref, depth, since_key, linking_value, timestamp, values \
+                    in records:
+                types = schema_cache.types_of(schema_hash)
+                if types is not None:
+                    buf.restore(CompactRecord(rec_id, schema_hash, types, tuple(values), linking_value, timestamp,
+                                              first_ref, second_ref, depth), since_key)
+
+    def push(self, record: dict) -> int:
+        """Adds a record, nested like json lines or flat (see utils.flatten), returns its rec_id
+        """
+        if self.closed:
+            raise ValueError('compressor is closed')
+        rec = self.builder.build(self.count, flatten(record))
+        self.buffer.index_string_values(rec)
+        self.buffer.add(rec)
+        self.count += 1
+        return self.count - 1
+
+    def push_many(self, records: Iterable[dict]) -> int:
+        """Adds records in order, returns the number of added ones
+        """
+        first = self.count
+        for record in records:
+            self.push(record)
+        return self.count - first
+
+    def flush(self) -> None:
+        """Ends the block with all pushed records and hands its whole bytes over to out (up to 7 bits wait
+        for the next block). The following records do not refer to the flushed ones, so frequent flushes
+        lower the ratio
+        """
+        if self.closed:
+            raise ValueError('compressor is closed')
+        self.buffer.flush()
+        self.bitbuffer.flush()
+
+    def close(self) -> None:
+        """Writes all pushed records, the block index and flushes the output, more calls do nothing
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._last_records = [buf.last_records() for buf in self._passes()]
+        for buf in self._passes():  # before the buffers are drained
+            self.stat.count_history('history pass %s' % buf.iteration, buf.history.counters())
+        self.buffer.close()
+        self.bitbuffer.close()
+
+    def checkpoint(self) -> Checkpoint:
+        """Returns the state of closed compressor which the next run continues the stream with
+        (see checkpoint.save_checkpoint)
+        """
+        if not self.closed:
+            raise ValueError('checkpoint is taken after close')
+        schema_cache = self.sink.schema_cache
+        histories = [[[rec.rec_id, rec.schema_hash, rec.first_ref, rec.second_ref, rec.depth, since_key,
+                       rec.linking_value, rec.timestamp, list(rec.values)]
+                      for rec, since_key in records if rec.schema_hash in schema_cache.schemas]
+                     for records in self._last_records]
+        bindings = [[name + ':' + col_type for name, col_type, _ in binding.columns]
+                    for binding in self.builder.bindings.values() if binding is not None]
+        return Checkpoint(self.sink.block_writer.index_offset, self.count, self.linking_column,
+                          self.sink.string_cache.to_bytes(), schema_cache.to_bytes(), self.sink.index, bindings,
+                          histories)
+
+    @property
+    def stat(self) -> Statistics:
+        return self.bitbuffer.stat
+
+    def __enter__(self) -> 'Compressor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compresses json lines (plain, gzip, xz or zstd) into block stream')
+    parser.add_argument('-i', '--in', default='-', help='input file with data, "-" for stdin', required=False)
+    parser.add_argument('-o', '--out', default='stock_data.bin', help='output file', required=False)
+    parser.add_argument('-l', '--lines', help='number of lines to read, all by default', type=int, default=None,
+                        required=False)
+    parser.add_argument('-w', '--workers', help='number of processes, records are sharded by linking column',
+                        type=int, default=1, required=False)
+    parser.add_argument('-s', '--schema', help='json schema of records (like data/stock_schema.json), '
+                                               'by default column types are learned from the first records',
+                        required=False)
+    parser.add_argument('-b', '--buffer-size', help='bytes of output chunk, written by a background thread',
+                        type=int, default=BACKGROUND_CHUNK_SIZE, required=False)
+    parser.add_argument('-f', '--fsync', help='when output is synced to disk', choices=FSYNC_POLICIES,
+                        default=FSYNC_NEVER, required=False)
+    parser.add_argument('-z', '--level', help='compression level: %s' % ', '.join(
+        '%s (%s)' % (name, knobs) for name, knobs in LEVELS.items()), choices=LEVELS, default=DEFAULT_LEVEL,
+                        required=False)
+    parser.add_argument('-m', '--metrics', help='json file for metrics, enables accounting of bits and time '
+                                                'per column', required=False)
+    parser.add_argument('-c', '--max-chain', help='longest chain of references to decode a record', type=int,
+                        required=False)
+    parser.add_argument('-k', '--key-interval', help='most records of a series from one key record to the next',
+                        type=int, required=False)
+    parser.add_argument('-F', '--frame-size', help='records per checksummed standalone frame (see frames.py), '
+                                                   'frames are decoded in parallel', type=int, required=False)
+    parser.add_argument('-a', '--append', help='continue the output from its checkpoint (saved next to it as '
+                                               '%s), the checkpoint is saved on close' % CHECKPOINT_SUFFIX,
+                        action='store_true', required=False)
+    parser.add_argument('-L', '--layout', help='layout of blocks: values saved record by record (rows) or as '
+                                               'a stream per column (columns)', choices=LAYOUTS,
+                        default=LAYOUT_ROWS, required=False)
+    parser.add_argument('-S', '--max-series', help='most series kept for delta search by every pass',
+                        type=int, default=DEFAULT_MAX_SERIES, required=False)
+    parser.add_argument('-T', '--ttl', help='records after which a series without new records is forgotten',
+                        type=int, required=False)
+    parser.add_argument('-H', '--history-bytes', help='approximate memory of series kept by every pass',
+                        type=int, default=DEFAULT_MAX_BYTES, required=False)
+
+    args = vars(parser.parse_args())
+    if args.get('append') and (args.get('workers') > 1 or args.get('frame_size')):
+        parser.error('only a single stream can be appended to')
+    schema = load_schema(args.get('schema')) if args.get('schema') else None
+    profile = args.get('metrics') is not None
+    bounds = dict(max_chain=args.get('max_chain'), key_interval=args.get('key_interval'), layout=args.get('layout'),
+                  max_series=args.get('max_series'), ttl=args.get('ttl'), history_bytes=args.get('history_bytes'))
+
+    with open_input(args.get('in')) as fp:
+        lines = islice(fp, args.get('lines'))
+        if args.get('workers') > 1:
+            from parallel import compress_parallel
+
+            _, stat = compress_parallel(lines, args.get('out'), workers=args.get('workers'), schema=schema,
+                                        profile=profile, level=args.get('level'), **bounds)
+        elif args.get('append'):
+            try:
+                out, checkpoint = open_append(args.get('out'))
+            except ValueError as e:
+                parser.error(str(e))
+            with out:
+                with Compressor(out, schema=schema, level=args.get('level'), profile=profile, background=True,
+                                buffer_size=args.get('buffer_size'), fsync=args.get('fsync'), resume=checkpoint,
+                                **bounds) as compressor:
+                    compressor.push_many(read_input(lines))
+            save_checkpoint(args.get('out'), compressor.checkpoint())
+            stat = compressor.stat
+        elif args.get('frame_size'):
+            from frames import compress_framed
+
+            with open(args.get('out'), 'wb') as out:
+                _, stat = compress_framed(read_input(lines), out, args.get('frame_size'), schema=schema,
+                                          profile=profile, level=args.get('level'), **bounds)
+        else:
+            with open(args.get('out'), 'wb') as out:
+                _, stat = compress_records(read_input(lines), out, schema=schema, profile=profile, background=True,
+                                           buffer_size=args.get('buffer_size'), fsync=args.get('fsync'),
+                                           level=args.get('level'), **bounds)
+        stat.show()
+    if profile:
+        with open(args.get('metrics'), 'w') as fp:
+            json.dump(stat.snapshot(), fp, indent=2, sort_keys=True)
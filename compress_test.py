@@ -0,0 +1,124 @@
+import io
+import json
+import unittest
+
+from compress import compress_lines, LEVELS, make_buffers, Compressor
+from cache import StringCache, SchemaCache
+from datablock import DummySink, Sinkable
+from ingest import RecordBuilder
+from reader import read_records
+from reader_test import make_records
+from utils import flatten
+
+
+class ListSink(Sinkable):
+
+    def __init__(self):
+        self.records = list()
+
+    def add(self, data: any) -> None:
+        self.records.append(data)
+
+    def close(self):
+        pass
+
+
+class TestingCompress(unittest.TestCase):
+
+    def test_levels(self):
+        records = make_records(400)
+        lines = [json.dumps(r) + '\n' for r in records]
+        sizes = dict()
+        for level in LEVELS:
+            out = io.BytesIO()
+            count, _ = compress_lines(lines, out, level=level)
+            self.assertEqual(count, 400)
+            sizes[level] = len(out.getvalue())
+            self.assertEqual(list(read_records(out.getvalue())), [flatten(r) for r in records], level)
+        self.assertLess(sizes['default'], sizes['fast'])
+        self.assertLessEqual(sizes['max'], sizes['default'])
+        with self.assertRaises(ValueError):
+            compress_lines(lines, io.BytesIO(), level='ultra')
+
+    def test_passes(self):
+        fast = make_buffers(DummySink(), StringCache(), SchemaCache(), 'fast')
+        self.assertIsInstance(fast.sink, DummySink)
+        self.assertEqual(fast.history.depth, 1)
+        default = make_buffers(DummySink(), StringCache(), SchemaCache())
+        self.assertEqual(default.sink.iteration, 1)
+        self.assertIsInstance(default.sink.sink, DummySink)
+
+
+    def test_compressor(self):
+        records = make_records(250)
+        out = io.BytesIO()
+        with Compressor(out) as compressor:
+            self.assertEqual(compressor.push(records[0]), 0)
+            compressor.push(flatten(records[1]))
+            self.assertEqual(compressor.push_many(records[2:120]), 118)
+            compressor.flush()
+            flushed = len(out.getvalue())
+            self.assertGreater(flushed, 0)
+            blocks = compressor.stat.counter['block header']
+            compressor.flush()  # nothing to flush
+            self.assertEqual(compressor.stat.counter['block header'], blocks)
+            compressor.push_many(records[120:])
+        self.assertTrue(compressor.closed)
+        compressor.close()
+        with self.assertRaises(ValueError):
+            compressor.push(records[0])
+        self.assertEqual(list(read_records(out.getvalue())), [flatten(r) for r in records])
+
+        whole = io.BytesIO()
+        compress_lines([json.dumps(r) + '\n' for r in records], whole)
+        self.assertLess(len(whole.getvalue()), len(out.getvalue()))  # the flush cut off references
+    def test_history_limits(self):
+        records = make_records(300)
+        for i, r in enumerate(records):
+            r['data']['symbol'] = 'S%s' % (i % 150)
+        out = io.BytesIO()
+        with Compressor(out, max_series=20, ttl=100, history_bytes=1 << 20) as compressor:
+            compressor.push_many(records)
+        self.assertEqual(list(read_records(out.getvalue())), [flatten(r) for r in records])
+        counters = compressor.stat.history['history pass 0']
+        self.assertLessEqual(counters['series'], 20)
+        self.assertGreater(counters['evictions'], 0)
+        self.assertEqual(counters['hits'] + counters['misses'], 300)
+        self.assertIn('history pass 1', compressor.stat.snapshot()['history'])
+        self.assertEqual(compressor.buffer.history.max_series, 20)
+        self.assertEqual(compressor.buffer.sink.history.ttl, 100)
+
+    def test_bounded_chains(self):
+        records = make_records(400)
+        sink = ListSink()
+        buf = make_buffers(sink, StringCache(), SchemaCache(), max_chain=2, key_interval=4)
+        builder = RecordBuilder('data.symbol')
+        for i, r in enumerate(records):
+            rec = builder.build(i, flatten(r))
+            buf.index_string_values(rec)
+            buf.add(rec)
+        buf.close()
+        depths = dict()
+        since_key = dict()
+        for rec in sink.records:
+            depths[rec.rec_id] = max([depths[rec.rec_id + ref] + 1 for ref in (rec.first_ref, rec.second_ref) if ref],
+                                     default=0)
+            self.assertEqual(depths[rec.rec_id], rec.depth)
+            self.assertLessEqual(rec.depth, 2)
+            series = rec.get_linking_column_value()
+            since_key[series] = 1 if rec.depth == 0 else since_key[series] + 1
+            self.assertLessEqual(since_key[series], 4)
+        self.assertTrue(any(rec.second_ref for rec in sink.records))
+
+        lines = [json.dumps(r) + '\n' for r in records]
+        bounded, unbounded = io.BytesIO(), io.BytesIO()
+        compress_lines(lines, bounded, max_chain=2, key_interval=4)
+        compress_lines(lines, unbounded)
+        self.assertEqual(list(read_records(bounded.getvalue())), [flatten(r) for r in records])
+        self.assertGreater(len(bounded.getvalue()), len(unbounded.getvalue()))
+        with self.assertRaises(ValueError):
+            make_buffers(ListSink(), StringCache(), SchemaCache(), key_interval=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,33 @@
-from typing import List
+from bisect import bisect_right
+from typing import List, Optional
 
 from cache import StringCache, SchemaCache
-from record import Record
-from writer import BlockWriter
+from record import CompactRecord
+from writer import BlockWriter, KEY_RECORD_BLOCK, LAYOUT_ROWS, LAYOUT_COLUMNS, LAYOUTS
 from abc import ABC, abstractmethod
 
 RECORD_MAX_BLOCK_SIZE = 100
 
 
+class BlockIndexEntry:
+    """Describes one flushed block: where it starts in the stream, which records and time range it holds
+    and the first block the decoding has to start from to resolve all references of this block
+    """
+
+    def __init__(self, bit_offset: int, first_rec_id: int, last_rec_id: int, anchor: int,
+                 min_timestamp: Optional[int] = None, max_timestamp: Optional[int] = None):
+        self.bit_offset = bit_offset
+        self.first_rec_id = first_rec_id
+        self.last_rec_id = last_rec_id
+        self.anchor = anchor  # number of block
+        self.min_timestamp = min_timestamp
+        self.max_timestamp = max_timestamp
+
+    def __repr__(self):
+        return f'@{self.bit_offset}:[{self.first_rec_id}..{self.last_rec_id}] ' \
+               f'ts=[{self.min_timestamp}..{self.max_timestamp}] anchor={self.anchor}'
+
+
 class Sinkable(ABC):
 
     @abstractmethod
@@ -18,6 +38,11 @@ class Sinkable(ABC):
     def close(self):
         pass
 
+    def flush(self) -> None:
+        """Pushes everything accepted so far down the chain, without closing it
+        """
+        pass
+
 
 class DummySink(Sinkable):
 
@@ -37,25 +62,80 @@ class DummySink(Sinkable):
 
 class Sink(Sinkable):
 
-    def __init__(self, block_writer: BlockWriter, string_cache: StringCache, schema_cache: SchemaCache):
+    def __init__(self, block_writer: BlockWriter, string_cache: StringCache, schema_cache: SchemaCache,
+                 block_size: int = RECORD_MAX_BLOCK_SIZE, layout: str = LAYOUT_ROWS):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown layout %s, expected one of %s' % (layout, ', '.join(LAYOUTS)))
         self.block_writer = block_writer
+        self.layout = layout
         self.string_cache = string_cache
         self.schema_cache = schema_cache
-        self.block: List[Record] = list()
+        self.block_size = block_size
+        self.block: List[CompactRecord] = list()
+        self.index: List[BlockIndexEntry] = list()
+        self.first_rec_ids: List[int] = list()  # first record of every indexed block, for bisecting
+
+    def restore_index(self, index: List[BlockIndexEntry]) -> None:
+        """Continues the index of the blocks saved by a previous run, so the anchors of new blocks
+        can point to them
+        """
+        self.index = list(index)
+        self.first_rec_ids = [entry.first_rec_id for entry in self.index]
+
+    def _block_of(self, rec_id: int) -> int:
+        return bisect_right(self.first_rec_ids, rec_id) - 1 if rec_id < self.block[0].rec_id else len(self.index)
+
+    def _index_block(self, bit_offset: int) -> None:
+        number = len(self.index)
+        lowest = number
+        timestamps = list()
+        for r in self.block:
+            for ref in (r.first_ref, r.second_ref):
+                if ref:
+                    lowest = min(lowest, self._block_of(r.rec_id + ref))
+            if r.timestamp is not None:
+                timestamps.append(r.timestamp)
+        # every block between the referenced one and this one is decoded too, so they add their anchors
+        anchor = min([number] + [self.index[i].anchor for i in range(lowest, number)])
+        entry = BlockIndexEntry(bit_offset, self.block[0].rec_id, self.block[-1].rec_id, anchor)
+        if timestamps:
+            entry.min_timestamp, entry.max_timestamp = min(timestamps), max(timestamps)
+        self.index.append(entry)
+        self.first_rec_ids.append(entry.first_rec_id)
 
     def _dump(self):
+        bit_offset = self.block_writer.buf.position
+        if self.block:
+            self._index_block(bit_offset)
         unsaved_cache = self.string_cache.unsaved_to_bytes()
         self.block_writer.save_string_cache(unsaved_cache)
         unsaved_schema = self.schema_cache.unsaved_to_bytes()
         self.block_writer.save_schema(unsaved_schema)
+        if self.block and self.layout == LAYOUT_COLUMNS:
+            self.block_writer.save_columnar_block(self.block, self.schema_cache, self.string_cache.index)
+            return
+        if self.block:
+            self.block_writer.start_block(self.string_cache.index)
         for r in self.block:
-            self.block_writer.save_record(r)
+            self.block_writer.save_record(r, self.schema_cache.ids.get(r.schema_hash))
 
-    def add(self, r: Record):
+    def add(self, r: CompactRecord):
+        if r.signature == KEY_RECORD_BLOCK and r.schema_hash not in self.schema_cache.schemas:
+            self.schema_cache.add(r.schema_hash, self.schema_cache.schema_of(r.schema_hash))  # saved with the block
         self.block.append(r)
-        if len(self.block) > RECORD_MAX_BLOCK_SIZE:
+        if len(self.block) > self.block_size:
+            self._dump()
+            self.block.clear()
+
+    def flush(self) -> None:
+        """Ends the current block, the next record starts a new one
+        """
+        if self.block:
             self._dump()
             self.block.clear()
 
     def close(self):
         self._dump()
+        self.block.clear()
+        self.block_writer.report_columns(self.schema_cache)
+        self.block_writer.save_index(self.index)
@@ -0,0 +1,190 @@
+import io
+import mmap
+import multiprocessing as mp
+import zlib
+from typing import Iterable, Iterator, BinaryIO, List, Optional, Tuple, Dict
+
+from bitbuffer import Statistics
+from compress import Compressor, LINKING_COLUMN, DEFAULT_LEVEL
+from history import DEFAULT_MAX_SERIES, DEFAULT_MAX_BYTES
+from reader import read_records
+from writer import LAYOUT_ROWS
+
+FRAME_MAGIC = b'TSFR'  # [magic (4 bytes)|payload length (4 bytes)|records (4 bytes)|payload crc32 (4 bytes)|
+FRAME_HEADER_SIZE = 20  # header crc32 (4 bytes)|payload], the payload is a standalone block stream
+DEFAULT_FRAME_SIZE = 10000  # records per frame
+ERRORS_RAISE = 'raise'
+ERRORS_SKIP = 'skip'
+
+
+class FrameError(ValueError):
+    pass
+
+
+class Frame:
+    """Frame of container: its number, offset, number of records and the payload (None if it is corrupt)
+    """
+
+    def __init__(self, number: int, offset: int, records: int, payload: Optional[bytes], error: str = None):
+        self.number = number
+        self.offset = offset
+        self.records = records
+        self.payload = payload
+        self.error = error
+
+    def __repr__(self):
+        return f'frame {self.number} @{self.offset}: {self.records} records' + (f', {self.error}' if self.error else '')
+
+
+def frame_header(payload: bytes, records: int) -> bytes:
+    header = FRAME_MAGIC + len(payload).to_bytes(4, 'big') + records.to_bytes(4, 'big') + \
+        zlib.crc32(payload).to_bytes(4, 'big')
+    return header + zlib.crc32(header).to_bytes(4, 'big')
+
+
+class FrameWriter:
+    """Compresses records into frames of frame_size records, every frame is a complete block stream
+    with own dictionaries, schemas and references (see Compressor), so it is decoded without the others.
+    The frames cost some ratio: a frame starts with empty caches and no records to refer to
+    """
+
+    def __init__(self, out: BinaryIO, frame_size: int = DEFAULT_FRAME_SIZE, linking_column: str = LINKING_COLUMN,
+                 schema: Optional[Dict[str, str]] = None, level: str = DEFAULT_LEVEL, profile: bool = False,
+                 max_chain: Optional[int] = None, key_interval: Optional[int] = None, layout: str = LAYOUT_ROWS,
+                 max_series: int = DEFAULT_MAX_SERIES, ttl: Optional[int] = None,
+                 history_bytes: int = DEFAULT_MAX_BYTES):
+        if frame_size < 1:
+            raise ValueError('frame has to hold at least one record, got %s' % frame_size)
+        self.out = out
+        self.frame_size = frame_size
+        self.options = dict(linking_column=linking_column, schema=schema, level=level, profile=profile,
+                            max_chain=max_chain, key_interval=key_interval, layout=layout, max_series=max_series,
+                            ttl=ttl, history_bytes=history_bytes)
+        self.stat = Statistics()
+        self.count = 0
+        self.frames = 0
+        self.closed = False
+        self._payload: Optional[io.BytesIO] = None
+        self._compressor: Optional[Compressor] = None
+
+    def push(self, record: dict) -> int:
+        """Adds a record (see Compressor.push), returns its number in the container
+        """
+        if self.closed:
+            raise ValueError('frame writer is closed')
+        if self._compressor is None:
+            self._payload = io.BytesIO()
+            self._compressor = Compressor(self._payload, **self.options)
+        self._compressor.push(record)
+        self.count += 1
+        if self._compressor.count >= self.frame_size:
+            self.flush()
+        return self.count - 1
+
+    def push_many(self, records: Iterable[dict]) -> int:
+        first = self.count
+        for record in records:
+            self.push(record)
+        return self.count - first
+
+    def flush(self) -> None:
+        """Writes the pushed records as a frame, the next record starts a new one
+        """
+        if self._compressor is None:
+            return
+        self._compressor.close()
+        self.stat.merge(self._compressor.stat)
+        payload = self._payload.getvalue()
+        self.out.write(frame_header(payload, self._compressor.count))
+        self.out.write(payload)
+        self.frames += 1
+        self._compressor = None
+        self._payload = None
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+
+    def __enter__(self) -> 'FrameWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def compress_framed(records: Iterable[dict], out: BinaryIO, frame_size: int = DEFAULT_FRAME_SIZE,
+                    **options) -> Tuple[int, Statistics]:
+    """Compresses records into frames (options are the same as of FrameWriter), returns the number
+    of records and statistics
+    """
+    with FrameWriter(out, frame_size, **options) as writer:
+        writer.push_many(records)
+    return writer.count, writer.stat
+
+
+def iter_frames(data: any) -> Iterator[Frame]:
+    """Walks the frames of container (bytes or a file, which is memory-mapped). A frame with wrong payload crc
+    is returned without payload, after a corrupt header the walk resumes at the next frame magic
+    """
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    elif not isinstance(data, (bytes, bytearray, mmap.mmap)):
+        data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    size = len(view)
+    offset = 0
+    number = 0
+    while offset + FRAME_HEADER_SIZE <= size:
+        header = bytes(view[offset:offset + FRAME_HEADER_SIZE])
+        length = int.from_bytes(header[4:8], 'big')
+        if header[:4] != FRAME_MAGIC or zlib.crc32(header[:16]) != int.from_bytes(header[16:20], 'big') or \
+                offset + FRAME_HEADER_SIZE + length > size:
+            yield Frame(number, offset, 0, None, 'corrupt header')
+            number += 1
+            offset = data.find(FRAME_MAGIC, offset + 1)
+            if offset < 0:
+                return
+            continue
+        start = offset + FRAME_HEADER_SIZE
+        payload = bytes(view[start:start + length])
+        records = int.from_bytes(header[8:12], 'big')
+        if zlib.crc32(payload) != int.from_bytes(header[12:16], 'big'):
+            yield Frame(number, offset, records, None, 'payload crc mismatch')
+        else:
+            yield Frame(number, offset, records, payload)
+        number += 1
+        offset = start + length
+
+
+def decode_frame(payload: bytes) -> List[dict]:
+    return list(read_records(payload))
+
+
+def read_frames(data: any, workers: int = 1, errors: str = ERRORS_RAISE,
+                corrupt: Optional[List[Frame]] = None) -> Iterator[dict]:
+    """Yields the records of container in order, the frames are decoded by a pool of workers processes
+    (in this process with 1 worker). A corrupt frame raises FrameError, or with errors='skip' only its
+    records are lost and the frame is appended to corrupt
+    """
+    if errors not in (ERRORS_RAISE, ERRORS_SKIP):
+        raise ValueError('unknown errors policy %s' % errors)
+
+    def payloads() -> Iterator[bytes]:
+        for frame in iter_frames(data):
+            if frame.payload is None:
+                if errors == ERRORS_RAISE:
+                    raise FrameError(repr(frame))
+                if corrupt is not None:
+                    corrupt.append(frame)
+                continue
+            yield frame.payload
+
+    if workers <= 1:
+        for payload in payloads():
+            yield from read_records(payload)
+        return
+    with mp.Pool(workers) as pool:
+        for records in pool.imap(decode_frame, payloads()):
+            yield from records
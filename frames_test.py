@@ -0,0 +1,55 @@
+import io
+import os
+import tempfile
+import unittest
+
+from frames import compress_framed, iter_frames, read_frames, FrameWriter, FrameError, FRAME_HEADER_SIZE, \
+    ERRORS_SKIP
+from reader import read_records
+from reader_test import make_records
+from utils import flatten
+
+
+class TestingFrames(unittest.TestCase):
+
+    def test_frames_are_standalone(self):
+        records = make_records(250)
+        out = io.BytesIO()
+        count, stat = compress_framed(records, out, frame_size=100)
+        self.assertEqual(count, 250)
+        self.assertEqual(stat.counter['meta block'], 3)
+        frames = list(iter_frames(out.getvalue()))
+        self.assertEqual([f.records for f in frames], [100, 100, 50])
+        # every frame is a complete stream
+        self.assertEqual(list(read_records(frames[1].payload)), [flatten(r) for r in records[100:200]])
+        self.assertEqual(list(read_frames(out.getvalue())), [flatten(r) for r in records])
+
+    def test_parallel_read(self):
+        records = make_records(300)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'framed.bin')
+            with open(path, 'wb') as f, FrameWriter(f, frame_size=70) as writer:
+                writer.push_many(records[:10])
+                writer.flush()
+                writer.push_many(records[10:])
+            with open(path, 'rb') as f:
+                self.assertEqual(list(read_frames(f, workers=2)), [flatten(r) for r in records])
+
+    def test_corrupt_frames(self):
+        records = make_records(300)
+        out = io.BytesIO()
+        compress_framed(records, out, frame_size=100)
+        frames = list(iter_frames(out.getvalue()))
+        data = bytearray(out.getvalue())
+        data[frames[0].offset + FRAME_HEADER_SIZE + 30] ^= 0x10  # payload of the first frame
+        data[frames[1].offset + 5] ^= 0x01  # length of the second frame
+        with self.assertRaises(FrameError):
+            list(read_frames(bytes(data)))
+        corrupt = list()
+        restored = list(read_frames(bytes(data), errors=ERRORS_SKIP, corrupt=corrupt))
+        self.assertEqual(restored, [flatten(r) for r in records[200:]])
+        self.assertEqual([(f.number, f.error) for f in corrupt], [(0, 'payload crc mismatch'), (1, 'corrupt header')])
+
+
+if __name__ == '__main__':
+    unittest.main()
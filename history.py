@@ -0,0 +1,306 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Iterator
+
+import numpy as np
+
+from record import CompactRecord
+from utils import TIMESTAMP_BITS
+from writer import MAX_ARRAY_LENGTH, STRING_TYPES
+
+INT_COSTS = {  # col_type => (limit of value in wide branch, bits within the limit, bits above the limit)
+    'int32': (1 << 31, 34, 98),  # same as int32_est
+    'date': (1 << 62, 18, 18),  # same as int16_est
+}
+INITIAL_CAPACITY = 4
+DEFAULT_MAX_SERIES = 100000
+DEFAULT_MAX_BYTES = 64 << 20  # per pass of delta search
+SERIES_BYTES = 2048  # approximate memory of a series history besides the data of its rings (measured)
+HALF = np.uint64(32)
+LOW_HALF = np.uint64(0xffffffff)
+ONE = np.uint64(1)
+NO_MATCH = np.iinfo(np.int64).max
+
+Packed = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class VectorLayout:
+    """Splits the stored vector of a schema into groups of columns of the same kind,
+    every group is packed into one numpy array
+    """
+
+    def __init__(self, types: List[str]):
+        self.size = len(types)
+        self.floats = [i for i, t in enumerate(types) if t == 'float64']
+        self.ints = [i for i, t in enumerate(types) if t in INT_COSTS]
+        self.strings = [i for i, t in enumerate(types) if t in STRING_TYPES]
+        self.arrays = [i for i, t in enumerate(types) if t == 'array']
+        self.timestamps = [i for i, t in enumerate(types) if t == 'timestamp']  # the same cost for any reference
+        if len(self.floats) + len(self.ints) + len(self.strings) + len(self.arrays) + len(self.timestamps) != self.size:
+            raise ValueError('unsupported column type in %s' % types)
+        self.int_limits = np.array([INT_COSTS[types[i]][0] for i in self.ints], dtype=np.int64)
+        self.int_costs = np.array([INT_COSTS[types[i]][1] for i in self.ints], dtype=np.int64)
+        self.int_wide_costs = np.array([INT_COSTS[types[i]][2] for i in self.ints], dtype=np.int64)
+
+    def pack(self, vector: List[any]) -> Packed:
+        """Raises OverflowError, ValueError or TypeError if the vector does not fit into fixed-width arrays
+        """
+        if len(vector) != self.size:
+            raise ValueError('vector of %s values does not match the layout of %s columns' % (len(vector), self.size))
+        floats = np.array([vector[i] for i in self.floats], dtype=np.uint64)
+        ints = np.array([vector[i] for i in self.ints], dtype=np.int64)
+        strings = np.array([vector[i] for i in self.strings], dtype=np.int64)
+        arrays = np.zeros((len(self.arrays), MAX_ARRAY_LENGTH), dtype=np.uint8)
+        lengths = np.zeros(len(self.arrays), dtype=np.int64)
+        for k, i in enumerate(self.arrays):
+            arr = vector[i]
+            if len(arr) > MAX_ARRAY_LENGTH or (arr and (min(arr) < 0 or max(arr) > 255)):
+                raise ValueError('array %s does not fit into %s bytes' % (arr, MAX_ARRAY_LENGTH))
+            arrays[k, :len(arr)] = arr
+            lengths[k] = len(arr)
+        mask = np.arange(MAX_ARRAY_LENGTH) < lengths[:, None]
+        return floats, ints, strings, arrays, lengths, mask
+
+
+class VectorRing:
+    """Ring buffer of the stored vectors of records with the same schema, newest records overwrite the oldest.
+    The bit cost of delta against every buffered vector is estimated in one vectorized pass,
+    with the same numbers as size_bits() returns for the delta record
+    """
+
+    def __init__(self, layout: VectorLayout, depth: int):
+        self.layout = layout
+        self.depth = depth
+        self.capacity = 0
+        self.end = 0  # slot for the next record
+        self.count = 0
+        self._allocate(min(INITIAL_CAPACITY, depth))
+
+    def _allocate(self, capacity: int) -> None:
+        layout = self.layout
+        order = self._order() if self.count else None
+        rec_ids = np.zeros(capacity, dtype=np.int64)
+        first_refs = np.zeros(capacity, dtype=np.int64)
+        depths = np.zeros(capacity, dtype=np.int64)
+        floats = np.zeros((capacity, len(layout.floats)), dtype=np.uint64)
+        ints = np.zeros((capacity, len(layout.ints)), dtype=np.int64)
+        strings = np.zeros((capacity, len(layout.strings)), dtype=np.int64)
+        arrays = np.zeros((capacity, len(layout.arrays), MAX_ARRAY_LENGTH), dtype=np.uint8)
+        if order is not None:
+            # keep the oldest record first, so the ring continues from slot `count`
+            old = order[::-1]
+            rec_ids[:self.count] = self.rec_ids[old]
+            first_refs[:self.count] = self.first_refs[old]
+            depths[:self.count] = self.depths[old]
+            floats[:self.count] = self.floats[old]
+            ints[:self.count] = self.ints[old]
+            strings[:self.count] = self.strings[old]
+            arrays[:self.count] = self.arrays[old]
+        self.rec_ids, self.first_refs, self.depths = rec_ids, first_refs, depths
+        self.floats, self.ints, self.strings, self.arrays = floats, ints, strings, arrays
+        self.nbytes = sum(a.nbytes for a in (rec_ids, first_refs, depths, floats, ints, strings, arrays))
+        self.capacity = capacity
+        self.end = self.count % capacity
+
+    def _order(self) -> np.ndarray:
+        """Slots from the newest record to the oldest one
+        """
+        return (self.end - 1 - np.arange(self.count)) % self.capacity
+
+    def append(self, rec: CompactRecord, packed: Packed) -> None:
+        if self.count == self.capacity and self.capacity < self.depth:
+            self._allocate(min(self.capacity * 2, self.depth))
+        slot = self.end
+        self.rec_ids[slot] = rec.rec_id
+        self.first_refs[slot] = rec.first_ref
+        self.depths[slot] = rec.depth
+        self.floats[slot], self.ints[slot], self.strings[slot], self.arrays[slot] = packed[:4]
+        self.end = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def remove(self, rec_id: int) -> None:
+        """Forgets the oldest records up to the given one (it could be overwritten already), records leave
+        in order of rec_id, so only the restored ones (see RecordBuffer.restore) can be older than it
+        """
+        while self.count and self.rec_ids[(self.end - self.count) % self.capacity] <= rec_id:
+            self.count -= 1
+
+    def costs(self, packed: Packed, string_bits: int = 16) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns slots (from the newest record) and estimated bits of delta against each of them
+        (see recordbuffer.size_bits)
+        """
+        layout = self.layout
+        floats, ints, strings, arrays, lengths, mask = packed
+        order = self._order()
+        n = len(order)
+        total = np.full(n, len(layout.timestamps) * TIMESTAMP_BITS, dtype=np.int64)
+        if layout.floats:
+            d = self.floats[order] ^ floats
+            # bit lengths of 32-bit halves and of the lowest set bit (a power of 2) are exact in float64
+            high = (d >> HALF).astype(np.float64)
+            bit_length = np.where(high > 0, 32 + np.frexp(high)[1], np.frexp((d & LOW_HALF).astype(np.float64))[1])
+            trailing = np.log2(np.maximum(d & (~d + ONE), ONE).astype(np.float64)).astype(np.int64)
+            leading = np.minimum(64 - bit_length, 31)
+            total += np.where(d == 0, 1, 77 - leading - trailing).sum(axis=1)
+        if layout.ints:
+            d = ints - self.ints[order]
+            wide = np.where(np.abs(d) < layout.int_limits, layout.int_costs, layout.int_wide_costs)
+            total += np.where(d == 0, 1, np.where(np.abs(d + 256) < 256, 10, wide)).sum(axis=1)
+        if layout.strings:
+            total += np.where(self.strings[order] == strings, 1, 1 + string_bits).sum(axis=1)
+        if layout.arrays:
+            nz = ((self.arrays[order] ^ arrays) != 0) & mask
+            first = np.argmax(nz, axis=2)
+            last = MAX_ARRAY_LENGTH - 1 - np.argmax(nz[:, :, ::-1], axis=2)
+            cost = np.where(nz.any(axis=2), 16 + (last - first + 1) * 8, 6)
+            total += np.where(lengths == 0, 5, cost).sum(axis=1)
+        return order, total
+
+    def closest(self, rec_id: int, packed: Packed, max_distance: int, only_deltas: bool,
+                max_depth: Optional[int] = None, string_bits: int = 16) -> Tuple[int, int]:
+        """Returns rec_id of the cheapest reference and its cost, the newest record wins a tie.
+        With max_depth only the records with reference chains not longer than it are candidates
+        """
+        if not self.count:
+            return -1, NO_MATCH
+        order, total = self.costs(packed, string_bits)
+        rec_ids = self.rec_ids[order]
+        valid = (rec_ids != rec_id) & (rec_id - rec_ids <= max_distance)
+        if only_deltas:
+            valid &= self.first_refs[order] != 0
+        if max_depth is not None:
+            valid &= self.depths[order] <= max_depth
+        total = np.where(valid, total, NO_MATCH)
+        best = int(np.argmin(total))
+        return int(rec_ids[best]), int(total[best])
+
+
+class SeriesHistory:
+    """Buffered records of one linking column value, in order of arrival, plus a ring of stored vectors per schema
+    """
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.records: Dict[int, CompactRecord] = dict()
+        self.rings: Dict[int, VectorRing] = dict()  # map: schema_hash => ring
+        self.last_used = 0  # rec_id of the last added record
+        self.since_key = 0  # records added since the last key record, including it
+        self.nbytes = SERIES_BYTES  # approximate memory, with the data of rings
+
+    def add(self, rec: CompactRecord, layout: Optional[VectorLayout], packed: Optional[Packed]) -> None:
+        self.records[rec.rec_id] = rec
+        self.last_used = rec.rec_id
+        self.since_key = 1 if rec.depth == 0 else self.since_key + 1
+        if packed is None:
+            return
+        ring = self.rings.get(rec.schema_hash)
+        if ring is None:
+            ring = self.rings[rec.schema_hash] = VectorRing(layout, self.depth)
+            self.nbytes += ring.nbytes
+        before = ring.nbytes
+        ring.append(rec, packed)
+        self.nbytes += ring.nbytes - before
+
+    def remove(self, rec: CompactRecord) -> None:
+        if rec.rec_id in self.records:
+            del self.records[rec.rec_id]
+        if rec.schema_hash in self.rings:
+            self.rings[rec.schema_hash].remove(rec.rec_id)
+
+    def closest(self, rec: CompactRecord, packed: Packed, max_distance: int, only_deltas: bool,
+                max_depth: Optional[int] = None, string_bits: int = 16) -> Tuple[Optional[CompactRecord], int]:
+        ring = self.rings.get(rec.schema_hash)
+        if ring is None:
+            return None, NO_MATCH
+        rec_id, cost = ring.closest(rec.rec_id, packed, max_distance, only_deltas, max_depth, string_bits)
+        if cost == NO_MATCH:
+            return None, NO_MATCH
+        return self.records.get(rec_id), cost
+
+    def __len__(self):
+        return len(self.records)
+
+
+class HistoryStore:
+    """Series histories by linking column value in order of use, at most max_series of them taking at most
+    max_bytes (approximately, see SeriesHistory.nbytes): adding a record evicts the least recently used series
+    over these limits, and with ttl every series which has not got a record for more than ttl records (by rec_id)
+    is evicted too. A series whose records all left the history (see remove) is dropped, it has no candidates.
+    An evicted series only loses the candidates for delta, its next record starts a new history
+    """
+
+    def __init__(self, depth: int, max_series: int = DEFAULT_MAX_SERIES, ttl: Optional[int] = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        if max_series < 1:
+            raise ValueError('history needs room for at least one series, got %s' % max_series)
+        if max_bytes < 1:
+            raise ValueError('history needs some memory, got %s bytes' % max_bytes)
+        self.depth = depth
+        self.max_series = max_series
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.series: OrderedDict[any, SeriesHistory] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: any) -> Optional[SeriesHistory]:
+        """Returns the history to search in, counts hits and misses
+        """
+        series = self.series.get(key)
+        if series is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return series
+
+    def peek(self, key: any) -> Optional[SeriesHistory]:
+        return self.series.get(key)
+
+    def add(self, key: any, rec: CompactRecord, layout: Optional[VectorLayout], packed: Optional[Packed]) -> None:
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = SeriesHistory(self.depth)
+            self.nbytes += series.nbytes
+        else:
+            self.series.move_to_end(key)
+        before = series.nbytes
+        series.add(rec, layout, packed)
+        self.nbytes += series.nbytes - before
+        self._evict(rec.rec_id)
+
+    def remove(self, key: any, rec: CompactRecord) -> None:
+        """Forgets the record of series, drops the series once it has no records
+        """
+        series = self.series.get(key)
+        if series is None:
+            return
+        series.remove(rec)
+        if not series.records:
+            del self.series[key]
+            self.nbytes -= series.nbytes
+
+    def _pop_oldest(self) -> None:
+        _, series = self.series.popitem(last=False)
+        self.nbytes -= series.nbytes
+        self.evictions += 1
+
+    def _evict(self, clock: int) -> None:
+        while len(self.series) > self.max_series or (self.nbytes > self.max_bytes and len(self.series) > 1):
+            self._pop_oldest()
+        if self.ttl is not None:
+            while self.series and clock - next(iter(self.series.values())).last_used > self.ttl:
+                self._pop_oldest()
+
+    def counters(self) -> Dict[str, int]:
+        return {'series': len(self.series), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __contains__(self, key: any) -> bool:
+        return key in self.series
+
+    def __len__(self):
+        return len(self.series)
+
+    def __iter__(self) -> Iterator[any]:
+        return iter(self.series)
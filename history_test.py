@@ -0,0 +1,122 @@
+import random
+import unittest
+
+from cache import StringCache, SchemaCache
+from datablock import DummySink
+from history import SeriesHistory, VectorLayout, HistoryStore, SERIES_BYTES
+from record import Record
+from recordbuffer import delta, size_bits, RecordBuffer
+from reader import read_records
+from reader_test import make_records, compress
+from utils import flatten
+
+
+def make_record(rec_id: int, r: dict) -> Record:
+    rec = Record(rec_id, linking_column='data.symbol')
+    rec.from_dict(flatten(r))
+    return rec
+
+
+class TestingHistory(unittest.TestCase):
+
+    def test_costs_match_size_bits(self):
+        random.seed(7)
+        buf = RecordBuffer(sink=DummySink(), string_cache=StringCache(), schema_cache=SchemaCache())
+        records = list()
+        for i, r in enumerate(make_records(60)):
+            r['data']['volume'] = random.choice([0, 5, -200, 1 << 20, -(1 << 40)])
+            r['data']['open'] = random.choice([1.5, 100.25, 1e300, -0.0])
+            rec = make_record(i, r)
+            buf.index_string_values(rec)
+            records.append(rec.compact(buf.schema_cache))
+        for rec in records:
+            packed = buf._pack(rec)
+            self.assertIsNotNone(packed)
+            series = SeriesHistory(depth=50)
+            others = [o for o in records if o.schema_hash == rec.schema_hash and o.rec_id < rec.rec_id]
+            for other in others:
+                series.add(other, buf.layouts[rec.schema_hash], buf._pack(other))
+            ring = series.rings.get(rec.schema_hash)
+            if ring is None:
+                continue
+            for string_bits in (1, 4, 16):
+                order, costs = ring.costs(packed, string_bits)
+                for slot, cost in zip(order, costs):
+                    other = series.records[int(ring.rec_ids[slot])]
+                    self.assertEqual(cost, size_bits(delta(our=rec, their=other, iteration=0), string_bits=string_bits))
+
+    def test_ring_keeps_newest(self):
+        layout = VectorLayout(['int32'])
+        series = SeriesHistory(depth=3)
+        schema_cache = SchemaCache()
+        records = list()
+        for i in range(5):
+            rec = Record(i, linking_column='s')
+            rec.from_dict({'s': 1, 'v': 10 * i})
+            rec = rec.compact(schema_cache)
+            records.append(rec)
+            series.add(rec, layout, layout.pack([rec.values[0]]))
+        ring = series.rings[records[0].schema_hash]
+        self.assertEqual(sorted(ring.rec_ids[ring._order()]), [2, 3, 4])
+        cur, cost = series.closest(records[4], layout.pack([41]), max_distance=127, only_deltas=False)
+        self.assertEqual(cur.rec_id, 3)  # the record itself is skipped
+        cur, _ = series.closest(records[4], layout.pack([41]), max_distance=0, only_deltas=False)
+        self.assertIsNone(cur)
+
+
+    def test_store_evicts_idle_series(self):
+        schema_cache = SchemaCache()
+        store = HistoryStore(depth=2, max_series=2)
+        for i, symbol in enumerate(['A', 'B', 'A', 'C', 'A', 'D']):
+            store.add(symbol, make_record(i, {'data': {'symbol': symbol, 'v': i}}).compact(schema_cache), None, None)
+        self.assertEqual(list(store), ['A', 'D'])  # B and C were the least recently used
+        self.assertIsNotNone(store.get('A'))
+        self.assertIsNone(store.get('B'))
+        self.assertEqual(store.counters(), {'series': 2, 'bytes': 2 * SERIES_BYTES, 'hits': 1, 'misses': 1,
+                                            'evictions': 2})
+
+        store = HistoryStore(depth=2, ttl=3)
+        for i, symbol in enumerate(['A', 'B', 'A', 'A', 'A', 'A']):
+            store.add(symbol, make_record(i, {'data': {'symbol': symbol, 'v': i}}).compact(schema_cache), None, None)
+        self.assertEqual(list(store), ['A'])  # B got its last record 4 records ago
+        self.assertEqual(store.evictions, 1)
+
+    def test_store_drops_empty_series(self):
+        schema_cache = SchemaCache()
+        layout = VectorLayout(['int32', 'int32'])
+        store = HistoryStore(depth=4)
+        records = list()
+        for i in range(10):
+            rec = make_record(i, {'data': {'symbol': 'S%s' % (i % 5), 'v': i}}).compact(schema_cache)
+            records.append(rec)
+            store.add(rec.linking_value, rec, layout, layout.pack([i, i]))
+        self.assertEqual(len(store), 5)
+        for rec in records[:5]:
+            store.remove(rec.linking_value, rec)
+        self.assertEqual(len(store), 5)  # every series has one record left
+        for rec in records[5:8]:
+            store.remove(rec.linking_value, rec)
+        self.assertEqual(list(store), ['S3', 'S4'])
+        self.assertEqual(store.nbytes, sum(s.nbytes for s in store.series.values()))
+        self.assertEqual(store.evictions, 0)
+
+    def test_store_byte_budget(self):
+        schema_cache = SchemaCache()
+        layout = VectorLayout(['int32', 'int32'])
+        store = HistoryStore(depth=4, max_bytes=3 * SERIES_BYTES + 500)
+        for i in range(20):
+            rec = make_record(i, {'data': {'symbol': 'S%s' % i, 'v': i}}).compact(schema_cache)
+            store.add(rec.linking_value, rec, layout, layout.pack([i, i]))
+            self.assertLessEqual(store.nbytes, store.max_bytes)
+        self.assertEqual(list(store)[-1], 'S19')
+        self.assertEqual(store.evictions, 20 - len(store))
+        self.assertEqual(store.nbytes, sum(s.nbytes for s in store.series.values()))
+        with self.assertRaises(ValueError):
+            HistoryStore(depth=4, max_bytes=0)
+
+    def test_evicted_history_round_trip(self):
+        records = make_records(200)  # 3 symbols in turn, every one evicts the previous one
+        self.assertEqual(list(read_records(compress(records, max_series=1))), [flatten(r) for r in records])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+import gzip
+import io
+import json
+import lzma
+import queue
+import re
+import sys
+import threading
+from datetime import datetime, date
+from typing import Dict, List, Tuple, Optional, Callable, Iterable, Iterator, TextIO
+
+from record import Record, Field
+from utils import datetime_to_microseconds_epoch, date_to_days_epoch, float_to_int, flatten, schema_fingerprint, \
+    is_byte_array, json_text
+
+SCHEMA_TYPES = {  # BigQuery type => col_type
+    'FLOAT64': 'float64',
+    'FLOAT': 'float64',
+    'INTEGER': 'int32',
+    'INT64': 'int32',
+    'DATE': 'date',
+    'TIMESTAMP': 'timestamp',
+    'STRING': 'string',
+}
+
+DATE_FORMAT = '%Y-%m-%d'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H-%M-%S.%fZ'
+_date = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+_timestamp = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2})-(\d{2})-(\d{2})\.(\d{1,6})Z')
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+DEFAULT_BATCH_SIZE = 500  # lines parsed per batch
+QUEUE_SIZE = 16  # parsed batches waiting for the compression stage
+
+
+def load_schema(path: str) -> Dict[str, str]:
+    """Loads BigQuery json schema (like data/stock_schema.json) as map: flat col_name => col_type
+    """
+    with open(path, 'r') as fp:
+        return schema_types(json.load(fp))
+
+
+def schema_types(fields: List[dict], prefix: str = '') -> Dict[str, str]:
+    ret = dict()
+    for f in fields:
+        name = prefix + f['name']
+        if f['type'] == 'RECORD':
+            ret.update(schema_types(f['fields'], name + '.'))
+        elif f.get('mode') == 'REPEATED':
+            if f['type'] != 'INTEGER':
+                raise ValueError('repeated %s column %s is not supported' % (f['type'], name))
+            ret[name] = 'array'
+        elif f['type'] in SCHEMA_TYPES:
+            ret[name] = SCHEMA_TYPES[f['type']]
+        else:
+            raise ValueError('column %s has unsupported type %s' % (name, f['type']))
+    return ret
+
+
+def to_float64(v: any) -> int:
+    if type(v) is not float:
+        raise TypeError('%r is not float' % v)
+    return float_to_int(v)
+
+
+def to_int32(v: any) -> int:
+    if type(v) is not int:
+        raise TypeError('%r is not int' % v)
+    return v
+
+
+def to_array(v: any) -> List[int]:
+    if not is_byte_array(v):
+        raise TypeError('%r is not list of bytes' % v)
+    return v
+
+
+def to_json(v: any) -> str:
+    if type(v) is not list:
+        raise TypeError('%r is not list' % v)
+    return json_text(v)  # replaced with index in string cache as strings are
+
+
+def to_string(v: any) -> str:
+    if type(v) is not str:
+        raise TypeError('%r is not str' % v)
+    return v  # replaced with index in string cache by RecordBuffer.index_string_values
+
+
+def to_nullable(v: any) -> Optional[str]:
+    if v is not None and type(v) is not str:
+        raise TypeError('%r is not str or None' % v)
+    return v
+
+
+def to_date(v: any) -> int:
+    m = _date.fullmatch(v)
+    if m:
+        dt = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    else:
+        dt = datetime.strptime(v, DATE_FORMAT).date()
+    return date_to_days_epoch(dt)
+
+
+def to_timestamp(v: any) -> int:
+    m = _timestamp.fullmatch(v)
+    if m:
+        dt = datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5)),
+                      int(m.group(6)), int(m.group(7).ljust(6, '0')))
+    else:
+        dt = datetime.strptime(v, TIMESTAMP_FORMAT)
+    return datetime_to_microseconds_epoch(dt)
+
+
+converters: Dict[str, Callable[[any], any]] = {
+    'float64': to_float64,
+    'int32': to_int32,
+    'date': to_date,
+    'timestamp': to_timestamp,
+    'string': to_string,
+    'nullable': to_nullable,
+    'array': to_array,
+    'json': to_json,
+}
+
+
+class Binding:
+    """Converters of one record shape (the sequence of column names), bound once per shape
+    """
+
+    def __init__(self, names: List[str], types: List[str]):
+        self.columns: List[Tuple[str, str, Callable[[any], any]]] = [
+            (name, col_type, converters[col_type]) for name, col_type in zip(names, types)]
+        self.schema_hash = schema_fingerprint(','.join([name + ':' + col_type for name, col_type in zip(names, types)]))
+        self.timestamp_column = next((name for name, col_type in zip(names, types) if col_type == 'timestamp'), None)
+
+    def build(self, rec_id: int, rec: dict, linking_column: str) -> Tuple[Record, bool]:
+        """Returns the record and whether all values matched the bound types,
+        the values which do not match are typed by inference
+        """
+        record = Record(rec_id, linking_column=linking_column)
+        columns = record.columns
+        matched = True
+        for name, col_type, convert in self.columns:
+            value = rec[name]
+            try:
+                columns[name] = Field(value, convert(value), col_type)
+            except (TypeError, ValueError):
+                columns[name] = Field(value)
+                matched = False
+        if matched:
+            record.schema_hash = self.schema_hash
+            if self.timestamp_column:
+                record.timestamp = columns[self.timestamp_column].stored
+        else:
+            record.schema_hash = schema_fingerprint(','.join([name + ':' + f.value_type for name, f in columns.items()]))
+            record.timestamp = next((f.stored for f in columns.values() if f.value_type == 'timestamp'), None)
+        columns[linking_column].linking = True
+        return record, matched
+
+
+class RecordBuilder:
+    """Builds records from flat dicts with the column types given by schema (map: col_name => col_type)
+    or learned from the first record of every shape, i.e. no value is trial-parsed once its shape is known.
+    The values which do not match the bound types (e.g. int in float column) fall back to inference
+    """
+
+    def __init__(self, linking_column: str, schema: Optional[Dict[str, str]] = None, learn: bool = True):
+        self.linking_column = linking_column
+        self.schema = schema
+        self.learn = learn
+        self.bindings: Dict[Tuple[str, ...], Optional[Binding]] = dict()  # map: column names => binding
+        self.fallbacks = 0  # number of records built with inference
+
+    def _bind(self, shape: Tuple[str, ...], record: Optional[Record]) -> Optional[Binding]:
+        if self.schema is not None and all(name in self.schema for name in shape):
+            return Binding(list(shape), [self.schema[name] for name in shape])
+        if record is not None and self.learn:
+            return Binding(list(shape), list(record.types))
+        return None
+
+    def build(self, rec_id: int, rec: dict) -> Record:
+        shape = tuple(rec)
+        if shape in self.bindings:
+            binding = self.bindings[shape]
+        else:
+            binding = self.bindings[shape] = self._bind(shape, None)
+        if binding is not None:
+            record, matched = binding.build(rec_id, rec, self.linking_column)
+            if not matched:
+                self.fallbacks += 1
+            return record
+        record = Record(rec_id, linking_column=self.linking_column)
+        record.from_dict(rec)
+        self.bindings[shape] = self._bind(shape, record)
+        return record
+
+
+def open_input(path: str = '-') -> TextIO:
+    """Opens json lines file or stdin (path "-"), gzip, xz and zstd (if zstandard is installed) input
+    is recognised by magic bytes and decompressed while reading
+    """
+    raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if not isinstance(raw, io.BufferedReader):
+        raw = io.BufferedReader(raw)
+    magic = raw.peek(len(XZ_MAGIC))[:len(XZ_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        raw = gzip.GzipFile(fileobj=raw, mode='rb')
+    elif magic.startswith(XZ_MAGIC):
+        raw = lzma.LZMAFile(raw, mode='rb')
+    elif magic.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('%s is compressed with zstd, install zstandard to read it' % path)
+        raw = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def parse_lines(lines: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[List[dict]]:
+    """Parses json lines (up to the first empty one) into batches of flat records
+    """
+    batch = list()
+    for line in lines:
+        if not line.strip():
+            break
+        batch.append(flatten(json.loads(line)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def _offer(out: queue.Queue, item: any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _produce(batches: Iterator[List[dict]], out: queue.Queue, stop: threading.Event) -> None:
+    try:
+        for batch in batches:
+            if not _offer(out, batch, stop):
+                return  # the consumer has stopped
+        _offer(out, None, stop)
+    except Exception as e:
+        _offer(out, e, stop)
+
+
+def read_input(lines: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE,
+               queue_size: int = QUEUE_SIZE) -> Iterator[dict]:
+    """Yields flat records parsed from json lines by a background thread, which runs ahead of the consumer
+    by up to queue_size batches. The decompression of input (see open_input) runs in the thread too,
+    zlib and lzma release the GIL, so it overlaps with the compression
+    """
+    batches = queue.Queue(queue_size)
+    stop = threading.Event()
+    worker = threading.Thread(target=_produce, args=(parse_lines(lines, batch_size), batches, stop),
+                              name='ingest', daemon=True)
+    worker.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        worker.join()
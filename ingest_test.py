@@ -0,0 +1,111 @@
+import gzip
+import json
+import lzma
+import os
+import tempfile
+import unittest
+from itertools import islice
+
+from ingest import RecordBuilder, load_schema, open_input, read_input
+from record import Record
+from reader_test import make_records
+from utils import flatten
+
+
+def inferred(rec_id: int, rec: dict) -> Record:
+    record = Record(rec_id, linking_column='data.symbol')
+    record.from_dict(rec)
+    return record
+
+
+class TestingIngest(unittest.TestCase):
+    r = {
+        "date": "2000-01-05",
+        "timestamp": "2000-01-05T00-00-00.036258Z",
+        "data_source": "free_tier",
+        "data": {
+            "open": 111.125, "high": 116.375, "low": 109.375, "close": 113.8125, "adjusted_close": 35.6219,
+            "volume": 64047000, "volume_array": [152, 71, 209, 3, 0, 0, 0, 0], "symbol": "MSFT", "name": "Microsoft"
+        }
+    }
+
+    def assertSameRecord(self, actual: Record, expected: Record):
+        self.assertEqual(actual.get_schema(), expected.get_schema())
+        self.assertEqual(actual.get_vector(), expected.get_vector())
+        self.assertEqual(actual.timestamp, expected.timestamp)
+        self.assertEqual(actual.get_linking_column_value(), expected.get_linking_column_value())
+
+    def test_load_schema(self):
+        schema = load_schema('data/stock_schema.json')
+        self.assertEqual(schema['date'], 'date')
+        self.assertEqual(schema['timestamp'], 'timestamp')
+        self.assertEqual(schema['data.open'], 'float64')
+        self.assertEqual(schema['data.volume'], 'int32')
+        self.assertEqual(schema['data.volume_array'], 'array')
+        self.assertEqual(schema['data.symbol'], 'string')
+
+    def test_schema_binding(self):
+        builder = RecordBuilder('data.symbol', load_schema('data/stock_schema.json'))
+        flat = flatten(TestingIngest.r)
+        self.assertSameRecord(builder.build(1, flat), inferred(1, flat))
+        self.assertEqual(builder.fallbacks, 0)
+
+        odd = dict(flat, **{'data.open': 111})  # int in float column
+        self.assertSameRecord(builder.build(2, odd), inferred(2, odd))
+        self.assertEqual(builder.fallbacks, 1)
+
+    def test_learned_binding(self):
+        builder = RecordBuilder('data.symbol')
+        for i, r in enumerate(make_records(50)):
+            flat = flatten(r)
+            self.assertSameRecord(builder.build(i, flat), inferred(i, flat))
+        self.assertEqual(builder.fallbacks, 0)
+        self.assertEqual(len(builder.bindings), 1)
+
+        odd = dict(flatten(TestingIngest.r), date='not a date')
+        shape = tuple(odd)
+        builder.build(100, odd)
+        self.assertSameRecord(builder.build(101, odd), inferred(101, odd))
+        self.assertEqual(builder.bindings[shape].columns[0][1], 'string')
+        odd['date'] = '2000-01-06'  # parsed only by inference now
+        self.assertEqual(builder.build(102, odd).columns['date'].value_type, 'string')
+
+    def test_array_binding(self):
+        builder = RecordBuilder('data.symbol', load_schema('data/stock_schema.json'))
+        flat = flatten(TestingIngest.r)
+        for arr in ([1000], [-1], list(range(32)), [1, 'a'], [[1]]):
+            record = builder.build(1, dict(flat, **{'data.volume_array': arr}))
+            self.assertEqual(record.columns['data.volume_array'].value_type, 'json', arr)
+        self.assertEqual(builder.fallbacks, 5)
+        self.assertEqual(builder.build(2, flat).columns['data.volume_array'].value_type, 'array')
+
+    def test_null_binding(self):
+        builder = RecordBuilder('data.symbol')
+        flat = flatten(TestingIngest.r)
+        builder.build(1, flat)
+        record = builder.build(2, dict(flat, **{'data.name': None}))
+        self.assertEqual(record.columns['data.name'].value_type, 'nullable')
+        self.assertEqual(builder.fallbacks, 1)
+
+    def test_open_compressed_input(self):
+        records = make_records(20)
+        text = ''.join(json.dumps(r) + '\n' for r in records).encode('utf-8')
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, data in (('plain.json', text), ('a.json.gz', gzip.compress(text)),
+                               ('a.json.xz', lzma.compress(text))):
+                path = os.path.join(tmp, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                with open_input(path) as fp:
+                    self.assertEqual(list(read_input(fp, batch_size=3)), [flatten(r) for r in records])
+
+    def test_read_input(self):
+        lines = [json.dumps(r) + '\n' for r in make_records(100)]
+        self.assertEqual(len(list(read_input(lines + ['\n'] + lines, batch_size=7, queue_size=2))), 100)
+        self.assertEqual(len(list(islice(read_input(lines, batch_size=1, queue_size=1), 5))), 5)
+        with self.assertRaises(json.JSONDecodeError):
+            list(read_input(lines[:10] + ['{broken\n'], batch_size=4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import json
+import mmap
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import re
+import zlib
+from typing import Iterable, List, Tuple, Iterator, BinaryIO, Dict, Optional, Pattern
+
+from bitbuffer import Statistics
+from compress import compress_lines, LINKING_COLUMN, DEFAULT_LEVEL
+from history import DEFAULT_MAX_SERIES, DEFAULT_MAX_BYTES
+from reader import BlockReader
+from utils import flatten
+from writer import LAYOUT_ROWS
+
+CONTAINER_MAGIC = b'TSCC'  # [magic (4 bytes)|manifest length (4 bytes)|manifest json|shard streams]
+DEFAULT_BATCH_SIZE = 1000
+QUEUE_SIZE = 8  # batches waiting for a worker
+POLL_SECONDS = 1  # how often a waiting parent checks that the workers are alive
+
+
+def shard_of(value: any, shards: int) -> int:
+    """Deterministic shard of linking column value, the same in every process
+    """
+    return zlib.crc32(str(value).encode('utf-8')) % shards
+
+
+def linking_pattern(linking_column: str) -> Pattern:
+    """Matches the last key of linking column (`"symbol":` of `data.symbol`) with its string or scalar value
+    """
+    key = json.dumps(linking_column.rsplit('.', 1)[-1], ensure_ascii=False)
+    return re.compile(re.escape(key) + r'\s*:\s*("(?:[^"\\]|\\.)*"|[\w.+-]+)')
+
+
+def linking_value_of(line: str, linking_column: str, pattern: Pattern) -> any:
+    """Returns the value of linking column in json line without parsing the line, if the key is in it
+    only once (the line is parsed otherwise), so the json is parsed only by the workers
+    """
+    found = pattern.findall(line)
+    if len(found) == 1:
+        try:
+            return json.loads(found[0])
+        except ValueError:
+            pass
+    return flatten(json.loads(line)).get(linking_column)
+
+
+def _lines_of(tasks: mp.Queue) -> Iterator[str]:
+    batch = tasks.get()
+    while batch is not None:
+        yield from batch
+        batch = tasks.get()
+
+
+def _compress_shard(shard: int, tasks: mp.Queue, results: mp.Queue, path: str, linking_column: str,
+                    schema: Optional[Dict[str, str]], profile: bool, level: str, max_chain: Optional[int],
+                    key_interval: Optional[int], layout: str, history: Dict[str, any]) -> None:
+    """Puts (shard, count, statistics) to results, or (shard, None, exception) if the shard failed
+    """
+    try:
+        with open(path, 'wb') as out:
+            count, stat = compress_lines(_lines_of(tasks), out, linking_column, schema, profile, background=True,
+                                         level=level, max_chain=max_chain, key_interval=key_interval, layout=layout,
+                                         **history)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError('%s: %s' % (type(e).__name__, e))
+        results.put((shard, None, e))
+        return
+    results.put((shard, count, stat))
+
+
+def _get(results: mp.Queue, processes: List[mp.Process], done: List[bool]) -> Tuple[int, int, Statistics]:
+    """Waits for the next result of a worker, raises the exception of a failed worker
+    or RuntimeError if a worker exited without result
+    """
+    while True:
+        # checked before waiting: a worker which exited by then has put its result into the queue
+        alive = [worker.is_alive() for worker in processes]
+        try:
+            shard, count, stat = results.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            for shard, worker in enumerate(processes):
+                if not done[shard] and not alive[shard]:
+                    raise RuntimeError('worker %s exited with code %s' % (worker.name, worker.exitcode))
+            continue
+        if count is None:
+            raise stat
+        done[shard] = True
+        return shard, count, stat
+
+
+def _put(tasks: mp.Queue, batch: any, worker: mp.Process, results: mp.Queue, processes: List[mp.Process]) -> None:
+    while True:
+        if not worker.is_alive():
+            _get(results, processes, [False] * len(processes))  # raises the failure of worker
+        try:
+            tasks.put(batch, timeout=POLL_SECONDS)
+            return
+        except queue.Full:
+            pass
+
+
+def write_container(out: BinaryIO, shard_paths: List[str], counts: List[int], linking_column: str) -> None:
+    shards = list()
+    offset = 0
+    for shard, path in enumerate(shard_paths):
+        length = os.path.getsize(path)
+        shards.append({'shard': shard, 'offset': offset, 'length': length, 'records': counts[shard]})
+        offset += length
+    manifest = json.dumps({'linking_column': linking_column, 'shards': shards}).encode('utf-8')
+    out.write(CONTAINER_MAGIC)
+    out.write(len(manifest).to_bytes(4, 'big'))
+    out.write(manifest)
+    for path in shard_paths:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+
+
+def compress_parallel(lines: Iterable[str], path: str, workers: int = 2, linking_column: str = LINKING_COLUMN,
+                      batch_size: int = DEFAULT_BATCH_SIZE,
+                      schema: Optional[Dict[str, str]] = None, profile: bool = False,
+                      level: str = DEFAULT_LEVEL, max_chain: Optional[int] = None,
+                      key_interval: Optional[int] = None, layout: str = LAYOUT_ROWS,
+                      max_series: int = DEFAULT_MAX_SERIES, ttl: Optional[int] = None,
+                      history_bytes: int = DEFAULT_MAX_BYTES) -> Tuple[int, Statistics]:
+    """Shards json lines by hash of linking column value between worker processes, each of them compresses
+    its shard with own caches and buffers, the shard streams are combined into one container with a manifest.
+
+    The delta search compares only records with the same linking column value, so sharding does not lose matches.
+    The parent only routes the lines (see linking_value_of), a failure of any worker is raised by the parent
+    and no shard files are left
+    """
+    history = dict(max_series=max_series, ttl=ttl, history_bytes=history_bytes)
+    tasks = [mp.Queue(QUEUE_SIZE) for _ in range(workers)]
+    results = mp.Queue()
+    shard_paths = ['%s.shard%s' % (path, shard) for shard in range(workers)]
+    processes = [mp.Process(target=_compress_shard, args=(shard, tasks[shard], results, shard_paths[shard],
+                                                          linking_column, schema, profile, level, max_chain,
+                                                          key_interval, layout, history),
+                            name='shard-%s' % shard)
+                 for shard in range(workers)]
+    for p in processes:
+        p.start()
+    try:
+        pattern = linking_pattern(linking_column)
+        batches: List[List[str]] = [list() for _ in range(workers)]
+        for line in lines:
+            if not line.strip():
+                break
+            shard = shard_of(linking_value_of(line, linking_column, pattern), workers)
+            batches[shard].append(line)
+            if len(batches[shard]) >= batch_size:
+                _put(tasks[shard], batches[shard], processes[shard], results, processes)
+                batches[shard] = list()
+        for shard in range(workers):
+            if batches[shard]:
+                _put(tasks[shard], batches[shard], processes[shard], results, processes)
+            _put(tasks[shard], None, processes[shard], results, processes)
+
+        counts = [0] * workers
+        done = [False] * workers
+        stat = Statistics()
+        for _ in range(workers):
+            shard, count, shard_stat = _get(results, processes, done)
+            counts[shard] = count
+            stat.merge(shard_stat)
+        for p in processes:
+            p.join()
+
+        with open(path, 'wb') as out:
+            write_container(out, shard_paths, counts, linking_column)
+        return sum(counts), stat
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+
+
+def read_manifest(data: memoryview) -> Tuple[dict, int]:
+    """Returns the manifest of container and the offset of the first shard stream
+    """
+    if bytes(data[:len(CONTAINER_MAGIC)]) != CONTAINER_MAGIC:
+        raise ValueError('not a sharded container')
+    length = int.from_bytes(data[4:8], 'big')
+    return json.loads(bytes(data[8:8 + length]).decode('utf-8')), 8 + length
+
+
+def open_shards(data: any) -> List[BlockReader]:
+    """Creates a reader per shard over the slices of container (bytes or a file, which is memory-mapped),
+    no data is copied
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+        data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    manifest, start = read_manifest(view)
+    return [BlockReader(view[start + s['offset']:start + s['offset'] + s['length']]) for s in manifest['shards']]
+
+
+def read_container(data: any) -> Iterator[dict]:
+    """Yields the records of container shard by shard, the order of records is preserved within a shard
+    (and so within every linking column value), but not across shards
+    """
+    for reader in open_shards(data):
+        try:
+            yield from reader.records()
+        finally:
+            reader.close()
@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+
+from parallel import compress_parallel, read_container, open_shards, shard_of, linking_pattern, linking_value_of
+from reader_test import make_records
+from utils import flatten
+
+
+def by_symbol(records: list) -> dict:
+    ret = dict()
+    for r in records:
+        ret.setdefault(r['data.symbol'], list()).append(r)
+    return ret
+
+
+class TestingParallel(unittest.TestCase):
+
+    def test_shard_of_is_stable(self):
+        self.assertEqual(shard_of('MSFT', 4), shard_of('MSFT', 4))
+        self.assertIn(shard_of('AAPL', 3), range(3))
+
+    def test_sharded_container(self):
+        records = make_records(300)
+        lines = [json.dumps(r) + '\n' for r in records]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sharded.bin')
+            count, stat = compress_parallel(lines, path, workers=2, batch_size=16)
+            self.assertEqual(count, 300)
+            self.assertGreater(stat.volume['delta record'], 0)
+            self.assertEqual(os.listdir(tmp), ['sharded.bin'])
+
+            with open(path, 'rb') as f:
+                restored = list(read_container(f))
+            self.assertEqual(len(restored), 300)
+            self.assertEqual(by_symbol(restored), by_symbol([flatten(r) for r in records]))
+
+            with open(path, 'rb') as f:
+                shards = open_shards(f)
+                self.assertEqual(len(shards), 2)
+                for shard, reader in enumerate(shards):
+                    for r in reader.records():
+                        self.assertEqual(shard_of(r['data.symbol'], 2), shard)
+                    reader.close()
+
+    def test_failed_worker(self):
+        lines = [json.dumps(r) + '\n' for r in make_records(100)]
+        lines.insert(50, '{"data": {"symbol": "MSFT"}} broken\n')  # routed without parsing, the worker fails
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sharded.bin')
+            with self.assertRaises(ValueError):
+                compress_parallel(lines, path, workers=2, batch_size=16)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_linking_value(self):
+        pattern = linking_pattern('data.symbol')
+        for rec in [{'data': {'symbol': 'MS"FT', 'x': 1}}, {'data': {'symbol': 12}}, {'data': {'open': 1.5}},
+                    {'symbol': 'X', 'data': {'symbol': 'Y'}}, {'data': {'symbol': None}}, {'data': {'symbol': [1]}}]:
+            line = json.dumps(rec)
+            self.assertEqual(linking_value_of(line, 'data.symbol', pattern), flatten(rec).get('data.symbol'), line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,580 @@
+import json
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate
+from typing import Dict, List, Tuple, Iterator, Iterable, BinaryIO, Optional
+
+from bitbuffer import BitBufferReader
+from cache import StringCache, SchemaCache
+from datablock import BlockIndexEntry
+from transform import undelta_operators, restore_operators
+from writer import SCHEMA_BLOCK, STRING_CACHE_BLOCK, INDEX_BLOCK, META_BLOCK, RECORD_BLOCK, COLUMNAR_BLOCK, \
+    INDEX_MAGIC, UINT8, UINT16, UINT32, UINT64, STRING_TYPES, string_ref_bits
+
+DEFAULT_WINDOW = 256  # references are saved in 8 bits, so no record can point further back
+
+
+def unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def r_int16(buf: BitBufferReader) -> int:
+    if not buf.get_value(1):
+        return 0  # bits 0
+    if not buf.get_value(1):
+        return buf.get_value(8) - UINT8  # bits 10|8bit
+    value = buf.get_value(16)  # bits 11|16bit
+    if value == 0:
+        return unzigzag(r_varint(buf))
+    return value - UINT16
+
+
+def r_int32(buf: BitBufferReader) -> int:
+    if not buf.get_value(1):
+        return 0  # bits 0
+    if not buf.get_value(1):
+        return buf.get_value(8) - UINT8  # bits 10|8bit
+    value = buf.get_value(32)  # bits 11|32bit
+    if value == 0:
+        return unzigzag(r_varint(buf))
+    return value - UINT32
+
+
+def r_int64(buf: BitBufferReader) -> int:
+    if not buf.get_value(1):
+        return 0  # bits 0
+    if not buf.get_value(1):
+        return buf.get_value(8) - UINT8  # bits 10|8bit
+    return buf.get_value(64) - UINT64  # bits 11|64bit
+
+
+def r_varint(buf: BitBufferReader) -> int:
+    value = 0
+    shift = 0
+    while True:
+        group = buf.get_value(8)
+        value |= (group & 0x7f) << shift
+        if group < 0x80:
+            return value
+        shift += 7
+
+
+def r_dod(buf: BitBufferReader) -> int:
+    if not buf.get_value(1):
+        return 0  # bits 0
+    if not buf.get_value(1):
+        return buf.get_value(7) - 63  # bits 10|7bit
+    if not buf.get_value(1):
+        return buf.get_value(9) - 255  # bits 110|9bit
+    if not buf.get_value(1):
+        return buf.get_value(12) - 2047  # bits 1110|12bit
+    return unzigzag(buf.get_value(buf.get_value(6) + 1))  # bits 1111|6bit width|zigzag value
+
+
+def r_float64(buf: BitBufferReader, window: List[int] = None, k: int = 0) -> int:
+    if not buf.get_value(1):
+        return 0  # bits 0
+    if window is None:
+        window = [0, 0]
+    if not buf.get_value(1):
+        size = window[k + 1]  # bits 10|data in the previous window
+        return buf.get_value(size) << (64 - window[k] - size)
+    leading = buf.get_value(5)  # bits 11|5bit leading zeros|6bit length|data
+    size = buf.get_value(6) + 1
+    window[k], window[k + 1] = leading, size
+    return buf.get_value(size) << (64 - leading - size)
+
+
+def r_str(buf: BitBufferReader, width: int = 16) -> int:
+    if not buf.get_value(1):
+        return 0  # bits 0
+    return buf.get_value(width)
+
+
+def r_array(buf: BitBufferReader) -> List[int]:
+    length = buf.get_value(5)
+    arr = [0] * length
+    if not length or not buf.get_value(1):
+        return arr
+    first_non_zero_byte = buf.get_value(5)
+    important_bytes = buf.get_value(5)
+    for i in range(first_non_zero_byte, first_non_zero_byte + important_bytes + 1):
+        arr[i] = buf.get_value(8)
+    return arr
+
+
+r_operators = {
+    'float64': r_float64,
+    'int32': r_int32,
+    'date': r_int16,
+    'timestamp': r_dod,
+    'string': r_str,
+    'array': r_array,
+    'nullable': r_str,
+    'json': r_str
+}
+
+
+def s_int16(buf: BitBufferReader) -> None:
+    if buf.get_value(1):
+        if not buf.get_value(1):
+            buf.skip(8)
+        elif buf.get_value(16) == 0:
+            r_varint(buf)
+
+
+def s_int32(buf: BitBufferReader) -> None:
+    if buf.get_value(1):
+        if not buf.get_value(1):
+            buf.skip(8)
+        elif buf.get_value(32) == 0:
+            r_varint(buf)
+
+
+def s_dod(buf: BitBufferReader) -> None:
+    if not buf.get_value(1):
+        return
+    if not buf.get_value(1):
+        buf.skip(7)
+    elif not buf.get_value(1):
+        buf.skip(9)
+    elif not buf.get_value(1):
+        buf.skip(12)
+    else:
+        buf.skip(buf.get_value(6) + 1)
+
+
+def s_float64(buf: BitBufferReader, window: List[int], k: int) -> None:
+    """Skips the value, but keeps the window of column for the next values
+    """
+    if not buf.get_value(1):
+        return
+    if not buf.get_value(1):
+        buf.skip(window[k + 1])
+        return
+    window[k] = buf.get_value(5)
+    window[k + 1] = buf.get_value(6) + 1
+    buf.skip(window[k + 1])
+
+
+def s_str(buf: BitBufferReader, width: int) -> None:
+    if buf.get_value(1):
+        buf.skip(width)
+
+
+def s_array(buf: BitBufferReader) -> None:
+    if buf.get_value(5) and buf.get_value(1):
+        buf.skip(5)
+        buf.skip((buf.get_value(5) + 1) * 8)
+
+
+s_operators = {  # skip a value by the lengths in its prefix, without restoring it (see r_operators)
+    'int32': s_int32,
+    'date': s_int16,
+    'timestamp': s_dod,
+    'array': s_array,
+}
+
+
+class DecodedRecord:
+    """Keeps what is needed to resolve the records which refer to this one
+    """
+
+    def __init__(self, rec_id: int, schema: List[Tuple[str, str]], first_order: List[any], values: List[any],
+                 schema_id: int = 0):
+        self.rec_id = rec_id
+        self.schema = schema
+        self.schema_id = schema_id
+        self.first_order = first_order  # the vector after the 1st delta iteration (key values or 1st deltas)
+        self.values = values  # fully restored stored values
+
+    @property
+    def timestamp(self) -> Optional[int]:
+        for i, (_, col_type) in enumerate(self.schema):
+            if col_type == 'timestamp':
+                return self.values[i]
+        return None
+
+    def __repr__(self):
+        return f'{self.rec_id}:{self.values}'
+
+
+class BlockReader:
+    """Walks the block stream written by BlockWriter and yields restored flat records lazily.
+
+    Only the last `window` decoded records are kept to resolve references, so the memory use
+    does not depend on the size of stream. Key records refer to schemas by sequential ids,
+    given in the order the schemas are saved
+    """
+
+    def __init__(self, io: BinaryIO, window: int = DEFAULT_WINDOW, columns: Optional[Iterable[str]] = None):
+        self.buf = BitBufferReader(io)
+        self.columns = None if columns is None else set(columns)
+        self.plans: Dict[int, List[bool]] = dict()  # map: schema id => whether every column is decoded
+        self.string_cache = StringCache()
+        self.schema_cache = SchemaCache()
+        self.schemas: List[List[Tuple[str, str]]] = list()  # list((col_name, col_type)) by schema id
+        self.stream_ids: Dict[str, int] = dict()  # map: col_name:col_type => column id, see BlockWriter.columns
+        self.stream_columns: List[Tuple[str, str]] = list()  # (col_name, col_type) by column id
+        self.schema_streams: List[List[int]] = list()  # column ids by schema id
+        self.window = window
+        self.history: Dict[int, DecodedRecord] = dict()
+        self.order: deque[int] = deque()
+        self.rec_id = 0
+        self.index: Optional[List[BlockIndexEntry]] = None
+        self.linking_column: Optional[str] = None
+        self.series: Dict[any, List[int]] = dict()  # map: linking value => (previous timestamp, delta) per column
+        self.float_windows: List[int] = list()  # (leading zeros, length) of the previous window per float column
+        self.string_bits = 0  # width of string index in the current block, see BlockWriter.start_block
+
+    def _remember(self, rec: DecodedRecord) -> None:
+        self.history[rec.rec_id] = rec
+        self.order.append(rec.rec_id)
+        if len(self.order) > self.window:
+            del self.history[self.order.popleft()]
+
+    def _lookup(self, rec_id: int) -> DecodedRecord:
+        if rec_id not in self.history:
+            raise ValueError('record %s refers to record %s outside of the window' % (self.rec_id, rec_id))
+        return self.history[rec_id]
+
+    def read_schema(self, data: bytes) -> None:
+        self.schema_cache.append_from_bytes(data)
+        for schema in list(self.schema_cache.schemas.values())[len(self.schemas):]:
+            self.schemas.append([tuple(col.split(':')) for col in schema])
+            for column in schema:
+                if column not in self.stream_ids:
+                    self.stream_ids[column] = len(self.stream_columns)
+                    self.stream_columns.append(tuple(column.split(':')))
+            self.schema_streams.append([self.stream_ids[column] for column in schema])
+
+    def read_string_cache(self, data: bytes) -> None:
+        self.string_cache.append_from_bytes(data)
+
+    def _plan(self, schema_id: int) -> List[bool]:
+        """Returns whether every column of schema is decoded: the projected columns, the timestamps
+        and the linking column, which the timestamps of series are restored by
+        """
+        if schema_id not in self.plans:
+            self.plans[schema_id] = [col_name in self.columns or col_type == 'timestamp'
+                                     or col_name == self.linking_column
+                                     for col_name, col_type in self.schemas[schema_id]]
+        return self.plans[schema_id]
+
+    def _read_projected(self, schema: List[Tuple[str, str]], plan: List[bool]) -> List[any]:
+        """Reads the stored values of decoded columns, the other ones are skipped and left None
+        """
+        buf = self.buf
+        stored = list()
+        k = 0
+        for (_, col_type), decoded in zip(schema, plan):
+            if col_type == 'float64':
+                if len(self.float_windows) < k + 2:
+                    self.float_windows.extend([0, 0])
+                if decoded:
+                    stored.append(r_float64(buf, self.float_windows, k))
+                else:
+                    s_float64(buf, self.float_windows, k)
+                    stored.append(None)
+                k += 2
+            elif col_type in STRING_TYPES:
+                if decoded:
+                    stored.append(r_str(buf, self.string_bits))
+                else:
+                    s_str(buf, self.string_bits)
+                    stored.append(None)
+            elif decoded:
+                stored.append(r_operators[col_type](buf))
+            else:
+                s_operators[col_type](buf)
+                stored.append(None)
+        return stored
+
+    def _read_schema_id(self) -> int:
+        schema_id = r_varint(self.buf)
+        if schema_id >= len(self.schemas):
+            raise ValueError('record %s has unknown schema %s' % (self.rec_id, schema_id))
+        return schema_id
+
+    def read_record(self, first_ref: int, second_ref: int) -> DecodedRecord:
+        if first_ref == 0 and second_ref == 0:
+            schema_id = self._read_schema_id()
+        else:
+            schema_id = self._lookup(self.rec_id + (first_ref or second_ref)).schema_id
+        schema = self.schemas[schema_id]
+        if self.columns is not None:
+            stored = self._read_projected(schema, self._plan(schema_id))
+        else:
+            stored = list()
+            k = 0
+            for _, col_type in schema:
+                if col_type == 'float64':
+                    if len(self.float_windows) < k + 2:
+                        self.float_windows.extend([0, 0])
+                    stored.append(r_float64(self.buf, self.float_windows, k))
+                    k += 2
+                elif col_type in STRING_TYPES:
+                    stored.append(r_str(self.buf, self.string_bits))
+                else:
+                    stored.append(r_operators[col_type](self.buf))
+        return self._restore(schema_id, first_ref, second_ref, stored)
+
+    def _restore(self, schema_id: int, first_ref: int, second_ref: int, stored: List[any]) -> DecodedRecord:
+        """Resolves the references of record with the read stored values (None for skipped columns)
+        """
+        schema = self.schemas[schema_id]
+        undelta = self._undelta if self.columns is None else self._undelta_projected
+        first_order = stored
+        if second_ref:
+            first_order = undelta(schema, stored, self._lookup(self.rec_id + second_ref).first_order)
+        values = first_order
+        if first_ref:
+            values = undelta(schema, first_order, self._lookup(self.rec_id + first_ref).values)
+        self._restore_timestamps(schema, [stored, first_order, values])
+        rec = DecodedRecord(self.rec_id, schema, first_order, values, schema_id)
+        self._remember(rec)
+        self.rec_id += 1
+        return rec
+
+    def _read_column(self, col_type: str, count: int) -> List[any]:
+        buf = self.buf
+        if col_type == 'float64':
+            window = [0, 0]
+            return [r_float64(buf, window) for _ in range(count)]
+        if col_type in STRING_TYPES:
+            width = self.string_bits
+            return [r_str(buf, width) for _ in range(count)]
+        read = r_operators[col_type]
+        return [read(buf) for _ in range(count)]
+
+    def read_columnar_block(self) -> Iterator[DecodedRecord]:
+        """Reads the block written by BlockWriter.save_columnar_block: the column streams are decoded one by one
+        (the streams of columns out of projection are skipped by their lengths), then the records are restored
+        in order
+        """
+        buf = self.buf
+        headers = list()
+        schema_ids: Dict[int, int] = dict()  # map: rec_id => schema id, for the records of block
+        for rec_id in range(self.rec_id, self.rec_id + r_varint(buf)):
+            first_ref = buf.get_value(8) - 128
+            second_ref = buf.get_value(8) - 128
+            if first_ref == 0 and second_ref == 0:
+                schema_id = self._read_schema_id()
+            else:
+                ref = rec_id + (first_ref or second_ref)
+                schema_id = schema_ids[ref] if ref in schema_ids else self._lookup(ref).schema_id
+            schema_ids[rec_id] = schema_id
+            headers.append((first_ref, second_ref, schema_id))
+        counts: Dict[int, int] = dict()  # map: column id => number of values in its stream
+        for _, _, schema_id in headers:
+            for column in self.schema_streams[schema_id]:
+                counts[column] = counts.get(column, 0) + 1
+        directory = [(r_varint(buf), r_varint(buf)) for _ in range(r_varint(buf))]
+        streams: Dict[int, Iterator[any]] = dict()
+        position = buf.tell()
+        for column, bits in directory:
+            col_name, col_type = self.stream_columns[column]
+            if self.columns is None or col_name in self.columns or col_type == 'timestamp' \
+                    or col_name == self.linking_column:
+                streams[column] = iter(self._read_column(col_type, counts[column]))
+            position += bits
+            buf.seek(position)
+        for first_ref, second_ref, schema_id in headers:
+            stored = [next(streams[column]) if column in streams else None
+                      for column in self.schema_streams[schema_id]]
+            yield self._restore(schema_id, first_ref, second_ref, stored)
+
+    @staticmethod
+    def _undelta(schema: List[Tuple[str, str]], vector: List[any], their: List[any]) -> List[any]:
+        return [undelta_operators[col_type](vector[i], their[i]) for i, (_, col_type) in enumerate(schema)]
+
+    @staticmethod
+    def _undelta_projected(schema: List[Tuple[str, str]], vector: List[any], their: List[any]) -> List[any]:
+        return [None if vector[i] is None else undelta_operators[col_type](vector[i], their[i])
+                for i, (_, col_type) in enumerate(schema)]
+
+    def _restore_timestamps(self, schema: List[Tuple[str, str]], vectors: List[List[any]]) -> None:
+        """Replaces delta of delta of every timestamp column with the timestamp, the timestamps are not
+        delta-encoded against references, so all vectors get the same value
+        """
+        state = None
+        k = 0
+        for i, (_, col_type) in enumerate(schema):
+            if col_type != 'timestamp':
+                continue
+            if state is None:
+                state = self.series.setdefault(self._series_of(schema, vectors[-1]), list())
+            if len(state) < k + 2:
+                state.extend([0] * (k + 2 - len(state)))
+            state[k + 1] += vectors[0][i]
+            state[k] += state[k + 1]
+            for vector in vectors:
+                vector[i] = state[k]
+            k += 2
+
+    def _series_of(self, schema: List[Tuple[str, str]], values: List[any]) -> any:
+        """Returns the original value of linking column, the same which BlockWriter keeps series state by
+        """
+        if self.linking_column is None:
+            return None
+        for i, (col_name, col_type) in enumerate(schema):
+            if col_name == self.linking_column:
+                return self._restore_value(col_type, values[i])
+        return None
+
+    def to_dict(self, rec: DecodedRecord) -> dict:
+        """Returns the restored record, only with the projected columns if the reader has them
+        """
+        ret = dict()
+        for (col_name, col_type), value in zip(rec.schema, rec.values):
+            if self.columns is not None and col_name not in self.columns:
+                continue
+            ret[col_name] = self._restore_value(col_type, value)
+        return ret
+
+    def _restore_value(self, col_type: str, value: any) -> any:
+        if col_type in STRING_TYPES:
+            value = self.string_cache.get(value)
+            return json.loads(value) if col_type == 'json' else value
+        return restore_operators[col_type](value)
+
+    def read_meta(self, data: bytes) -> None:
+        self.linking_column = json.loads(data.decode('utf-8')).get('linking_column')
+
+    def _read_dictionary_block(self, block_type: int) -> bool:
+        if block_type == META_BLOCK:
+            self.read_meta(self.buf.get_bytes(self.buf.get_value(32)))
+        elif block_type == SCHEMA_BLOCK:
+            self.read_schema(self.buf.get_bytes(self.buf.get_value(32)))
+        elif block_type == STRING_CACHE_BLOCK:
+            self.read_string_cache(self.buf.get_bytes(self.buf.get_value(32)))
+        else:
+            return False
+        return True
+
+    def _decode(self) -> Iterator[DecodedRecord]:
+        buf = self.buf
+        while buf.bits_left >= 16:
+            first = buf.get_value(8)
+            second = buf.get_value(8)
+            if first == 0:
+                if second == RECORD_BLOCK:
+                    self.series.clear()
+                    self.float_windows.clear()
+                    self.string_bits = string_ref_bits(self.string_cache.index)
+                elif second == COLUMNAR_BLOCK:
+                    self.series.clear()
+                    self.string_bits = string_ref_bits(self.string_cache.index)
+                    yield from self.read_columnar_block()
+                elif not self._read_dictionary_block(second):
+                    return  # block index or zero padding after the last block
+            else:
+                yield self.read_record(first - 128, second - 128)
+
+    def records(self) -> Iterator[dict]:
+        for rec in self._decode():
+            yield self.to_dict(rec)
+
+    def read_index(self) -> List[BlockIndexEntry]:
+        """Loads the block index from the footer, the stream without footer has an empty index
+        """
+        if self.index is not None:
+            return self.index
+        self.index = list()
+        buf = self.buf
+        trailer = len(INDEX_MAGIC) * 8 + 64
+        if buf.size < trailer:
+            return self.index
+        position = buf.tell()
+        buf.seek(buf.size - trailer)
+        offset = buf.get_value(64)
+        if buf.get_bytes(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            buf.seek(offset)
+            if buf.get_value(16) != INDEX_BLOCK:
+                raise ValueError('no block index at %s' % offset)
+            for _ in range(buf.get_value(32)):
+                entry = BlockIndexEntry(buf.get_value(64), buf.get_value(64), buf.get_value(64), buf.get_value(32))
+                if buf.get_value(1):
+                    entry.min_timestamp = buf.get_value(64) - UINT64
+                    entry.max_timestamp = buf.get_value(64) - UINT64
+                self.index.append(entry)
+        buf.seek(position)
+        return self.index
+
+    def _start_at(self, block: int) -> None:
+        """Positions the reader at the anchor of block: restores dictionaries saved before the anchor
+        by reading only the dictionary blocks of preceding blocks, then seeks to the anchor
+        """
+        index = self.read_index()
+        anchor = index[block].anchor
+        self.string_cache = StringCache()
+        self.schema_cache = SchemaCache()
+        self.schemas.clear()
+        self.plans.clear()
+        self.stream_ids.clear()
+        self.stream_columns.clear()
+        self.schema_streams.clear()
+        self.buf.seek(0)
+        while self.buf.bits_left >= 16 and self.buf.get_value(8) == 0 and self.buf.get_value(8) == META_BLOCK:
+            self._read_dictionary_block(META_BLOCK)
+        for entry in index[:anchor]:
+            self.buf.seek(entry.bit_offset)
+            while self.buf.bits_left >= 16 and self.buf.get_value(8) == 0:
+                if not self._read_dictionary_block(self.buf.get_value(8)):
+                    break
+        self.buf.seek(index[anchor].bit_offset)
+        self.rec_id = index[anchor].first_rec_id
+        self.history.clear()
+        self.order.clear()
+        self.series.clear()
+        self.float_windows.clear()
+
+    def records_from(self, rec_id: int) -> Iterator[dict]:
+        """Yields the records starting with rec_id (the 0-based number of record in the stream)
+        """
+        index = self.read_index()
+        if index:
+            block = bisect_left([entry.last_rec_id for entry in index], rec_id)
+            if block == len(index):
+                return
+            self._start_at(block)
+        for rec in self._decode():
+            if rec.rec_id >= rec_id:
+                yield self.to_dict(rec)
+
+    def records_since(self, timestamp: int) -> Iterator[dict]:
+        """Yields the records starting with the first one which has timestamp (microseconds since epoch)
+        not less than the given one
+        """
+        index = self.read_index()
+        if index:
+            # blocks of interleaved series are not ordered by time, but the running maximum is
+            latest = list(accumulate([-1 if e.max_timestamp is None else e.max_timestamp for e in index], max))
+            block = bisect_left(latest, timestamp)
+            if block == len(index):
+                return
+            self._start_at(block)
+        found = False
+        for rec in self._decode():
+            if not found:
+                ts = rec.timestamp
+                found = ts is not None and ts >= timestamp
+            if found:
+                yield self.to_dict(rec)
+
+    def __iter__(self) -> Iterator[dict]:
+        return self.records()
+
+    def close(self):
+        self.buf.close()
+
+
+def read_records(io: BinaryIO, window: int = DEFAULT_WINDOW, columns: Optional[Iterable[str]] = None) -> Iterator[dict]:
+    """Yields the flat records stored in the stream one by one, with columns only those of them
+    (the others are skipped over without decoding)
+    """
+    reader = BlockReader(io, window, columns)
+    try:
+        yield from reader.records()
+    finally:
+        reader.close()
@@ -0,0 +1,221 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from bitbuffer import BitBufferWriter, BitBufferReader
+from cache import StringCache, SchemaCache
+from datablock import Sink
+from history import DEFAULT_MAX_SERIES
+from reader import read_records, BlockReader, r_dod, r_float64, r_int16, r_int32
+from record import Record
+from recordbuffer import RecordBuffer
+from utils import flatten
+from transform import microseconds_epoch_to_datetime
+from writer import BlockWriter, t_dod, t_float64, t_int16, t_int32, LAYOUT_ROWS, LAYOUT_COLUMNS, LAYOUTS
+
+
+def compress(records: list, linked: bool = True, max_series: int = DEFAULT_MAX_SERIES,
+             layout: str = LAYOUT_ROWS) -> bytes:
+    out = io.BytesIO()
+    string_cache = StringCache()
+    schema_cache = SchemaCache()
+    bitbuffer = BitBufferWriter(out)
+    bw = BlockWriter(bit_buffer=bitbuffer)
+    if linked:
+        bw.save_meta({'linking_column': 'data.symbol'})
+    sink = Sink(block_writer=bw, string_cache=string_cache, schema_cache=schema_cache, layout=layout)
+    buf_2 = RecordBuffer(sink=sink, string_cache=string_cache, schema_cache=schema_cache, iteration=1, max_size=10,
+                         max_series=max_series)
+    buf_1 = RecordBuffer(sink=buf_2, string_cache=string_cache, schema_cache=schema_cache, iteration=0, max_size=10,
+                         max_series=max_series)
+    for index, rec in enumerate(records):
+        record = Record(index, linking_column='data.symbol')
+        record.from_dict(flatten(rec))
+        buf_1.index_string_values(record)
+        buf_1.add(record)
+    buf_1.close()
+    bitbuffer.close()
+    return out.getvalue()
+
+
+def make_records(count: int) -> list:
+    records = list()
+    for i in range(count):
+        symbol = ['MSFT', 'AAPL', 'TSLA'][i % 3]
+        records.append({
+            "date": "2000-01-%02d" % (1 + i // 3 % 28),
+            "timestamp": "2000-01-%02dT00-00-00.%06dZ" % (1 + i // 3 % 28, (i * 7919) % 100000),
+            "data_source": "free_tier" if i % 5 else "paid, tier ü",
+            "data": {
+                "open": 111.125 + i, "high": 116.375 - i / 8, "low": 109 + i % 4, "close": -113.8125 * i,
+                "volume": [64047000, 7291978422, -3000000000, -129, 127, 0][i % 6] + i,
+                "symbol": symbol, "name": symbol.lower() if i % 7 else "%s, №%s" % (symbol.lower(), i),
+                "volume_array": [152, 71, i % 256, 3, 0, 0, 0, 0][:8 - i % 4]
+            }
+        })
+    return records
+
+
+class TestingReader(unittest.TestCase):
+
+    def test_round_trip(self):
+        records = make_records(250)
+        data = compress(records)
+        restored = list(read_records(data))
+        self.assertEqual(len(restored), len(records))
+        for original, decoded in zip(records, restored):
+            self.assertEqual(flatten(original), decoded)
+
+    def test_round_trip_without_meta(self):
+        records = make_records(120)
+        restored = list(read_records(compress(records, linked=False)))
+        self.assertEqual(restored, [flatten(r) for r in records])
+
+    def test_round_trip_across_processes(self):
+        script = 'import sys; from reader_test import compress, make_records; ' \
+                 'sys.stdout.buffer.write(compress(make_records(60)))'
+        data = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              env=dict(os.environ, PYTHONHASHSEED='123')).stdout
+        self.assertEqual(list(read_records(data)), [flatten(r) for r in make_records(60)])
+
+    def test_timestamp_buckets(self):
+        values = [0, 1, -63, 64, 65, -64, -255, 256, 257, -2047, 2048, 2049, -2048, 1 << 40, -(1 << 62), (1 << 63) - 1]
+        out = io.BytesIO()
+        bb = BitBufferWriter(out)
+        bb.set_metric('record')
+        for v in values:
+            t_dod(bb, v)
+        bb.close()
+        buf = BitBufferReader(out.getvalue())
+        self.assertEqual([r_dod(buf) for _ in values], values)
+        with self.assertRaises(ValueError):
+            t_dod(bb, 1 << 64)
+
+    def test_wide_ints(self):
+        values = [0, -128, 127, 1 << 31, -(1 << 31), (1 << 63) - 1, -(1 << 63), 1 << 64, (1 << 70) + 2, -(1 << 70)]
+        out = io.BytesIO()
+        bb = BitBufferWriter(out)
+        bb.set_metric('record')
+        for v in values:
+            t_int16(bb, v)
+            t_int32(bb, v)
+        bb.close()
+        buf = BitBufferReader(out.getvalue())
+        self.assertEqual([(r_int16(buf), r_int32(buf)) for _ in values], [(v, v) for v in values])
+        records = make_records(30)
+        for i, rec in enumerate(records):
+            rec['data']['volume'] = (1 << 70) + 2 if i % 2 else -(1 << 63) - i
+        self.assertEqual(list(read_records(compress(records))), [flatten(r) for r in records])
+
+    def test_json_arrays(self):
+        records = make_records(60)
+        for i, rec in enumerate(records):
+            rec['data']['volume_array'] = [[1000, -i], list(range(40)), [i % 256], ['a', {'b': None}]][i % 4]
+        for layout in LAYOUTS:
+            self.assertEqual(list(read_records(compress(records, layout=layout))), [flatten(r) for r in records])
+
+    def test_nulls(self):
+        records = make_records(60)
+        for i, rec in enumerate(records):
+            rec['data']['name'] = None if i % 3 else rec['data']['name']
+            rec['data_source'] = None if i % 4 == 1 else rec['data_source']
+            rec['data']['close'] = None if i % 5 == 2 else rec['data']['close']
+        for layout in LAYOUTS:
+            self.assertEqual(list(read_records(compress(records, layout=layout))), [flatten(r) for r in records])
+
+    def test_float_windows(self):
+        values = [0x405bc80000000000, 0x0003000000000000, 0x0001000000000000, 0, 0x0000000000000001, 1 << 63,
+                  0x00ff00000000ff00, 0x0010000000000100, 0xffffffffffffffff, 0x0000001000000000]
+        out = io.BytesIO()
+        bb = BitBufferWriter(out)
+        bb.set_metric('record')
+        window = [0, 0]
+        for v in values:
+            t_float64(bb, v, window)
+        bb.close()
+        buf = BitBufferReader(out.getvalue())
+        window = [0, 0]
+        self.assertEqual([r_float64(buf, window) for _ in values], values)
+
+    def test_projection(self):
+        records = [flatten(r) for r in make_records(250)]
+        for linked in (True, False):
+            data = compress(make_records(250), linked=linked)
+            for columns in (['data.close'], ['data.name', 'date', 'data.volume_array'], ['timestamp'], ['missing']):
+                projected = list(read_records(data, columns=columns))
+                self.assertEqual(projected, [{c: r[c] for c in columns if c in r} for r in records], columns)
+        reader = BlockReader(compress(make_records(250)), columns=['data.open'])
+        self.assertEqual(list(reader.records_from(203)), [{'data.open': r['data.open']} for r in records[203:]])
+
+    def test_columnar_layout(self):
+        records = [flatten(r) for r in make_records(250)]
+        for linked in (True, False):
+            data = compress(make_records(250), linked=linked, layout=LAYOUT_COLUMNS)
+            self.assertEqual(list(read_records(data)), records)
+            for columns in (['data.close'], ['data.name', 'date', 'data.volume_array'], ['timestamp'], ['missing']):
+                projected = list(read_records(data, columns=columns))
+                self.assertEqual(projected, [{c: r[c] for c in columns if c in r} for r in records], columns)
+        data = compress(make_records(250), layout=LAYOUT_COLUMNS)
+        self.assertEqual(list(BlockReader(data).records_from(150)), records[150:])
+        reader = BlockReader(data, columns=['data.open'])
+        self.assertEqual(list(reader.records_from(203)), [{'data.open': r['data.open']} for r in records[203:]])
+        with self.assertRaises(ValueError):
+            Sink(block_writer=BlockWriter(BitBufferWriter(io.BytesIO())), string_cache=StringCache(),
+                 schema_cache=SchemaCache(), layout='diagonal')
+
+    def test_streaming_is_lazy(self):
+        data = compress(make_records(100))
+        reader = BlockReader(data, window=128)
+        it = iter(reader)
+        first = next(it)
+        self.assertEqual(first['data.symbol'], 'MSFT')
+        self.assertEqual(reader.rec_id, 1)
+        self.assertEqual(sum(1 for _ in it), 99)
+        self.assertLessEqual(len(reader.history), 128)
+
+    def test_reading_file(self):
+        records = make_records(30)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test_reader.bin')
+            with open(path, 'wb') as f:
+                f.write(compress(records))
+            with open(path, 'rb') as f:
+                restored = list(read_records(f))
+        self.assertEqual([flatten(r) for r in records], restored)
+
+    def test_empty_stream(self):
+        self.assertEqual(list(read_records(compress([]))), [])
+        self.assertEqual(BlockReader(compress([])).read_index(), [])
+
+    def test_block_index(self):
+        data = compress(make_records(250))
+        index = BlockReader(data).read_index()
+        self.assertEqual([(e.first_rec_id, e.last_rec_id) for e in index], [(0, 100), (101, 201), (202, 249)])
+        self.assertEqual(index[0].bit_offset, 48 + 8 * len('{"linking_column": "data.symbol"}'))  # after meta block
+        for entry in index:
+            self.assertLessEqual(entry.anchor, index.index(entry))
+            self.assertLessEqual(entry.min_timestamp, entry.max_timestamp)
+
+    def test_seek_by_record_id(self):
+        data = compress(make_records(250))
+        full = list(read_records(data))
+        for rec_id in (0, 1, 100, 101, 150, 249):
+            self.assertEqual(list(BlockReader(data).records_from(rec_id)), full[rec_id:])
+        self.assertEqual(list(BlockReader(data).records_from(250)), [])
+
+    def test_seek_by_timestamp(self):
+        data = compress(make_records(250))
+        full = list(read_records(data))
+        reader = BlockReader(data)
+        timestamps = [e.min_timestamp for e in reader.read_index()]
+        for ts in timestamps + [timestamps[1] + 1]:
+            expected = next(i for i, r in enumerate(full) if r['timestamp'] >= microseconds_epoch_to_datetime(ts))
+            self.assertEqual(list(BlockReader(data).records_since(ts)), full[expected:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
 from datetime import datetime, date
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 
-from utils import datetime_to_microseconds_epoch, date_to_days_epoch, float_to_int
+from cache import SchemaCache
+from utils import datetime_to_microseconds_epoch, date_to_days_epoch, float_to_int, schema_fingerprint, \
+    is_byte_array, json_text
 
 
 class Field:
+    __slots__ = ('value', 'stored', 'value_type', 'linking')
 
     def __init__(self, value: any, stored_value: any = None, value_type: str = None, is_linking: bool = False):
         self.value = value  # original value
@@ -20,8 +23,12 @@ class Field:
             return float_to_int(v), 'float64'
         elif isinstance(v, int):
             return v, 'int32'
+        elif v is None:
+            return v, 'nullable'  # saved in string cache as strings are
         elif isinstance(v, list):
-            return v, 'array'
+            if is_byte_array(v):
+                return v, 'array'
+            return json_text(v), 'json'  # saved as text in string cache
         else:
             try:
                 dt = datetime.strptime(str(v), '%Y-%m-%d').date()
@@ -46,12 +53,19 @@ class Field:
 
 
 class Record:
+    """Mutable record with named and typed fields, used to build records from the input
+    and as a readable view of CompactRecord
+    """
+    __slots__ = ('rec_id', 'linking_column', 'timestamp', 'first_ref', 'second_ref', 'depth', 'columns',
+                 'schema_hash')
 
     def __init__(self, rec_id: int, linking_column: str = '', first_ref: int = 0):
         self.rec_id = rec_id  # absolute index of record in sequence - transient field
         self.linking_column = linking_column  # the name of key field in record - transient field
+        self.timestamp = None  # stored value of the first timestamp column - transient field
         self.first_ref = first_ref
         self.second_ref = 0
+        self.depth = 0  # records to decode before this one, see CompactRecord - transient field
 
         self.columns: Dict[str, Field] = dict()
         self.schema_hash = 0
@@ -60,6 +74,18 @@ class Record:
     def signature(self) -> int:
         return self.first_ref * 8 + self.second_ref
 
+    @property
+    def types(self) -> Tuple[str, ...]:
+        return tuple(field.value_type for field in self.columns.values())
+
+    @property
+    def values(self) -> Tuple[any, ...]:
+        return tuple(field.stored for field in self.columns.values())
+
+    @property
+    def linking_value(self) -> any:
+        return self.get_linking_column_value()
+
     def get_linking_column_value(self) -> str:
         return self.columns[self.linking_column].value  # always use non-transformed value for matching column (for 2x delta)
 
@@ -70,8 +96,10 @@ class Record:
         for col_name, value in rec.items():
             field = Field(value)
             self.columns[col_name] = field
+            if self.timestamp is None and field.value_type == 'timestamp':
+                self.timestamp = field.stored
         schema = ','.join([col_name + ':' + field.value_type for col_name, field in self.columns.items()])
-        self.schema_hash = hash(schema)
+        self.schema_hash = schema_fingerprint(schema)
         self.columns[self.linking_column].linking = True
 
     def from_vector(self, vector: List[any], schema: List[str]):
@@ -88,5 +116,65 @@ class Record:
         sch = [col_name + ':' + field.value_type for col_name, field in self.columns.items()]
         return self.schema_hash, sch
 
+    def compact(self, schema_cache: SchemaCache) -> 'CompactRecord':
+        """Returns the compact copy of record, the names and types of columns are registered in schema cache
+        """
+        types = schema_cache.types_of(self.schema_hash)
+        if types is None:
+            types = schema_cache.register(self.schema_hash, list(self.columns.keys()),
+                                          [field.value_type for field in self.columns.values()])
+        return CompactRecord(self.rec_id, self.schema_hash, types, self.values, self.get_linking_column_value(),
+                             self.timestamp, self.first_ref, self.second_ref)
+
     def __repr__(self):
         return f'{self.rec_id}:[{self.first_ref},{self.second_ref}] {self.columns}'
+
+
+class CompactRecord:
+    """Record kept in buffers and histories: stored values in a flat tuple, the column names and types
+    are shared by all records of the schema (see SchemaCache.register)
+    """
+    __slots__ = ('rec_id', 'schema_hash', 'types', 'values', 'linking_value', 'timestamp', 'first_ref', 'second_ref',
+                 'depth')
+
+    def __init__(self, rec_id: int, schema_hash: int, types: Tuple[str, ...], values: Tuple[any, ...],
+                 linking_value: any, timestamp: Optional[int] = None, first_ref: int = 0, second_ref: int = 0,
+                 depth: int = 0):
+        self.rec_id = rec_id  # absolute index of record in sequence - transient field
+        self.schema_hash = schema_hash
+        self.types = types
+        self.values = values
+        self.linking_value = linking_value  # original value of linking column - transient field
+        self.timestamp = timestamp  # stored value of the first timestamp column - transient field
+        self.first_ref = first_ref
+        self.second_ref = second_ref
+        self.depth = depth  # length of the longest reference chain down to a key record - transient field
+
+    @property
+    def signature(self) -> int:
+        return self.first_ref * 8 + self.second_ref
+
+    def get_linking_column_value(self) -> str:
+        return self.linking_value
+
+    def get_vector(self) -> List[any]:
+        return list(self.values)
+
+    def compact(self, schema_cache: SchemaCache) -> 'CompactRecord':
+        return self
+
+    def view(self, schema_cache: SchemaCache, linking_column: str = '') -> Record:
+        """Returns the record with named fields, the fields keep stored values only
+        """
+        rec = Record(self.rec_id, linking_column, self.first_ref)
+        rec.second_ref = self.second_ref
+        rec.schema_hash = self.schema_hash
+        rec.timestamp = self.timestamp
+        rec.from_vector(self.get_vector(), schema_cache.schema_of(self.schema_hash))
+        if linking_column in rec.columns:
+            rec.columns[linking_column].value = self.linking_value
+            rec.columns[linking_column].linking = True
+        return rec
+
+    def __repr__(self):
+        return f'{self.rec_id}:[{self.first_ref},{self.second_ref}] {list(zip(self.types, self.values))}'
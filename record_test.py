@@ -1,5 +1,6 @@
 import unittest
 
+from cache import SchemaCache
 from record import Record
 from utils import flatten, float_to_int
 
@@ -34,6 +35,26 @@ class TestingRecordCls(unittest.TestCase):
         extract_vector = rec.get_vector()
         print(extract_vector)
 
+    def test_compact_record(self):
+        schema_cache = SchemaCache()
+        record_1 = Record(1, linking_column='data.symbol')
+        record_1.from_dict(flatten(TestingRecordCls.r_1))
+        record_2 = Record(2, linking_column='data.symbol')
+        record_2.from_dict(flatten(TestingRecordCls.r_1))
+        compact_1 = record_1.compact(schema_cache)
+        compact_2 = record_2.compact(schema_cache)
+        self.assertIs(compact_1.types, compact_2.types)  # shared by the records of schema
+        self.assertFalse(hasattr(compact_1, '__dict__'))
+        self.assertEqual(compact_1.get_vector(), record_1.get_vector())
+        self.assertEqual(compact_1.get_linking_column_value(), 'MSFT')
+        self.assertEqual(compact_1.timestamp, record_1.timestamp)
+        self.assertEqual(schema_cache.schema_of(compact_1.schema_hash), record_1.get_schema()[1])
+
+        view = compact_1.view(schema_cache, linking_column='data.symbol')
+        self.assertEqual(view.get_vector(), record_1.get_vector())
+        self.assertEqual(view.get_schema(), record_1.get_schema())
+        self.assertEqual(view.get_linking_column_value(), 'MSFT')
+
 
 if __name__ == '__main__':
     unittest.main()
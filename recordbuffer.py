@@ -1,102 +1,156 @@
 from collections import deque
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 from cache import StringCache, SchemaCache
 from datablock import Sinkable
-from record import Record, Field
-from utils import delta_float, delta_int, delta_str, \
-    delta_array, float64_est, int32_est, int16_est, int64_est, string_est, array_est
+from history import HistoryStore, SeriesHistory, VectorLayout, Packed, DEFAULT_MAX_SERIES, DEFAULT_MAX_BYTES
+from record import Record, CompactRecord
+from utils import delta_float, delta_int, delta_str, delta_timestamp, \
+    delta_array, float64_est, int32_est, int16_est, timestamp_est, string_est, array_est
+from writer import STRING_TYPES, string_ref_bits
 
 delta_operators = {
     'float64': delta_float,
     'int32': delta_int,
     'date': delta_int,
-    'timestamp': delta_int,
+    'timestamp': delta_timestamp,
     'string': delta_str,
     'array': delta_array,
-    'nullable': delta_str
+    'nullable': delta_str,
+    'json': delta_str
 }
 
 size_operators = {
     'float64': float64_est,
     'int32': int32_est,
     'date': int16_est,
-    'timestamp': int64_est,
+    'timestamp': timestamp_est,
     'string': string_est,
     'array': array_est,
-    'nullable': string_est
+    'nullable': string_est,
+    'json': string_est
 }
 
 
-def size_bits(r: Record, verbose: bool = False) -> int:
+def size_bits(r: Record, verbose: bool = False, string_bits: int = 16) -> int:
+    """Estimated bits of record values, string indexes take string_bits (see writer.string_ref_bits)
+    """
     total = 0
-    for field in r.columns.values():
-        sz = size_operators[field.value_type](field.stored)
+    for col_type, value in zip(r.types, r.values):
+        if col_type in STRING_TYPES:
+            sz = string_est(value, string_bits)
+        else:
+            sz = size_operators[col_type](value)
         total += sz
         if verbose:
-            print(f'{field} -> {sz} bit')
+            print(f'({col_type},{value}) -> {sz} bit')
     return total
 
 
-def delta(our: Record, their: Record, iteration: int = 0) -> Record:
+def delta(our: Record, their: Record, iteration: int = 0) -> CompactRecord:
     if not their or our.schema_hash != their.schema_hash:
         return our
-    delta_record = Record(our.rec_id, our.linking_column, our.first_ref)
+    values = tuple(delta_operators[col_type](this_value, other_value)
+                   for col_type, this_value, other_value in zip(our.types, our.values, their.values))
+    delta_record = CompactRecord(our.rec_id, our.schema_hash, our.types, values, our.linking_value, our.timestamp,
+                                 our.first_ref)
     if iteration == 0:
         delta_record.first_ref = their.rec_id - our.rec_id
+        delta_record.depth = their.depth + 1
     else:
         delta_record.second_ref = their.rec_id - our.rec_id
-
-    for col_name, this_field in our.columns.items():
-        other_value = their.columns[col_name]
-        col_type = this_field.value_type
-        delta_value = delta_operators[col_type](this_field.stored, other_value.stored)
-        delta_record.columns[col_name] = Field(this_field.value, delta_value, col_type, this_field.linking)
+        delta_record.depth = max(our.depth, their.depth + 1)
     return delta_record
 
 
 DEFAULT_SEARCH_DEPTH = 50
+MAX_REFERENCE_DISTANCE = 127  # references are saved as 8-bit offsets
 
 
 class RecordBuffer(Sinkable):
+    """One pass of delta search. With max_chain no record is more than max_chain references away from a key
+    record, with key_interval every series gets a key record after at most key_interval - 1 deltas, so decoding
+    any record takes a bounded number of records. Both bounds are kept by the first pass, the second pass adds
+    references only where they do not lengthen the chain (and never to key records)
+    """
 
     def __init__(self,
                  sink: Sinkable,
                  string_cache: StringCache,
                  schema_cache: SchemaCache,
                  iteration: int = 0,
-                 max_size: int = 1000):
-        self.buffer: deque[Record] = deque()
+                 max_size: int = 1000,
+                 depth: int = DEFAULT_SEARCH_DEPTH,
+                 max_series: int = DEFAULT_MAX_SERIES,
+                 ttl: Optional[int] = None,
+                 max_chain: Optional[int] = None,
+                 key_interval: Optional[int] = None,
+                 history_bytes: int = DEFAULT_MAX_BYTES):
+        if max_chain is not None and max_chain < 0:
+            raise ValueError('reference chain can not be negative, got %s' % max_chain)
+        if key_interval is not None and key_interval < 1:
+            raise ValueError('key interval has to be at least one record, got %s' % key_interval)
+        self.buffer: deque[CompactRecord] = deque()
         self.sink = sink
         self.max_size = max_size
         self.iteration = iteration
-        # From Python 3.6 onwards, the standard dict type maintains insertion order by default.
-        self.history: Dict[str, Dict[int, Record]] = dict()
+        self.history = HistoryStore(depth, max_series, ttl, history_bytes)  # map: linking column value => series
+        self.max_chain = max_chain
+        self.key_interval = key_interval
+        self.layouts: Dict[int, VectorLayout] = dict()  # map: schema_hash => layout of stored vector
         self.string_cache = string_cache
         self.schema_cache = schema_cache
 
-    def _memo(self, rec: Record) -> None:
-        linking_column = rec.get_linking_column_value()
-        if linking_column not in self.history:
-            self.history[linking_column] = dict()
-        self.history[linking_column][rec.rec_id] = rec
-
-    def _forget(self, rec: Record) -> None:
-        linking_column = rec.get_linking_column_value()
-        if linking_column in self.history:
-            if rec.rec_id in self.history[linking_column]:
-                del self.history[linking_column][rec.rec_id]
+    def _pack(self, rec: CompactRecord) -> Optional[Packed]:
+        """Packs stored values into numpy arrays, returns None if the record has values which do not fit them
+        """
+        layout = self.layouts.get(rec.schema_hash)
+        if layout is None:
+            try:
+                layout = VectorLayout(rec.types)
+            except ValueError:
+                return None
+            self.layouts[rec.schema_hash] = layout
+        try:
+            return layout.pack(rec.values)
+        except (OverflowError, ValueError, TypeError):
+            return None
+
+    def _memo(self, rec: CompactRecord, packed: Optional[Packed] = None) -> None:
+        self.history.add(rec.get_linking_column_value(), rec, self.layouts.get(rec.schema_hash), packed)
+
+    def _forget(self, rec: CompactRecord) -> None:
+        self.history.remove(rec.get_linking_column_value(), rec)
+
+    def last_records(self) -> List[Tuple[CompactRecord, int]]:
+        """Returns the last record of every series in history and the number of records of series since its
+        last key record, the state which the next records of series refer to
+        """
+        ret = list()
+        for key in self.history:
+            series = self.history.peek(key)
+            rec = series.records.get(series.last_used)
+            if rec is not None:
+                ret.append((rec, series.since_key))
+        return ret
+
+    def restore(self, rec: CompactRecord, since_key: int) -> None:
+        """Puts the record saved by a previous run (see last_records) into history, so the next records
+        of series can refer to it. The record itself is not buffered, it is in the stream already
+        """
+        self._memo(rec, self._pack(rec))
+        self.history.peek(rec.get_linking_column_value()).since_key = since_key
 
     def index_string_values(self, rec: Record) -> None:
-        """replaces string values in record with index in string cache
+        """replaces string values (and json texts) in record with index in string cache
         """
         for field in rec.columns.values():
-            if field.value_type == 'string':
-                field.stored = self.string_cache.add(field.value)
+            if field.value_type in STRING_TYPES:
+                field.stored = self.string_cache.add(field.stored)
 
-    def get_similar(self, linking_column: str, depth: int = DEFAULT_SEARCH_DEPTH) -> List[Record]:
+    def get_similar(self, linking_column: str, depth: int = DEFAULT_SEARCH_DEPTH) -> List[CompactRecord]:
         if linking_column in self.history:
-            history = list(self.history[linking_column].values())
+            history = list(self.history.peek(linking_column).records.values())
             if self.iteration > 0:
                 history = [r for r in history if r.first_ref != 0]  # interested only in deltas
             more_than_needed = len(history) - depth
@@ -105,37 +159,90 @@ class RecordBuffer(Sinkable):
             return history[more_than_needed:]  # return the tail of the list of found records
         return list()
 
-    def find_closest_to(self, cur_record: Record) -> Record:
-        best_score = size_bits(cur_record)  # the smaller, the better
+    def _max_depth(self, cur_record: CompactRecord, series: Optional[SeriesHistory]) -> Optional[int]:
+        """Returns the longest reference chain a reference of record may have (-1 if the record has to be
+        a key record), None if the chain is not bounded
+        """
+        if self.max_chain is None and self.key_interval is None:
+            return None
+        if self.iteration > 0:
+            return cur_record.depth - 1
+        max_depth = None if self.max_chain is None else self.max_chain - 1
+        if self.key_interval is not None and series is not None:
+            # the record after `since_key` ones of series is at most that many references away from the key record
+            max_depth = series.since_key - 1 if max_depth is None else min(max_depth, series.since_key - 1)
+            if series.since_key >= self.key_interval:
+                return -1
+        return max_depth
+
+    def find_closest_to(self, cur_record: Record) -> CompactRecord:
+        cur_record = cur_record.compact(self.schema_cache)
+        return self._find_closest(cur_record, self._pack(cur_record))
+
+    def _find_closest(self, cur_record: CompactRecord, packed: Optional[Packed]) -> CompactRecord:
+        string_bits = string_ref_bits(self.string_cache.index)  # as wide as in the block the record is saved to
+        best_score = size_bits(cur_record, string_bits=string_bits)  # the smaller, the better
         found = None
-        similar = self.get_similar(linking_column=cur_record.get_linking_column_value())
-        similar.reverse()  # start from the closest by offset
-        for other in similar:
-            if other.rec_id == cur_record.rec_id:
-                continue
-            dr = delta(our=cur_record, their=other, iteration=self.iteration)
-            score = size_bits(dr)
-            if score < best_score:
-                found = dr
-                best_score = score
-
-        if not found and self.iteration == 1:
-            sch_hash, sch = cur_record.get_schema()
-            self.schema_cache.add(sch_hash, sch) # TODO faster: check hash first
+        series = self.history.get(cur_record.get_linking_column_value())
+        max_depth = self._max_depth(cur_record, series)
+        if max_depth is not None and max_depth < 0:
+            return cur_record
+        if series and packed is not None:
+            # one vectorized pass over all buffered vectors of the same schema, delta is built only for the winner
+            other, score = series.closest(cur_record, packed, MAX_REFERENCE_DISTANCE, self.iteration > 0, max_depth,
+                                          string_bits)
+            if other is not None and score < best_score:
+                found = delta(our=cur_record, their=other, iteration=self.iteration)
+        elif series:
+            similar = self.get_similar(linking_column=cur_record.get_linking_column_value())
+            similar.reverse()  # start from the closest by offset
+            for other in similar:
+                if other.rec_id == cur_record.rec_id:
+                    continue
+                if cur_record.rec_id - other.rec_id > MAX_REFERENCE_DISTANCE:
+                    break
+                if max_depth is not None and other.depth > max_depth:
+                    continue
+                dr = delta(our=cur_record, their=other, iteration=self.iteration)
+                score = size_bits(dr, string_bits=string_bits)
+                if score < best_score:
+                    found = dr
+                    best_score = score
 
         return found or cur_record
 
     def add(self, rec: Record) -> None:
-        delta_rec = self.find_closest_to(rec)  # can be either delta (if similar was found) or the same record
+        """Accepts both Record and CompactRecord, only compact records are buffered
+        """
+        rec = rec.compact(self.schema_cache)
+        packed = self._pack(rec)
+        delta_rec = self._find_closest(rec, packed)  # can be either delta (if similar was found) or the same record
+        rec.depth = delta_rec.depth
         self.buffer.append(delta_rec)
-        self._memo(rec)
+        self._memo(rec, packed)
         if len(self.buffer) > self.max_size:
             out_record = self.buffer.popleft()
             self._forget(out_record)
             self.sink.add(out_record)
 
+    def _drain(self) -> None:
+        while self.buffer:
+            out_record = self.buffer.popleft()
+            self._forget(out_record)
+            self.sink.add(out_record)
+
+    def flush(self) -> None:
+        """Pushes all buffered records down to the sink and flushes it, the following records
+        can not refer to the flushed ones
+        """
+        self._drain()
+        self.sink.flush()
+
     def close(self):
-        pass
+        """Pushes all buffered records down to the sink and closes it
+        """
+        self._drain()
+        self.sink.close()
 
     def __repr__(self):
-        return f'hist={self.history.keys()}, records: {len(self.buffer)}'
+        return f'hist={list(self.history)}, records: {len(self.buffer)}'
@@ -0,0 +1,64 @@
+import struct
+from datetime import datetime, date, timedelta
+from typing import List
+
+EPOCH_DAY = date(1970, 1, 1)
+
+
+def undelta_int(delta: int, their: int) -> int:
+    return their + delta
+
+
+def undelta_timestamp(stored: int, their: int) -> int:
+    return stored  # timestamps are not delta-encoded against references
+
+
+def undelta_float(delta: int, their: int) -> int:
+    return their ^ delta
+
+
+def undelta_str(delta: int, their: int) -> int:
+    return their if delta == 0 else delta - 1
+
+
+def undelta_array(delta: List[int], their: List[int]) -> List[int]:
+    size = min(len(delta), len(their))
+    ret = list()
+    for i in range(size):
+        ret.append(delta[i] ^ their[i])
+    if size < len(delta):
+        ret.extend(delta[size:])
+    return ret
+
+
+def int_to_float(value: int) -> float:
+    return struct.unpack('<d', struct.pack('<Q', value))[0]
+
+
+def days_epoch_to_date(days: int) -> str:
+    return (EPOCH_DAY + timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def microseconds_epoch_to_datetime(microseconds: int) -> str:
+    dt = datetime.fromtimestamp(microseconds // 1000000).replace(microsecond=microseconds % 1000000)
+    return dt.strftime('%Y-%m-%dT%H-%M-%S.%fZ')
+
+
+undelta_operators = {
+    'float64': undelta_float,
+    'int32': undelta_int,
+    'date': undelta_int,
+    'timestamp': undelta_timestamp,
+    'string': undelta_str,
+    'array': undelta_array,
+    'nullable': undelta_str,
+    'json': undelta_str
+}
+
+restore_operators = {
+    'float64': int_to_float,
+    'int32': int,
+    'date': days_epoch_to_date,
+    'timestamp': microseconds_epoch_to_datetime,
+    'array': list
+}
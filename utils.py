@@ -1,9 +1,27 @@
+import hashlib
+import json
+import struct
 import time
 from datetime import datetime, date
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 
+TIMESTAMP_BITS = 36  # typical size of timestamp delta of delta: bits 1111|6bit|zigzag value
+MAX_ARRAY_LENGTH = 31  # the length of array is saved in 5 bits
+MAX_ARRAY_ELEMENT = 255  # the elements of array are saved in 8 bits
+
+
+def is_byte_array(v: any) -> bool:
+    """Whether the value fits the array type: a list of up to MAX_ARRAY_LENGTH ints in 0..MAX_ARRAY_ELEMENT
+    """
+    return type(v) is list and len(v) <= MAX_ARRAY_LENGTH and \
+        all(type(e) is int and 0 <= e <= MAX_ARRAY_ELEMENT for e in v)
+
+
+def json_text(v: any) -> str:
+    return json.dumps(v, ensure_ascii=False, separators=(',', ':'))
+
 
 def int16_est(value: int) -> int:
     if value == 0:
@@ -19,8 +37,10 @@ def int32_est(value: int) -> int:
         return 1  # bits 0
     elif abs(value + 256) < 256:
         return 10  # bits 10|8bit
-    else:
+    elif abs(value) < 1 << 31:
         return 34  # bits 11|32bit
+    else:
+        return 98  # bits 11|32bit|64bit
 
 
 def int64_est(value: int) -> int:
@@ -44,56 +64,57 @@ float_lookup_table: List[int] = [
 ]
 
 
+def timestamp_est(value: int) -> int:
+    return TIMESTAMP_BITS  # the same for any reference, timestamps are encoded against the previous one of series
+
+
 def float64_est(value: int) -> int:
     if value == 0:
-        return 1
-    i = 0
-    while i < 8:
-        if value & float_lookup_table[i]:
-            break
-        i += 1
-    offset = i
-    i = 7
-    while i > -1:
-        if value & float_lookup_table[i]:
-            break
-        i -= 1
-    return 7 + (i - offset + 1) * 8  # bits 1|3bit|3bit|data
+        return 1  # bits 0
+    leading = min(64 - value.bit_length(), 31)
+    trailing = (value & -value).bit_length() - 1
+    return 13 + 64 - leading - trailing  # bits 11|5bit|6bit|data, reusing the window of previous value saves more
 
 
-def string_est(value: str) -> int:
+def string_est(value: int, string_bits: int = 16) -> int:
     if value:
-        return 17
+        return 1 + string_bits  # bits 1|index in string_bits (see writer.string_ref_bits)
     return 1
 
 
 def array_est(value: List[int]) -> int:
+    if not value:
+        return 5  # bits 5
     i = 0
     while i < len(value):
         if value[i] != 0:
             break
         i += 1
     if i == len(value):
-        return 1
+        return 6  # bits 5|0
     offset = i
     i = len(value) - 1
     while i > -1:
         if value[i] != 0:
             break
         i -= 1
-    return 11 + (i - offset + 1) * 8  # bits 1|5bit|5bit|data
+    return 16 + (i - offset + 1) * 8  # bits 5|1|5bit|5bit|data
 
 
 def delta_int(our: int, their: int) -> int:
     return our - their
 
 
+def delta_timestamp(our: int, their: int) -> int:
+    return our  # stays absolute, BlockWriter encodes the delta of delta to the previous timestamp of series
+
+
 def delta_float(our: int, their: int) -> int:
     return our ^ their
 
 
 def delta_str(our: int, their: int) -> int:
-    return 0 if our == their else our
+    return 0 if our == their else our + 1  # 0 is reserved for "the same string"
 
 
 def delta_array(our: List[int], their: List[int]) -> List[int]:
@@ -106,6 +127,39 @@ def delta_array(our: List[int], their: List[int]) -> List[int]:
     return ret
 
 
+def schema_fingerprint(schema: str) -> int:
+    """64-bit digest of schema "name:type,name:type...", unlike hash() it is the same in every process
+    """
+    return int.from_bytes(hashlib.blake2b(schema.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def encode_varint(value: int) -> bytes:
+    """LEB128: 7 bits per byte from the lowest ones, the high bit of byte marks that more bytes follow
+    """
+    ret = bytearray()
+    while value > 0x7f:
+        ret.append(value & 0x7f | 0x80)
+        value >>= 7
+    ret.append(value)
+    return bytes(ret)
+
+
+def decode_varint(data: bytes, pos: int = 0) -> Tuple[int, int]:
+    """Returns the value and the position after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError('varint is truncated')
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
 def flatten(rec: dict) -> dict:
     ret = dict()
     for k, v in rec.items():
@@ -119,12 +173,30 @@ def flatten(rec: dict) -> dict:
     return ret
 
 
+def unflatten(rec: dict) -> dict:
+    """Reverts flatten, nests "data." columns back into "data" dict
+    """
+    ret = dict()
+    data = dict()
+    for k, v in rec.items():
+        if k.startswith('data.'):
+            data[k[5:]] = v
+        else:
+            ret[k] = v
+    if data:
+        ret['data'] = data
+    return ret
+
+
 def _to_bytes(self, value: float) -> str:
     return hex(np.frombuffer(self.numfunc(value).tobytes(), dtype=self.parsefunc)[0]) + ' ' + str(value)
 
 
+_FLOAT64 = struct.Struct('>d')
+
+
 def float_to_int(value: float) -> int:
-    return int(np.frombuffer(np.float64(value).tobytes(), dtype=np.uint64)[0])
+    return int.from_bytes(_FLOAT64.pack(value), 'big')
 
 
 def date_to_int(value: float) -> int:
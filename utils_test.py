@@ -1,6 +1,6 @@
 import unittest
 
-from utils import short_hash
+from utils import short_hash, encode_varint, decode_varint
 
 
 class Testing(unittest.TestCase):
@@ -38,6 +38,16 @@ class Testing(unittest.TestCase):
         print('size of empty bytearray %s' % len(b_0))
         print('size of empty bytearray %s' % len(b_1))
 
+    def test_varint(self):
+        values = [0, 1, 127, 128, 300, 16383, 16384, 1 << 35]
+        data = b''.join(encode_varint(v) for v in values)
+        self.assertEqual(encode_varint(300), b'\xac\x02')
+        pos = 0
+        for v in values:
+            restored, pos = decode_varint(data, pos)
+            self.assertEqual(restored, v)
+        self.assertEqual(pos, len(data))
+
 
 
 
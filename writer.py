@@ -1,12 +1,25 @@
-from typing import List
+import json
+from time import perf_counter
+from typing import List, Iterable, Dict, Callable, Sequence, Tuple, Optional
 
 from bitbuffer import BufferWriter
-from record import Record
-from utils import float_lookup_table
+from cache import SchemaCache
+from record import CompactRecord
+from utils import MAX_ARRAY_LENGTH, MAX_ARRAY_ELEMENT
 
 KEY_RECORD_BLOCK: int = 0  # [x00, x00]
 SCHEMA_BLOCK: int = 1  # [x00, x01]
 STRING_CACHE_BLOCK: int = 2  # [x00, x02]
+INDEX_BLOCK: int = 3  # [x00, x03]
+META_BLOCK: int = 4  # [x00, x04]
+RECORD_BLOCK: int = 5  # [x00, x05] starts the records of block, timestamps of every series restart from zero
+COLUMNAR_BLOCK: int = 6  # [x00, x06]|records|headers of records|streams|(column id|bits) per stream|streams
+LAYOUT_ROWS = 'rows'  # records of block one after another
+LAYOUT_COLUMNS = 'columns'  # every column of block in own stream (COLUMNAR_BLOCK)
+LAYOUTS = (LAYOUT_ROWS, LAYOUT_COLUMNS)
+STRING_TYPES = ('string', 'nullable', 'json')  # col_types saved as index in string cache
+
+INDEX_MAGIC = b'TSIX'  # the last bytes of stream: [index block offset (8 bytes)|magic (4 bytes)]
 
 UINT8 = 1 << 7
 UINT16 = 1 << 15
@@ -33,80 +46,157 @@ def t_uint64(v: int) -> int:
 def t_int16(buf: BufferWriter, value: int) -> None:
     if value == 0:
         buf.add_value(0, 1)  # bits 0
-    elif t_uint8(value) < 256:
+    elif 0 <= t_uint8(value) < 256:
         buf.add_value(2, 2)
         buf.add_value(t_uint8(value), 8)  # bits 10|8bit
-    else:
+    elif -UINT16 < value < UINT16:
         buf.add_value(3, 2)
         buf.add_value(t_uint16(value), 16)  # bits 11|16bit
+    else:
+        buf.add_value(3, 2)
+        buf.add_value(0, 16)  # bits 11|16bit, -UINT16 is reserved as an escape to zigzag varint of any size
+        t_varint(buf, zigzag(value))
 
 
 def t_int32(buf: BufferWriter, value: int) -> None:
     if value == 0:
         buf.add_value(0, 1)  # bits 0
-    elif t_uint8(value) < 256:
+    elif 0 <= t_uint8(value) < 256:
         buf.add_value(2, 2)
         buf.add_value(t_uint8(value), 8)  # bits 10|8bit
-    else:
+    elif -UINT32 < value < UINT32:
         buf.add_value(3, 2)
         buf.add_value(t_uint32(value), 32)  # bits 11|32bit
+    else:
+        buf.add_value(3, 2)
+        buf.add_value(0, 32)  # bits 11|32bit, -UINT32 is reserved as an escape to zigzag varint of any size
+        t_varint(buf, zigzag(value))
 
 
 def t_int64(buf: BufferWriter, value: int) -> None:
     if value == 0:
         buf.add_value(0, 1)  # bits 0
-    elif t_uint8(value) < 256:
+    elif 0 <= t_uint8(value) < 256:
         buf.add_value(2, 2)
         buf.add_value(t_uint8(value), 8)  # bits 10|8bit
-    else:
+    elif -UINT64 <= value < UINT64:
         buf.add_value(3, 2)
         buf.add_value(t_uint64(value), 64)  # bits 11|64bit
+    else:
+        raise ValueError('%s does not fit into 64 bits' % value)
 
 
-def t_float64(buf: BufferWriter, value: int) -> None:
+def zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def t_varint(buf: BufferWriter, value: int) -> None:
+    """Saves non-negative value in 8-bit groups of 7 bits (the lowest first), the high bit marks that more follow
+    """
+    while value > 0x7f:
+        buf.add_value(value & 0x7f | 0x80, 8)
+        value >>= 7
+    buf.add_value(value, 8)
+
+
+def varint_bits(value: int) -> Tuple[int, int]:
+    """The same bits as t_varint() adds, returned as (value, number of bits)
+    """
+    acc = 0
+    n = 8
+    while value > 0x7f:
+        acc = (acc << 8) | value & 0x7f | 0x80
+        n += 8
+        value >>= 7
+    return (acc << 8) | value, n
+
+
+def t_dod(buf: BufferWriter, value: int) -> None:
+    """Saves delta of delta of timestamp (see BlockWriter.save_record) in Gorilla buckets
+    """
+    if value == 0:
+        buf.add_value(0, 1)  # bits 0
+    elif -63 <= value <= 64:
+        buf.add_value(2, 2)
+        buf.add_value(value + 63, 7)  # bits 10|7bit
+    elif -255 <= value <= 256:
+        buf.add_value(6, 3)
+        buf.add_value(value + 255, 9)  # bits 110|9bit
+    elif -2047 <= value <= 2048:
+        buf.add_value(14, 4)
+        buf.add_value(value + 2047, 12)  # bits 1110|12bit
+    else:
+        z = zigzag(value)
+        if z.bit_length() > 64:
+            raise ValueError('timestamp delta of delta %s does not fit into 64 bits' % value)
+        buf.add_value(15, 4)
+        buf.add_value(z.bit_length() - 1, 6)
+        buf.add_value(z, z.bit_length())  # bits 1111|6bit width|zigzag value
+
+
+def t_float64(buf: BufferWriter, value: int, window: List[int] = None, k: int = 0) -> None:
+    """Saves xor'ed float (see delta_float) with bit-granular window of meaningful bits,
+    window[k] and window[k + 1] keep the leading zeros and the length of the previous window
+    (the length of 0 means no window). Unlike Gorilla, the previous window is reused only if it is not
+    longer than the new one with its header (xor against different references varies a lot)
+    """
     if value == 0:
         buf.add_value(0, 1)  # bits 0
         return
-    # here: value is NOT zero => must have at least 1 non-zero byte
-    i = 0
-    while i < 8:
-        if value & float_lookup_table[i]:
-            break
-        i += 1
-    first_non_zero_byte = i  # edge cases -  (i=0) no prefix (i=7) - only 1 last byte is != 0
-    i = 7
-    while i > -1:
-        if value & float_lookup_table[i]:
-            break
-        i -= 1
-    last_non_zero_byte = i  # edge cases -  (7) no suffix) (0) - first byte
-    important_bytes = last_non_zero_byte - first_non_zero_byte
-    buf.add_value(1, 1)  # bits 1
-    buf.add_value(first_non_zero_byte, 3)  # bits 3
-    buf.add_value(important_bytes, 3)  # bits 3
-    shift_in_bits = (7 - last_non_zero_byte) * 8
-    value = value >> shift_in_bits
-    buf.add_value(value, (important_bytes + 1) * 8)  # bits 1  # bits 1|3bit|3bit|data
+    if window is None:
+        window = [0, 0]
+    leading = min(64 - value.bit_length(), 31)
+    trailing = (value & -value).bit_length() - 1
+    size = window[k + 1]
+    if size and window[k] <= leading and 64 - window[k] - size <= trailing and size <= 75 - leading - trailing:
+        buf.add_value(2, 2)
+        buf.add_value(value >> (64 - window[k] - size), size)  # bits 10|data in the previous window
+        return
+    size = 64 - leading - trailing
+    window[k], window[k + 1] = leading, size
+    buf.add_value(3, 2)
+    buf.add_value(leading, 5)
+    buf.add_value(size - 1, 6)
+    buf.add_value(value >> trailing, size)  # bits 11|5bit leading zeros|6bit length|data
+
+
+def string_ref_bits(strings: int) -> int:
+    """Width of string index in a block after `strings` saved strings: a delta of delta (see delta_str)
+    adds one to the index twice, so the values reach strings + 1
+    """
+    return (strings + 1).bit_length()
 
 
-def t_str(buf: BufferWriter, value: int) -> None:
+def t_str(buf: BufferWriter, value: int, width: int = 16) -> None:
+    """Saves index in string cache (or index + 1, see delta_str) in `width` bits, which covers the size of cache
+    """
     if value == 0:
         buf.add_value(0, 1)  # bits 0
         return
+    if value.bit_length() > width:
+        raise ValueError('string index %s does not fit into %s bits' % (value, width))
     buf.add_value(1, 1)  # bits 1
-    buf.add_value(value, 16)  # bits 16 for index TODO can be optimized
+    buf.add_value(value, width)  # bits 1|index
 
 
 def t_array(buf: BufferWriter, arr: List[int]) -> None:
+    """Saves up to MAX_ARRAY_LENGTH elements of 0..MAX_ARRAY_ELEMENT, raises ValueError on other arrays
+    (which are typed as json, see utils.is_byte_array)
+    """
+    if len(arr) > MAX_ARRAY_LENGTH:
+        raise ValueError('array of %s elements is longer than %s' % (len(arr), MAX_ARRAY_LENGTH))
+    buf.add_value(len(arr), 5)  # bits 5
     if not arr:
-        buf.add_value(0, 1)  # bits 0
         return
-    # here: arr has at least 1 non-zero byte
     i = 0
     while i < len(arr):
         if arr[i]:
             break
         i += 1
+    if i == len(arr):
+        buf.add_value(0, 1)  # bits 5|0
+        return
+    # here: arr has at least 1 non-zero byte
     first_non_zero_byte = i  # edge cases -  (i=0) no prefix (i=7) - only 1 last byte
     i = len(arr) - 1
     while i > -1:
@@ -120,7 +210,9 @@ def t_array(buf: BufferWriter, arr: List[int]) -> None:
     buf.add_value(important_bytes, 5)  # bits 5
     i = first_non_zero_byte
     while i <= last_non_zero_byte:
-        buf.add_value(arr[i], 8)  # bits 1  # bits 1|5bit|5bit|data
+        if not 0 <= arr[i] <= MAX_ARRAY_ELEMENT:
+            raise ValueError('array element %s does not fit into 8 bits' % arr[i])
+        buf.add_value(arr[i], 8)  # bits 5|1|5bit|5bit|data
         i += 1
 
 
@@ -128,18 +220,221 @@ t_operators = {
     'float64': t_float64,
     'int32': t_int32,
     'date': t_int16,
-    'timestamp': t_int64,
+    'timestamp': t_dod,
     'string': t_str,
     'array': t_array,
-    'nullable': t_str
+    'nullable': t_str,
+    'json': t_str
+}
+
+
+def array_bits(arr: List[int]) -> Tuple[int, int]:
+    """The same bits as t_array() adds, returned as (value, number of bits)
+    """
+    if len(arr) > MAX_ARRAY_LENGTH:
+        raise ValueError('array of %s elements is longer than %s' % (len(arr), MAX_ARRAY_LENGTH))
+    first = 0
+    while first < len(arr) and not arr[first]:
+        first += 1
+    if first == len(arr):
+        return len(arr) << 1, 6 if arr else 5  # bits 5|0 or bits 5 for empty array
+    last = len(arr) - 1
+    while not arr[last]:
+        last -= 1
+    value = (((len(arr) << 1) | 1) << 10) | (first << 5) | (last - first)
+    for i in range(first, last + 1):
+        if not 0 <= arr[i] <= MAX_ARRAY_ELEMENT:
+            raise ValueError('array element %s does not fit into 8 bits' % arr[i])
+        value = (value << 8) | arr[i]
+    return value, 16 + (last - first + 1) * 8  # bits 5|1|5bit|5bit|data
+
+
+# Inlined bodies of t_* operators: every one appends the bits of value `v` to the integer `acc` of `n` bits
+_int_template = '''
+    if v == 0:
+        acc <<= 1
+        n += 1
+    elif -128 <= v < 128:
+        acc = (acc << 10) | 0x200 | (v + 128)
+        n += 10
+    elif -{limit} < v < {limit}:
+        acc = (acc << {wide}) | {wide_prefix} | (v + {limit})
+        n += {wide}
+    else:
+        value, bits = varint_bits(zigzag(v))
+        acc = (((acc << {wide}) | {wide_prefix}) << bits) | value
+        n += {wide} + bits
+'''
+
+_encoder_templates = {
+    'int32': _int_template.format(limit=UINT32, wide=34, wide_prefix=3 << 32),
+    'date': _int_template.format(limit=UINT16, wide=18, wide_prefix=3 << 16),
+    'string': '''
+    if v == 0:
+        acc <<= 1
+        n += 1
+    elif v >> string_bits:
+        raise ValueError('string index %s does not fit into %s bits' % (v, string_bits))
+    else:
+        acc = (((acc << 1) | 1) << string_bits) | v
+        n += 1 + string_bits
+''',
+    'array': '''
+    value, bits = array_bits(v)
+    acc = (acc << bits) | value
+    n += bits
+''',
 }
+_encoder_templates['nullable'] = _encoder_templates['string']
+_encoder_templates['json'] = _encoder_templates['string']
+
+# Inlines t_float64, window[k] and window[k + 1] keep the leading zeros and the length of the previous window
+_float_template = '''
+    if v == 0:
+        acc <<= 1
+        n += 1
+    else:
+        leading = 64 - v.bit_length()
+        if leading > 31:
+            leading = 31
+        trailing = (v & -v).bit_length() - 1
+        size = window[{k1}]
+        if size and window[{k}] <= leading and 64 - window[{k}] - size <= trailing and size <= 75 - leading - trailing:
+            acc = (((acc << 2) | 2) << size) | (v >> (64 - window[{k}] - size))
+            n += 2 + size
+        else:
+            size = 64 - leading - trailing
+            window[{k}] = leading
+            window[{k1}] = size
+            acc = (((acc << 13) | 0x1800 | (leading << 6) | (size - 1)) << size) | (v >> trailing)
+            n += 13 + size
+'''
+
+# Inlines t_dod
+_dod_template = '''
+    if v == 0:
+        acc <<= 1
+        n += 1
+    elif -63 <= v <= 64:
+        acc = (acc << 9) | 0x100 | (v + 63)
+        n += 9
+    elif -255 <= v <= 256:
+        acc = (acc << 12) | 0xc00 | (v + 255)
+        n += 12
+    elif -2047 <= v <= 2048:
+        acc = (acc << 16) | 0xe000 | (v + 2047)
+        n += 16
+    else:
+        z = zigzag(v)
+        width = z.bit_length()
+        if width > 64:
+            raise ValueError('timestamp delta of delta %s does not fit into 64 bits' % v)
+        acc = (((acc << 10) | 0x3c0 | (width - 1)) << width) | z
+        n += 10 + width
+'''
+
+# Replaces absolute timestamp `v` with its delta of delta, state[k] and state[k + 1] keep the previous
+# timestamp and delta of the series, then inlines t_dod
+_timestamp_template = '''
+    t = v - state[{k}]
+    state[{k}] = v
+    v = t - state[{k1}]
+    state[{k1}] = t
+''' + _dod_template
+
+
+def compile_encoder(types: Sequence[str], profile: Optional[Tuple[List[int], List[float]]] = None) \
+        -> Callable[[BufferWriter, Sequence[any], List[int], List[int], int], None]:
+    """Generates the function which encodes the stored values of a schema with the t_* operators
+    inlined in the order of columns, the bits of whole record are added to the buffer at once.
+    The state of series is passed in list of 2 values per timestamp column and the windows of float columns
+    in list of 2 values per float column (see BlockWriter.save_record), string indexes take string_bits.
+    With profile (lists of bits and seconds per column) the function adds the bits and time of every column
+    to them, without it the function has no accounting code at all
+    """
+    lines = ['def encode(buf, values, state, window, string_bits):', '    acc = 0', '    n = 0']
+    if profile:
+        lines.append('    mark = perf_counter()')
+    timestamps = 0
+    floats = 0
+    for i, col_type in enumerate(types):
+        lines.append('    v = values[%s]' % i)
+        if col_type == 'timestamp':
+            lines.append(_timestamp_template.format(k=timestamps * 2, k1=timestamps * 2 + 1).strip('\n'))
+            timestamps += 1
+        elif col_type == 'float64':
+            lines.append(_float_template.format(k=floats * 2, k1=floats * 2 + 1).strip('\n'))
+            floats += 1
+        else:
+            lines.append(_encoder_templates[col_type].strip('\n'))
+        if profile:
+            lines.extend(['    clock = perf_counter()', '    column_seconds[%s] += clock - mark' % i, '    mark = clock',
+                          '    column_bits[%s] += n - %s' % (i, 'before' if i else '0'), '    before = n'])
+    lines.append('    buf.add_value(acc, n)')
+    namespace = {'array_bits': array_bits, 'varint_bits': varint_bits, 'zigzag': zigzag}
+    if profile:
+        namespace.update(perf_counter=perf_counter, column_bits=profile[0], column_seconds=profile[1])
+    exec('\n'.join(lines), namespace)
+    return namespace['encode']
+
+
+def compile_column_encoder(col_type: str) -> Callable[[Sequence[any], List[int], int], Tuple[int, int]]:
+    """Generates the function which encodes all values of a column stream in one loop with the same inlined
+    operators as compile_encoder, returns the bits as (value, number of bits). Timestamps are passed as deltas
+    of delta and the floats share the window of stream
+    """
+    if col_type == 'timestamp':
+        body = _dod_template
+    elif col_type == 'float64':
+        body = _float_template.format(k=0, k1=1)
+    else:
+        body = _encoder_templates[col_type]
+    lines = ['def encode(values, window, string_bits):', '    acc = 0', '    n = 0', '    for v in values:']
+    lines.extend('    ' + line if line else line for line in body.strip('\n').split('\n'))
+    lines.append('    return acc, n')
+    namespace = {'array_bits': array_bits, 'varint_bits': varint_bits, 'zigzag': zigzag}
+    exec('\n'.join(lines), namespace)
+    return namespace['encode']
 
 
 class BlockWriter:
     FIRST_BIT = 1 << 63
 
-    def __init__(self, bit_buffer: BufferWriter):
+    def __init__(self, bit_buffer: BufferWriter, profile: bool = False):
         self.buf = bit_buffer
+        self.profile = profile
+        self.profiles: Dict[int, Tuple[List[int], List[float]]] = dict()  # map: schema_hash => (bits, seconds) per column
+        self.encoders: Dict[int, Tuple[Callable, int, int]] = dict()  # map: schema_hash => (encoder, timestamps, floats)
+        self.series: Dict[any, List[int]] = dict()  # map: linking value => (previous timestamp, delta) per column
+        self.linked = False  # timestamps of stream without linking column in meta are one series
+        self.float_windows: List[int] = list()  # (leading zeros, length) of the previous window per float column
+        self.string_bits = 0  # width of string index in the current block
+        self.index_offset: Optional[int] = None  # bit offset of the block index, once it is saved
+        self.columns: Dict[str, int] = dict()  # map: col_name:col_type => column id, given in order of schema ids
+        self.column_names: List[str] = list()  # col_name:col_type by column id
+        self.schema_columns: Dict[int, List[int]] = dict()  # map: schema_hash => column ids
+        self.registered = 0  # number of schemas with registered columns
+        self.column_encoders: Dict[str, Callable] = dict()  # map: col_type => column encoder
+
+    def save_meta(self, meta: dict) -> None:
+        """Saves the properties of stream, e.g. linking column which identifies series for timestamp decoding
+        """
+        data = json.dumps(meta).encode('utf-8')
+        self.linked = meta.get('linking_column') is not None
+        self.buf.set_metric('meta block')
+        self.buf.add_value(META_BLOCK, 16)
+        self.buf.add_value(len(data), 32)
+        self.buf.add_bytes(data)
+
+    def start_block(self, strings: int = 0) -> None:
+        """Starts the records of block, string indexes of block take the bits of the number of saved strings
+        (plus one, see string_ref_bits), the reader knows it too after the dictionary blocks
+        """
+        self.buf.set_metric('block header')
+        self.buf.add_value(RECORD_BLOCK, 16)
+        self.string_bits = string_ref_bits(strings)
+        self.series.clear()
+        self.float_windows.clear()
 
     def save_schema(self, data: bytes) -> None:
         if not data or len(data) == 0:
@@ -147,8 +442,7 @@ class BlockWriter:
         self.buf.set_metric('schema block')
         self.buf.add_value(SCHEMA_BLOCK, 16)
         self.buf.add_value(len(data), 32)
-        for b in data:
-            self.buf.add_value(b, 8)
+        self.buf.add_bytes(data)
 
     def save_string_cache(self, data: bytes) -> None:
         if not data or len(data) == 0:
@@ -156,10 +450,31 @@ class BlockWriter:
         self.buf.set_metric('string cache')
         self.buf.add_value(STRING_CACHE_BLOCK, 16)
         self.buf.add_value(len(data), 32)
-        for b in data:
-            self.buf.add_value(b, 8)
+        self.buf.add_bytes(data)
+
+    def save_index(self, entries: Iterable) -> None:
+        """Saves the block index footer, followed by byte-aligned trailer which points to it
+        """
+        entries = list(entries)
+        offset = self.index_offset = self.buf.position
+        self.buf.set_metric('block index')
+        self.buf.add_value(INDEX_BLOCK, 16)
+        self.buf.add_value(len(entries), 32)
+        for e in entries:
+            self.buf.add_values([(e.bit_offset, 64), (e.first_rec_id, 64), (e.last_rec_id, 64), (e.anchor, 32)])
+            if e.min_timestamp is None:
+                self.buf.add_value(0, 1)  # bits 0
+            else:
+                self.buf.add_value(1, 1)  # bits 1|64bit|64bit
+                self.buf.add_value(t_uint64(e.min_timestamp), 64)
+                self.buf.add_value(t_uint64(e.max_timestamp), 64)
+        self.buf.add_value(0, -self.buf.position % 8)
+        self.buf.add_value(offset, 64)
+        self.buf.add_bytes(INDEX_MAGIC)
 
-    def save_record(self, r: Record) -> None:
+    def save_record(self, r: CompactRecord, schema_id: Optional[int] = None) -> None:
+        """Saves the record, key records refer to their schema by the id given by SchemaCache.add
+        """
         # print('sink: %s' % r)
         if r.signature == KEY_RECORD_BLOCK:
             self.buf.set_metric('key record')
@@ -168,6 +483,106 @@ class BlockWriter:
         self.buf.add_value(r.first_ref + 128, 8)
         self.buf.add_value(r.second_ref + 128, 8)
         if r.signature == KEY_RECORD_BLOCK:
-            self.buf.add_value(r.schema_hash, 32)
-        for field in r.columns.values():
-            t_operators[field.value_type](self.buf, field.stored)
+            if schema_id is None:
+                raise ValueError('key record %s has no saved schema' % r.rec_id)
+            t_varint(self.buf, schema_id)
+        if r.schema_hash not in self.encoders:
+            profile = None
+            if self.profile:
+                profile = self.profiles[r.schema_hash] = ([0] * len(r.types), [0.0] * len(r.types))
+            self.encoders[r.schema_hash] = (compile_encoder(r.types, profile), r.types.count('timestamp'),
+                                            r.types.count('float64'))
+        encoder, timestamps, floats = self.encoders[r.schema_hash]
+        series = r.linking_value if self.linked else None
+        state = self.series.get(series)
+        if state is None:
+            state = self.series[series] = list()
+        if len(state) < timestamps * 2:
+            state.extend([0] * (timestamps * 2 - len(state)))
+        if len(self.float_windows) < floats * 2:
+            self.float_windows.extend([0] * (floats * 2 - len(self.float_windows)))
+        encoder(self.buf, r.values, state, self.float_windows, self.string_bits)
+
+    def _register_columns(self, schema_cache: SchemaCache) -> None:
+        """Gives ids to the columns of saved schemas, the reader gives the same ones by reading schema blocks
+        """
+        for schema_hash, schema in list(schema_cache.schemas.items())[self.registered:]:
+            for column in schema:
+                if column not in self.columns:
+                    self.columns[column] = len(self.columns)
+                    self.column_names.append(column)
+            self.schema_columns[schema_hash] = [self.columns[column] for column in schema]
+        self.registered = len(schema_cache.schemas)
+
+    def _timestamp_dods(self, r: CompactRecord) -> List[any]:
+        """Returns the values of record with timestamps replaced by delta of delta in their series,
+        the same which save_record encodes
+        """
+        state = self.series.setdefault(r.linking_value if self.linked else None, list())
+        values = list(r.values)
+        k = 0
+        for i, col_type in enumerate(r.types):
+            if col_type == 'timestamp':
+                if len(state) < k + 2:
+                    state.extend([0, 0])
+                delta = values[i] - state[k]
+                state[k] = values[i]
+                values[i] = delta - state[k + 1]
+                state[k + 1] = delta
+                k += 2
+        return values
+
+    def save_columnar_block(self, records: List[CompactRecord], schema_cache: SchemaCache, strings: int = 0) -> None:
+        """Saves the records of block column by column: the headers of records (references and schema ids of
+        key records), then the directory of column streams (column id and number of bits of every stream)
+        and the streams, every one holds the values of column in order of records which have it.
+        Floats keep one window per stream, timestamps are restarted by the block as in record blocks
+        """
+        self.buf.set_metric('block header')
+        self.buf.add_value(COLUMNAR_BLOCK, 16)
+        self.string_bits = string_ref_bits(strings)
+        self.series.clear()
+        self._register_columns(schema_cache)
+        self.buf.set_metric('record header')
+        t_varint(self.buf, len(records))
+        streams: Dict[int, List[any]] = dict()  # map: column id => values
+        for r in records:
+            self.buf.add_value(r.first_ref + 128, 8)
+            self.buf.add_value(r.second_ref + 128, 8)
+            if r.signature == KEY_RECORD_BLOCK:
+                if r.schema_hash not in schema_cache.ids:
+                    raise ValueError('key record %s has no saved schema' % r.rec_id)
+                t_varint(self.buf, schema_cache.ids[r.schema_hash])
+            values = self._timestamp_dods(r) if 'timestamp' in r.types else r.values
+            for column, value in zip(self.schema_columns[r.schema_hash], values):
+                if column in streams:
+                    streams[column].append(value)
+                else:
+                    streams[column] = [value]
+        encoded = list()
+        for column in sorted(streams):
+            col_type = self.column_names[column].rsplit(':', 1)[1]
+            if col_type not in self.column_encoders:
+                self.column_encoders[col_type] = compile_column_encoder(col_type)
+            start = perf_counter()
+            value, bits = self.column_encoders[col_type](streams[column], [0, 0], self.string_bits)
+            if self.profile:
+                self.buf.stat.measure_column(self.column_names[column], bits, perf_counter() - start)
+            encoded.append((column, value, bits))
+        self.buf.set_metric('column directory')
+        t_varint(self.buf, len(encoded))
+        for column, _, bits in encoded:
+            t_varint(self.buf, column)
+            t_varint(self.buf, bits)
+        self.buf.set_metric('column stream')
+        for _, value, bits in encoded:
+            self.buf.add_value(value, bits)
+
+    def report_columns(self, schema_cache: SchemaCache) -> None:
+        """Adds the profiled bits and time of columns to the statistics of buffer, see Statistics.columns
+        """
+        for schema_hash, (bits, seconds) in self.profiles.items():
+            for column, column_bits, column_seconds in zip(schema_cache.schema_of(schema_hash), bits, seconds):
+                self.buf.stat.measure_column(column, column_bits, column_seconds)
+            bits[:] = [0] * len(bits)
+            seconds[:] = [0.0] * len(seconds)
@@ -1,7 +1,11 @@
+import io
+import os
+import random
+import tempfile
 import unittest
 
 from bitbuffer import DummyBufferWriter, BitBufferWriter
-from writer import BlockWriter
+from writer import BlockWriter, compile_encoder, compile_column_encoder, t_operators, t_dod, t_float64, t_str
 
 
 class TestingBitBuffer(unittest.TestCase):
@@ -13,14 +17,138 @@ class TestingBitBuffer(unittest.TestCase):
         bw.save_schema(data)
 
     def test_bytes_real_test(self):
-
-        with open('test2.bin', 'wb') as f:
+        with tempfile.TemporaryDirectory() as tmp, open(os.path.join(tmp, 'test2.bin'), 'wb') as f:
             bb = BitBufferWriter(f)
             bw = BlockWriter(bit_buffer=bb)
             data = bytes('test:data_as_a_sequence', encoding='UTF-8')
             bw.save_schema(data)
             bb.close()
 
+    def test_compiled_encoder(self):
+        random.seed(3)
+        types = ['float64', 'int32', 'date', 'string', 'array', 'nullable']
+        samples = {
+            'float64': [0, 1, 0xff, 1 << 63, 0x0102030405060708, 0x00ff000000000000, 0xffffffffffffffff,
+                        0x00f0000000000000, 0x0070000000000000, 0x405bc80000000000],
+            'int32': [0, 1, -1, 127, -128, 128, -129, (1 << 31) - 1, -(1 << 31), 1 << 31, -(1 << 40), (1 << 70) + 2,
+                      -(1 << 64)],
+            'date': [0, 5, -128, 200, -(1 << 15) + 1, -(1 << 15), 1 << 15, 1 << 20, 1 << 64],
+            'string': [0, 1, 0xffff, 0x1ffff],
+            'array': [[], [0, 0], [1], [0, 3, 0, 255, 0], list(range(31))],
+            'nullable': [0, 7],
+        }
+        encoder = compile_encoder(types)
+        expected_window, actual_window = [0, 0], [0, 0]
+        for _ in range(200):
+            values = [random.choice(samples[t]) for t in types]
+            expected, actual = io.BytesIO(), io.BytesIO()
+            bb = BitBufferWriter(expected)
+            bb.set_metric('record')
+            for t, v in zip(types, values):
+                if t == 'float64':
+                    t_float64(bb, v, expected_window)
+                elif t in ('string', 'nullable'):
+                    t_str(bb, v, 17)
+                else:
+                    t_operators[t](bb, v)
+            bb.close()
+            bb = BitBufferWriter(actual)
+            bb.set_metric('record')
+            encoder(bb, values, [], actual_window, 17)
+            bb.close()
+            self.assertEqual(actual.getvalue(), expected.getvalue(), values)
+
+    def test_column_encoder(self):
+        random.seed(7)
+        samples = {
+            'float64': [0, 1, 1 << 63, 0x00ff000000000000, 0x0070000000000000, 0x405bc80000000000],
+            'int32': [0, -1, 127, -129, (1 << 31) - 1, -(1 << 40)],
+            'timestamp': [0, 63, -64, 2048, -(1 << 40)],
+            'string': [0, 1, 0x1ffff],
+            'array': [[], [0, 3, 0, 255, 0], list(range(31))],
+        }
+        for col_type, sample in samples.items():
+            values = [random.choice(sample) for _ in range(100)]
+            expected, actual = io.BytesIO(), io.BytesIO()
+            bb = BitBufferWriter(expected)
+            bb.set_metric('record')
+            window = [0, 0]
+            for v in values:
+                if col_type == 'float64':
+                    t_float64(bb, v, window)
+                elif col_type == 'timestamp':
+                    t_dod(bb, v)
+                elif col_type == 'string':
+                    t_str(bb, v, 17)
+                else:
+                    t_operators[col_type](bb, v)
+            bb.close()
+            bb = BitBufferWriter(actual)
+            bb.set_metric('record')
+            bb.add_value(*compile_column_encoder(col_type)(values, [0, 0], 17))
+            bb.close()
+            self.assertEqual(actual.getvalue(), expected.getvalue(), col_type)
+
+    def test_string_width(self):
+        for encoder in (compile_encoder(['string']), compile_encoder(['nullable'], ([0], [0.0]))):
+            bb = BitBufferWriter(io.BytesIO())
+            bb.set_metric('record')
+            encoder(bb, [7], [], [], 3)
+            with self.assertRaises(ValueError):
+                encoder(bb, [8], [], [], 3)
+        with self.assertRaises(ValueError):
+            compile_column_encoder('string')([1, 8], [0, 0], 3)
+
+    def test_invalid_arrays(self):
+        encoder = compile_encoder(['array'])
+        for arr in ([1000], [-1], [0, 256, 0], list(range(32))):
+            bb = BitBufferWriter(io.BytesIO())
+            bb.set_metric('record')
+            with self.assertRaises(ValueError):
+                t_operators['array'](bb, arr)
+            with self.assertRaises(ValueError):
+                encoder(bb, [arr], [], [], 0)
+
+    def test_profiled_encoder(self):
+        types = ['timestamp', 'float64', 'string', 'array']
+        plain, profiled = io.BytesIO(), io.BytesIO()
+        bits, seconds = [0] * 4, [0.0] * 4
+        for out, encoder in [(plain, compile_encoder(types)), (profiled, compile_encoder(types, (bits, seconds)))]:
+            bb = BitBufferWriter(out)
+            bb.set_metric('record')
+            state, window = [0, 0], [0, 0]
+            for i in range(50):
+                encoder(bb, [1000 * i, (i * 0x10001) << 20, i % 3, [i % 5, 0, 1]], state, window, 2)
+            bb.close()
+        self.assertEqual(profiled.getvalue(), plain.getvalue())
+        self.assertEqual(sum(bits), bb.stat.volume['record'])
+        self.assertEqual(bits[2], 50 + 33 * 2)  # 17 zeros of 1 bit, 33 indexes of 1 + 2 bits
+        self.assertTrue(all(s > 0 for s in seconds))
+
+    def test_compiled_timestamps(self):
+        random.seed(5)
+        timestamps = [946684800036258]
+        for _ in range(300):
+            timestamps.append(timestamps[-1] + random.choice([0, 1, 86400000000, 3 * 86400000000]) +
+                              random.choice([0, 1, -40, 200, -2000, 4000, 99999, -(1 << 40)]))
+        expected, actual = io.BytesIO(), io.BytesIO()
+        bb = BitBufferWriter(expected)
+        bb.set_metric('record')
+        prev_ts, prev_delta = 0, 0
+        for ts in timestamps:
+            t_dod(bb, ts - prev_ts - prev_delta)
+            prev_ts, prev_delta = ts, ts - prev_ts
+        bb.close()
+        bb = BitBufferWriter(actual)
+        bb.set_metric('record')
+        encoder = compile_encoder(['timestamp'])
+        state = [0, 0]
+        for ts in timestamps:
+            encoder(bb, [ts], state, [], 0)
+        bb.close()
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+        self.assertEqual(state, [timestamps[-1], timestamps[-1] - timestamps[-2]])
+
 
 if __name__ == '__main__':
     unittest.main()